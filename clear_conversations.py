@@ -199,6 +199,7 @@ if __name__ == "__main__":
     parser.add_argument("--info", action="store_true", help="查看用户信息")
     
     args = parser.parse_args()
+    session_manager.connect()
     
     if args.list:
         asyncio.run(list_all_conversations())
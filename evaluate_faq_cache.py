@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+近似重复问题缓存阈值评估工具
+
+用历史日志离线评估 faq_cache.threshold 的取值：
+
+1. 标注样本（JSONL，每行一对问题）计算各阈值下的准确率/召回率/F1：
+       {"a": "怎么申请退款", "b": "如何申请退款？", "duplicate": true}
+
+       python evaluate_faq_cache.py pairs.jsonl
+
+2. 未标注的问题日志（每行一个问题，按时间顺序）模拟缓存命中率，
+   并打印部分命中样例供人工检查：
+       python evaluate_faq_cache.py --queries queries.txt
+"""
+
+import argparse
+import json
+import sys
+from pathlib import Path
+
+# 添加src目录到路径
+sys.path.insert(0, str(Path(__file__).parent / "src"))
+
+from src.config import config
+from src.faq_cache import FAQCache, jaccard, shingles
+
+THRESHOLDS = [round(0.3 + 0.05 * i, 2) for i in range(13)]
+
+def evaluate_pairs(path: str):
+    """在标注样本上按阈值计算准确率/召回率"""
+    scored = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            pair = json.loads(line)
+            similarity = jaccard(
+                shingles(pair["a"], config.faq_cache.shingle_size),
+                shingles(pair["b"], config.faq_cache.shingle_size)
+            )
+            scored.append((similarity, bool(pair["duplicate"])))
+
+    positives = sum(1 for _, duplicate in scored if duplicate)
+    print(f"样本数: {len(scored)}，重复样本: {positives}")
+    print(f"{'阈值':>6} {'准确率':>8} {'召回率':>8} {'F1':>8}")
+    for threshold in THRESHOLDS:
+        predicted = [(similarity >= threshold, duplicate) for similarity, duplicate in scored]
+        true_positive = sum(1 for hit, duplicate in predicted if hit and duplicate)
+        hits = sum(1 for hit, _ in predicted if hit)
+        precision = true_positive / hits if hits else 1.0
+        recall = true_positive / positives if positives else 0.0
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        print(f"{threshold:>6.2f} {precision:>8.3f} {recall:>8.3f} {f1:>8.3f}")
+
+def simulate_queries(path: str, samples: int):
+    """按时间顺序回放问题日志，统计各阈值下的缓存命中率（使用LSH索引，与线上一致）"""
+    with open(path, 'r', encoding='utf-8') as f:
+        queries = [line.strip() for line in f if line.strip()]
+
+    config.faq_cache.enabled = True
+    cache = FAQCache()
+    # 记录每个问题的最佳候选相似度，之后按阈值统计
+    best_matches = []
+    for query in queries:
+        _, scored = cache.similarity_candidates(query)
+        if scored:
+            best_matches.append((scored[0][0], query, scored[0][1].query))
+        cache.remember(query, query, True)
+
+    print(f"问题数: {len(queries)}，有LSH候选: {len(best_matches)}")
+    print(f"{'阈值':>6} {'命中率':>8}")
+    for threshold in THRESHOLDS:
+        hits = sum(1 for similarity, _, _ in best_matches if similarity >= threshold)
+        print(f"{threshold:>6.2f} {hits / len(queries) if queries else 0:>8.3f}")
+
+    print(f"\n当前阈值 {config.faq_cache.threshold} 下的命中样例：")
+    examples = [match for match in best_matches if match[0] >= config.faq_cache.threshold]
+    for similarity, query, matched in examples[:samples]:
+        print(f"  {similarity:.2f}  {query}  <=>  {matched}")
+
+def main():
+    parser = argparse.ArgumentParser(description="评估近似重复问题缓存的相似度阈值")
+    parser.add_argument("pairs", nargs="?", help="标注样本JSONL文件")
+    parser.add_argument("--queries", help="未标注问题日志，每行一个问题")
+    parser.add_argument("--samples", type=int, default=20, help="打印的命中样例数")
+    args = parser.parse_args()
+
+    if not args.pairs and not args.queries:
+        parser.error("请指定标注样本文件或 --queries")
+    if args.pairs:
+        evaluate_pairs(args.pairs)
+    if args.queries:
+        simulate_queries(args.queries, args.samples)
+
+if __name__ == "__main__":
+    main()
@@ -17,31 +17,51 @@ sys.path.insert(0, str(project_root))
 
 from src.config import config
 from src.app import create_app
+from src.structured_log import patch_record, sample_filter, json_format
+
+# 当前进程是否已配置日志（多worker时每个子进程通过 create_worker_app 各自配置）
+_logging_configured = False
 
 def setup_logging():
-    """设置日志"""
+    """设置日志（text/json格式、后台写入、分阶段采样）"""
     log_level = config.logging.level
     log_file = config.logging.file
+    json_mode = config.logging.format == "json"
     
     # 创建日志目录
     log_dir = Path(log_file).parent
     log_dir.mkdir(exist_ok=True)
     
+    global _logging_configured
+    _logging_configured = True
+    
     # 配置日志格式
     logger.remove()
+    logger.configure(patcher=patch_record)
     logger.add(
         sys.stderr,
         level=log_level,
-        format="<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level: <8}</level> | <cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>"
+        format=json_format if json_mode else "<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level: <8}</level> | <cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>",
+        filter=sample_filter,
+        enqueue=config.logging.enqueue
     )
     logger.add(
         log_file,
         level=log_level,
-        format="{time:YYYY-MM-DD HH:mm:ss} | {level: <8} | {name}:{function}:{line} - {message}",
+        format=json_format if json_mode else "{time:YYYY-MM-DD HH:mm:ss} | {level: <8} | {name}:{function}:{line} - {message}",
+        filter=sample_filter,
+        enqueue=config.logging.enqueue,
         rotation="10 MB",
         retention="30 days"
     )
 
+def create_worker_app():
+    """uvicorn应用工厂：worker子进程中先配置日志再创建应用"""
+    # 单进程时uvicorn在同一进程中以 main 模块名重新导入本文件，日志已由 __main__ 配置
+    if not getattr(sys.modules.get("__main__"), "_logging_configured", False):
+        setup_logging()
+    return create_app()
+
 def main():
     """主函数"""
     try:
@@ -54,16 +74,27 @@ def main():
             logger.error("❌ 请先配置Dify API密钥")
             return
             
-        # 创建FastAPI应用
-        app = create_app()
+        server = config.server
+        if server.workers > 1 and server.state_store != "memory":
+            # 父进程不处理请求，只做一次性检查、不保留连接，各worker进程启动后自行连接
+            from src.session_manager import session_manager
+            if not session_manager.check_connection():
+                logger.warning("⚠️ 多worker模式下Redis不可用，消息去重和会话无法在进程间共享")
         
-        # 启动服务
-        logger.info(f"📡 服务启动在 http://{config.server.host}:{config.server.port}")
+        # 启动服务（应用由工厂在每个worker进程中创建）
+        logger.info(f"📡 服务启动在 http://{server.host}:{server.port}，worker进程数: {server.workers}")
         uvicorn.run(
-            app,
-            host=config.server.host,
-            port=config.server.port,
-            log_level=config.logging.level.lower()
+            "main:create_worker_app",
+            factory=True,
+            host=server.host,
+            port=server.port,
+            workers=server.workers,
+            loop=server.loop,
+            http=server.http,
+            backlog=server.backlog,
+            log_level=config.logging.level.lower(),
+            # 收到SIGTERM后停止接收新连接，留出时间让lifespan排空异步任务
+            timeout_graceful_shutdown=int(server.shutdown_grace_period) + 5
         )
         
     except KeyboardInterrupt:
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+运维诊断接口
+
+需要 security.admin_token 认证（请求头 Authorization: Bearer <token> 或 X-Admin-Token），
+未配置令牌时接口不可用。
+
+- 采样分析：在限定时长内定期读取各线程调用栈（sys._current_frames），输出collapsed
+  格式（每行 "帧;帧;... 次数"），可直接交给 flamegraph.pl 或 speedscope 生成火焰图
+- 内存快照：按需开启 tracemalloc，每次快照与上一次对比，给出分配最多和增长最多的代码位置
+- 结构大小：各处理器单例中常驻内存的字典、集合的条目数和近似字节数
+"""
+
+import hmac
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Any, Dict, Optional
+
+from fastapi import HTTPException, Request
+
+from .config import config
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAX_PROFILE_SECONDS = 60.0
+MIN_PROFILE_INTERVAL = 0.001
+
+def require_admin(request: Request):
+    """FastAPI依赖：校验管理令牌"""
+    token = config.security.admin_token
+    if not token:
+        raise HTTPException(status_code=404, detail="管理接口未启用")
+    provided = request.headers.get("x-admin-token", "")
+    authorization = request.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        provided = authorization[7:].strip()
+    if not hmac.compare_digest(provided.encode(), token.encode()):
+        raise HTTPException(status_code=401, detail="管理令牌无效")
+
+def _short_path(filename: str) -> str:
+    """项目内文件用相对路径，第三方库只保留包内路径"""
+    if filename.startswith(PROJECT_ROOT + os.sep):
+        return os.path.relpath(filename, PROJECT_ROOT)
+    marker = f"{os.sep}site-packages{os.sep}"
+    if marker in filename:
+        return filename.split(marker, 1)[1]
+    return os.path.basename(filename)
+
+class SamplingProfiler:
+    """基于 sys._current_frames 的采样分析器（同一时间只允许一次分析）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._labels: Dict[Any, str] = {}
+
+    @property
+    def busy(self) -> bool:
+        return self._lock.locked()
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    def run(self, seconds: float, interval: float, thread_id: Optional[int] = None) -> Dict[str, Any]:
+        """阻塞采样 seconds 秒（在线程中调用），thread_id 为None时采样所有线程"""
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("已有采样分析在进行中")
+        try:
+            seconds = min(seconds, MAX_PROFILE_SECONDS)
+            interval = max(interval, MIN_PROFILE_INTERVAL)
+            own_thread = threading.get_ident()
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks: Counter = Counter()
+            samples = 0
+            deadline = time.perf_counter() + seconds
+            while time.perf_counter() < deadline:
+                for ident, frame in sys._current_frames().items():
+                    if ident == own_thread or (thread_id is not None and ident != thread_id):
+                        continue
+                    frames = []
+                    while frame is not None:
+                        frames.append(self._label(frame.f_code))
+                        frame = frame.f_back
+                    frames.append(thread_names.get(ident, f"thread-{ident}"))
+                    stacks[";".join(reversed(frames))] += 1
+                samples += 1
+                time.sleep(interval)
+            return {"samples": samples, "stacks": stacks}
+        finally:
+            self._labels.clear()
+            self._lock.release()
+
+    @staticmethod
+    def collapsed(stacks: Counter) -> str:
+        """collapsed格式输出"""
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+def _approx_size(obj: Any, depth: int = 3, seen: Optional[set] = None) -> int:
+    """容器及其内容的近似字节数（限制递归深度）"""
+    seen = seen if seen is not None else set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if depth <= 0:
+        return size
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += _approx_size(key, depth - 1, seen) + _approx_size(value, depth - 1, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += _approx_size(item, depth - 1, seen)
+    return size
+
+def structure_sizes() -> Dict[str, Dict[str, int]]:
+    """各处理器单例中常驻内存结构的大小（需在事件循环线程中调用，避免遍历时被修改）"""
+    from .faq_cache import faq_cache
+    from .scheduler import dify_scheduler
+    from .session_manager import session_manager
+    from .state_store import state_store
+    from .tracing import trace_exporter
+    from .wechat_official import wechat_official_handler
+    from .work_wechat import work_wechat_handler
+
+    structures = {
+        "wechat_official.async_tasks": wechat_official_handler.async_tasks,
+        "wechat_official.async_messages": wechat_official_handler.async_messages,
+        "wechat_official.typing_users": wechat_official_handler.typing._last_sent,
+        "state_store.memory": state_store.memory._data,
+        "session_manager.memory_store": session_manager.memory_store,
+        "faq_cache.entries": faq_cache._entries,
+        "scheduler.user_finish_tags": dify_scheduler._last_finish,
+        "tracing.traces": trace_exporter.traces,
+    }
+    return {
+        name: {"items": len(structure), "approx_bytes": _approx_size(structure)}
+        for name, structure in structures.items()
+    }
+
+class MemoryInspector:
+    """tracemalloc快照与对比"""
+
+    def __init__(self):
+        self._baseline: Optional[tracemalloc.Snapshot] = None
+
+    @staticmethod
+    def _site(stat) -> str:
+        frame = stat.traceback[0]
+        return f"{_short_path(frame.filename)}:{frame.lineno}"
+
+    def snapshot(self, top: int = 20, frames: int = 1) -> Dict[str, Any]:
+        """拍摄快照（首次调用时开启tracemalloc），与上一次快照对比"""
+        started = False
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            started = True
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        result: Dict[str, Any] = {
+            "tracing_started": started,
+            "traced_bytes": current,
+            "traced_peak_bytes": peak,
+            "top": [
+                {"site": self._site(stat), "bytes": stat.size, "count": stat.count}
+                for stat in snapshot.statistics("lineno")[:top]
+            ],
+        }
+        if self._baseline is not None:
+            result["growth"] = [
+                {"site": self._site(stat), "bytes_diff": stat.size_diff, "count_diff": stat.count_diff, "bytes": stat.size}
+                for stat in snapshot.compare_to(self._baseline, "lineno")[:top]
+            ]
+        self._baseline = snapshot
+        return result
+
+    def stop(self):
+        """关闭tracemalloc（开启期间内存分配有额外开销）"""
+        self._baseline = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+# 全局诊断工具实例
+sampling_profiler = SamplingProfiler()
+memory_inspector = MemoryInspector()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+准入控制（负载削峰）
+
+根据调度器中进行中的Dify调用数、排队深度和各优先级最近的槽位占用时长估算新请求的
+排队等待时间；如果等待时间已经超过被动回复窗口，就没必要再占着连接等4.5秒，
+直接回复繁忙提示并转入异步回复流程。
+"""
+
+from typing import Dict, Any
+from loguru import logger
+
+from .config import config
+from .scheduler import dify_scheduler, Priority
+from .metrics import registry
+
+admission_decisions_total = registry.counter(
+    "dify2wechat_admission_decisions_total", "准入控制决策次数", ("result",))
+
+class AdmissionController:
+    """基于预估等待时间的准入控制器"""
+
+    def __init__(self):
+        self.admitted = 0
+        self.shed = 0
+        self.last_estimate = 0.0
+
+    def estimate_wait(self, priority: Priority = Priority.INTERACTIVE) -> float:
+        """估算新请求获得Dify槽位前的等待时间（秒）"""
+        max_concurrency = dify_scheduler.max_concurrency
+        queued = dify_scheduler.queue_depth_for(priority)
+        if dify_scheduler.active < max_concurrency and queued == 0:
+            return 0.0
+        # 槽位按进行中调用的占用时长释放（后台长回复占着槽位时释放得慢），
+        # 排在前面的请求加上自己，需要依次等待槽位释放
+        service_time = dify_scheduler.mean_active_service_time()
+        return (queued + 1) * service_time / max_concurrency
+
+    def admit(self, budget: float) -> bool:
+        """判断请求能否在被动回复预算内开始处理，并记录决策"""
+        if not config.admission.enabled:
+            return True
+        estimate = self.estimate_wait()
+        self.last_estimate = estimate
+        if estimate * config.admission.safety_factor > budget:
+            self.shed += 1
+            admission_decisions_total.inc("shed")
+            logger.warning(f"🚦 负载削峰：预估等待{estimate:.2f}秒，超过被动回复预算{budget:.2f}秒")
+            return False
+        self.admitted += 1
+        admission_decisions_total.inc("admitted")
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        """获取准入控制统计"""
+        return {
+            "enabled": config.admission.enabled,
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "last_estimate": round(self.last_estimate, 4),
+        }
+
+# 全局准入控制器实例
+admission_controller = AdmissionController()
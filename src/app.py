@@ -4,11 +4,15 @@
 FastAPI应用程序
 """
 
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request, HTTPException, Depends
 from fastapi.responses import PlainTextResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from contextlib import asynccontextmanager
 from loguru import logger
 import asyncio
+import os
+import threading
+import time
 from typing import Dict, Any
 
 from .config import config
@@ -16,6 +20,35 @@ from .wechat_official import wechat_official_handler
 from .work_wechat import work_wechat_handler
 from .session_manager import session_manager
 from .menu_manager import menu_manager
+from .deadline import start_deadline
+from .metrics import registry, webhook_seconds, dify_requests_total, reply_send_errors_total
+from .live_stats import live_stats
+from .tracing import tracer, trace_exporter
+from .loop_watchdog import loop_watchdog
+from .state_store import state_store
+from .config_reload import config_reloader
+from .admin import require_admin, sampling_profiler, memory_inspector, structure_sizes
+from . import lifecycle
+
+# Webhook路径对应的渠道（用于计时和指标标签）
+WEBHOOK_CHANNELS = {"/wechat/official": "official", "/wechat/work": "work"}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：预热完成后才开始接收请求，关闭时排空异步任务"""
+    app.state.ready = False
+    # 预热中的同步调用（如获取access_token）同样会阻塞事件循环，先启动监测
+    loop_watchdog.start()
+    app.state.warmup = await lifecycle.warm_up()
+    config_reloader.start()
+    app.state.ready = True
+    try:
+        yield
+    finally:
+        app.state.ready = False
+        await config_reloader.stop()
+        await lifecycle.shutdown()
+        await loop_watchdog.stop()
 
 def create_app() -> FastAPI:
     """创建FastAPI应用"""
@@ -24,7 +57,8 @@ def create_app() -> FastAPI:
         description="将Dify AI助手接入微信生态的服务",
         version="1.0.0",
         docs_url="/docs" if config.server.debug else None,
-        redoc_url="/redoc" if config.server.debug else None
+        redoc_url="/redoc" if config.server.debug else None,
+        lifespan=lifespan
     )
     
     # 添加CORS中间件
@@ -36,6 +70,28 @@ def create_app() -> FastAPI:
         allow_headers=["*"],
     )
     
+    @app.middleware("http")
+    async def webhook_deadline_and_timing(request: Request, call_next):
+        """Webhook请求到达时开始计时：公众号消息从此刻开始计算5秒被动回复预算
+
+        所有请求在入口固定当前配置快照，处理过程中（包括派生的后台任务）热加载不会改变它看到的配置
+        """
+        with config.pinned():
+            channel = WEBHOOK_CHANNELS.get(request.url.path)
+            if channel is None or request.method != "POST":
+                return await call_next(request)
+            
+            start_time = time.perf_counter()
+            live_stats.record_message(channel)
+            if channel == "official":
+                request.state.deadline = start_deadline()
+            try:
+                # 每条消息一条链路，解析出MsgId后由处理器关联
+                with tracer.trace(f"webhook.{channel}", channel=channel):
+                    return await call_next(request)
+            finally:
+                webhook_seconds.observe(time.perf_counter() - start_time, channel)
+    
     @app.get("/natapp-test")
     async def natapp_test():
         """natapp连通性测试端点"""
@@ -79,6 +135,28 @@ def create_app() -> FastAPI:
             "timestamp": asyncio.get_event_loop().time()
         }
     
+    @app.get("/metrics")
+    async def metrics():
+        """Prometheus指标"""
+        from .job_queue import job_queue
+        if job_queue.enabled:
+            # 指标采集函数是同步的，任务流长度在这里异步读取后缓存
+            try:
+                await job_queue.refresh_length()
+            except Exception as e:
+                logger.warning(f"读取任务队列长度失败: {e}")
+        return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+    
+    @app.get("/ready")
+    async def readiness_check(request: Request):
+        """就绪检查：预热完成前和关闭过程中返回503"""
+        ready = getattr(request.app.state, "ready", False)
+        content = {
+            "status": "ready" if ready else "not_ready",
+            "warmup": getattr(request.app.state, "warmup", {})
+        }
+        return JSONResponse(content=content, status_code=200 if ready else 503)
+    
     @app.api_route("/wechat/official", methods=["GET", "POST"])
     async def wechat_official_webhook(request: Request):
         """微信公众号Webhook"""
@@ -106,6 +184,32 @@ def create_app() -> FastAPI:
             logger.error(f"企业微信Webhook处理失败: {e}")
             raise HTTPException(status_code=500, detail="内部服务器错误")
     
+    @app.post("/api/work/broadcast")
+    async def work_wechat_broadcast(data: Dict[str, Any]):
+        """企业微信批量发送同一条消息给多个成员/部门/标签"""
+        content = data.get("content")
+        if not content or not isinstance(content, str):
+            raise HTTPException(status_code=400, detail="消息内容不能为空")
+        for field in ("users", "parties", "tags"):
+            value = data.get(field)
+            # 字符串会被逐字符拆成接收人，必须是字符串列表
+            if value is not None and not (isinstance(value, list) and all(isinstance(item, str) for item in value)):
+                raise HTTPException(status_code=400, detail=f"{field} 必须是字符串列表")
+        if not (data.get("users") or data.get("parties") or data.get("tags")):
+            raise HTTPException(status_code=400, detail="接收人不能为空")
+        
+        try:
+            report = await work_wechat_handler.send_batch(
+                content,
+                users=data.get("users"),
+                parties=data.get("parties"),
+                tags=data.get("tags")
+            )
+            return {"message": "批量发送完成", **report}
+        except Exception as e:
+            logger.error(f"企业微信批量发送失败: {e}")
+            raise HTTPException(status_code=500, detail=f"批量发送失败: {str(e)}")
+    
     @app.post("/api/clear_session")
     async def clear_user_session(data: Dict[str, str]):
         """清除用户会话"""
@@ -122,13 +226,34 @@ def create_app() -> FastAPI:
     
     @app.get("/api/stats")
     async def get_stats():
-        """获取统计信息"""
+        """获取统计信息（实时速率、延迟百分位、被动回复命中率等）"""
         try:
+            from .scheduler import dify_scheduler
+            
+            # 按类型汇总的错误数（进程启动以来）
+            errors: Dict[str, float] = {}
+            for (app_name, result), count in dify_requests_total.items():
+                if result != "success":
+                    errors[f"dify_{result}"] = errors.get(f"dify_{result}", 0) + count
+            for (channel, errcode), count in reply_send_errors_total.items():
+                errors[f"{channel}_send_{errcode}"] = count
+            
             return {
                 "message": "统计信息",
                 "wechat_official_enabled": config.wechat_official.enabled,
                 "work_wechat_enabled": config.work_wechat.enabled,
-                "group_trigger": config.message.group_trigger
+                "group_trigger": config.message.group_trigger,
+                **live_stats.snapshot(),
+                "active": {
+                    "official_async_tasks": sum(1 for task in wechat_official_handler.async_tasks.values() if not task.done()),
+                    "work_pool_queue": work_wechat_handler.pool.stats()["queue_size"],
+                    "dify_calls": dify_scheduler.active,
+                    "dify_queue_depth": dify_scheduler.queue_depth,
+                },
+                # 多worker时上述统计只反映处理本次请求的进程
+                "worker_pid": os.getpid(),
+                "state_store": state_store.stats(),
+                "errors": errors
             }
         except Exception as e:
             logger.error(f"获取统计信息失败: {e}")
@@ -218,13 +343,116 @@ def create_app() -> FastAPI:
             return {
                 "message": "获取异步任务状态成功",
                 "active_tasks_count": len(active_tasks),
-                "active_tasks": active_tasks
+                "active_tasks": active_tasks,
+                "work_wechat_pool": work_wechat_handler.pool.stats()
             }
                 
         except Exception as e:
             logger.error(f"获取异步任务状态失败: {e}")
             raise HTTPException(status_code=500, detail=f"获取状态失败: {str(e)}")
     
+    @app.post("/api/keywords/reload")
+    async def reload_keyword_rules():
+        """重新加载关键词规则"""
+        from .keyword_router import keyword_router
+        
+        count = keyword_router.reload()
+        return {"message": "关键词规则已重新加载", "rules": count, "hits": keyword_router.hits}
+    
+    @app.get("/api/scheduler/stats")
+    async def get_scheduler_stats():
+        """获取Dify调度器状态（并发、队列深度、排队等待时间）"""
+        from .scheduler import dify_scheduler
+        from .admission import admission_controller
+        
+        return {
+            "message": "获取调度器状态成功",
+            **dify_scheduler.stats(),
+            "admission": admission_controller.stats()
+        }
+    
+    @app.get("/api/routing/stats")
+    async def get_routing_stats():
+        """获取Dify应用路由统计（各应用决策次数和耗时）"""
+        from .dify_router import dify_router
+        from .latency_predictor import latency_predictor
+        
+        return {
+            "message": "获取路由统计成功",
+            **dify_router.stats(),
+            "prediction": latency_predictor.stats()
+        }
+    
+    @app.get("/api/traces/{msg_id}")
+    async def get_message_trace(msg_id: str):
+        """按消息ID查询处理链路（OTLP JSON格式，可直接发送到OTLP collector）"""
+        record = trace_exporter.lookup(msg_id)
+        if record is None:
+            raise HTTPException(status_code=404, detail="未找到该消息的链路（可能已被新消息覆盖或未启用追踪）")
+        return trace_exporter.to_otlp(record)
+    
+    @app.get("/api/debug/stalls")
+    async def get_loop_stalls():
+        """事件循环阻塞记录（阻塞位置、时长和当时的调用栈）"""
+        return {"message": "获取事件循环阻塞记录成功", **loop_watchdog.stats()}
+    
+    @app.get("/api/admin/profile", dependencies=[Depends(require_admin)])
+    async def admin_profile(seconds: float = 10.0, interval: float = 0.005, all_threads: bool = False):
+        """对运行中的进程采样分析，输出collapsed格式调用栈（默认只采样事件循环线程）"""
+        if sampling_profiler.busy:
+            raise HTTPException(status_code=409, detail="已有采样分析在进行中")
+        thread_id = None if all_threads else threading.get_ident()
+        try:
+            result = await asyncio.to_thread(sampling_profiler.run, seconds, interval, thread_id)
+        except RuntimeError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        return PlainTextResponse(
+            sampling_profiler.collapsed(result["stacks"]),
+            headers={"X-Profile-Samples": str(result["samples"])}
+        )
+    
+    @app.post("/api/admin/memory/snapshot", dependencies=[Depends(require_admin)])
+    async def admin_memory_snapshot(top: int = 20, frames: int = 1):
+        """拍摄tracemalloc快照并与上一次对比（首次调用时开启tracemalloc）"""
+        result = await asyncio.to_thread(memory_inspector.snapshot, top, frames)
+        return {"message": "内存快照完成", **result, "structures": structure_sizes()}
+    
+    @app.delete("/api/admin/memory/snapshot", dependencies=[Depends(require_admin)])
+    async def admin_memory_stop():
+        """关闭tracemalloc并清除对比基线"""
+        memory_inspector.stop()
+        return {"message": "已关闭tracemalloc"}
+    
+    @app.get("/api/admin/structures", dependencies=[Depends(require_admin)])
+    async def admin_structures():
+        """各处理器常驻内存结构的条目数和近似大小"""
+        return {"message": "获取内存结构大小成功", "structures": structure_sizes()}
+    
+    @app.post("/api/admin/config/reload", dependencies=[Depends(require_admin)])
+    async def admin_reload_config():
+        """重新加载配置文件（只作用于处理本次请求的worker进程）"""
+        try:
+            result = await config_reloader.reload("admin")
+        except Exception as e:
+            logger.error(f"配置重新加载失败（admin），继续使用当前配置: {e}")
+            raise HTTPException(status_code=400, detail=f"配置无效，继续使用当前配置: {e}")
+        return {"message": "配置已重新加载", **result}
+    
+    @app.get("/api/queue/stats")
+    async def get_queue_stats():
+        """获取任务队列状态"""
+        from .job_queue import job_queue
+        
+        if not job_queue.enabled:
+            return {"message": "任务队列未启用", "enabled": False}
+        
+        try:
+            stats = await job_queue.stats()
+            return {"message": "获取任务队列状态成功", "enabled": True, **stats}
+        except Exception as e:
+            logger.error(f"获取任务队列状态失败: {e}")
+            raise HTTPException(status_code=500, detail=f"获取状态失败: {str(e)}")
+    
     @app.post("/api/async/force_complete")
     async def force_complete_async_task(data: Dict[str, str]):
         """强制完成指定用户的异步任务"""
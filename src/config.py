@@ -6,23 +6,38 @@
 
 import os
 import yaml
+from contextlib import contextmanager
+from contextvars import ContextVar
 from pathlib import Path
-from typing import Optional, List
+from typing import Optional, List, Dict
 from pydantic import BaseModel, Field
 from loguru import logger
 
+class DifyAppConfig(BaseModel):
+    """额外的Dify应用配置"""
+    api_base: str = Field(default="")  # 为空时使用 dify.api_base
+    api_key: str = Field(default="")
+
 class DifyConfig(BaseModel):
     """Dify配置"""
     api_base: str = Field(default="https://api.dify.ai/v1")
     api_key: str = Field(default="")
     conversation_id: str = Field(default="")
     verify_ssl: bool = Field(default=True)  # SSL证书校验开关
+    apps: Dict[str, DifyAppConfig] = Field(default_factory=dict)  # 命名应用，"default" 指上面的主应用
 
 class ServerConfig(BaseModel):
     """服务器配置"""
     host: str = Field(default="0.0.0.0")
     port: int = Field(default=8000)
     debug: bool = Field(default=False)
+    warmup_timeout: float = Field(default=10.0)  # 启动预热每一项的超时时间（秒）
+    shutdown_grace_period: float = Field(default=30.0)  # 关闭时等待异步任务完成的时间（秒）
+    workers: int = Field(default=1)  # uvicorn worker进程数，大于1时跨请求状态需要Redis共享
+    loop: str = Field(default="auto")  # 事件循环实现：auto / asyncio / uvloop
+    http: str = Field(default="auto")  # HTTP协议实现：auto / h11 / httptools
+    backlog: int = Field(default=2048)  # 监听socket的连接等待队列长度
+    state_store: str = Field(default="auto")  # 跨请求状态存储：auto（有Redis时用Redis）/ memory / redis
 
 class WeChatOfficialConfig(BaseModel):
     """微信公众号配置"""
@@ -31,6 +46,9 @@ class WeChatOfficialConfig(BaseModel):
     app_secret: str = Field(default="")
     token: str = Field(default="")
     encoding_aeskey: str = Field(default="")
+    typing_indicator: bool = Field(default=True)  # 后台生成回复时显示“对方正在输入”
+    typing_refresh_interval: float = Field(default=10.0)  # 输入状态刷新间隔（秒），微信端约持续15秒
+    typing_rate_limit: float = Field(default=20.0)  # 输入状态命令的全局速率上限（次/秒）
 
 class WorkWeChatConfig(BaseModel):
     """企业微信配置"""
@@ -38,6 +56,16 @@ class WorkWeChatConfig(BaseModel):
     corp_id: str = Field(default="")
     corp_secret: str = Field(default="")
     agent_id: str = Field(default="")
+    workers: int = Field(default=8)  # 后台处理消息的worker数
+    queue_size: int = Field(default=1000)  # 后台待处理消息上限
+    reply_deadline: float = Field(default=120.0)  # 单条消息生成回复的最长时间（秒）
+    api_base: str = Field(default="https://qyapi.weixin.qq.com")  # 可指向本地mock进行测试
+    token_refresh_ahead: int = Field(default=300)  # 访问令牌在过期前多少秒后台刷新
+    batch_concurrency: int = Field(default=4)  # 批量发送时并发的请求数
+    stream_reply: bool = Field(default=False)  # 边生成边分段推送回复
+    stream_flush_interval: float = Field(default=1.5)  # 分段推送的最小间隔（秒）
+    stream_min_chars: int = Field(default=30)  # 中间片段的最少字符数
+    stream_max_messages: int = Field(default=8)  # 单条回复最多拆分的消息数
 
 class RedisConfig(BaseModel):
     """Redis配置"""
@@ -50,6 +78,10 @@ class LoggingConfig(BaseModel):
     """日志配置"""
     level: str = Field(default="INFO")
     file: str = Field(default="logs/app.log")
+    format: str = Field(default="text")  # text: 可读文本；json: 每行一条JSON记录
+    enqueue: bool = Field(default=True)  # 由后台线程写日志，不阻塞事件循环
+    sampling: Dict[str, float] = Field(default_factory=dict)  # 各阶段（模块名）INFO及以下日志的采样率
+    message_summary: bool = Field(default=True)  # 每条消息输出一条汇总记录
 
 class MessageConfig(BaseModel):
     """消息处理配置"""
@@ -57,11 +89,112 @@ class MessageConfig(BaseModel):
     timeout: int = Field(default=3)  # 改为3秒，确保在微信5秒限制内
     enable_group: bool = Field(default=True)
     group_trigger: str = Field(default="@bot")
+    passive_reply_timeout: float = Field(default=4.5)  # 公众号被动回复等待时间，微信要求5秒内响应
+    adaptive_budget: bool = Field(default=True)  # 按请求到达时间计算被动回复剩余预算
+    passive_window: float = Field(default=5.0)  # 微信被动回复的响应时限（秒）
+    network_margin: float = Field(default=0.3)  # 为微信侧网络传输预留的时间（秒）
+    finalize_reserve_min: float = Field(default=0.02)  # 为序列化和加密预留的最少时间（秒）
 
 class SecurityConfig(BaseModel):
     """安全配置"""
-    rate_limit: int = Field(default=10)
-    whitelist: List[str] = Field(default_factory=list)
+    rate_limit: int = Field(default=10)  # 每个用户每个窗口内的最大消息数，0表示不限制
+    ip_rate_limit: int = Field(default=0)  # 每个来源IP每个窗口内的最大请求数，0表示不限制
+    rate_limit_window: int = Field(default=60)  # 限流窗口（秒）
+    rate_limit_reply: str = Field(default="🙏 您发送消息太频繁了，请稍后再试。")
+    trust_proxy_headers: bool = Field(default=False)  # 部署在反向代理后时从X-Forwarded-For取来源IP
+    whitelist: List[str] = Field(default_factory=list)  # 不受限流的IP或用户ID
+    admin_token: str = Field(default="")  # 运维诊断接口（/api/admin/*）的访问令牌，为空时不开放
+
+class QueueConfig(BaseModel):
+    """任务队列配置（Redis Streams）"""
+    enabled: bool = Field(default=False)
+    stream: str = Field(default="dify2wechat:jobs")
+    group: str = Field(default="dify-workers")
+    dead_letter_stream: str = Field(default="dify2wechat:jobs:dead")
+    max_len: int = Field(default=10000)  # 流的近似最大长度
+    block_ms: int = Field(default=2000)  # 需小于Redis socket_timeout
+    claim_idle_ms: int = Field(default=120000)  # 超过该时间未ack的任务会被其他worker接管
+    max_deliveries: int = Field(default=3)  # 超过投递次数进入死信流
+    concurrency: int = Field(default=4)  # 每个worker进程的并发任务数
+    processes: int = Field(default=1)  # worker.py 启动的进程数
+    passive_attempt: bool = Field(default=True)  # 公众号是否先尝试4.5秒内被动回复
+
+class SchedulerConfig(BaseModel):
+    """Dify请求调度配置"""
+    enabled: bool = Field(default=True)
+    max_concurrency: int = Field(default=8)  # 同时进行的Dify调用数
+    cost_unit_chars: int = Field(default=100)  # 每多少字符计为一个单位代价
+    user_weights: Dict[str, float] = Field(default_factory=dict)  # 用户权重，默认1.0
+
+class AdmissionConfig(BaseModel):
+    """准入控制配置（预估等待超过被动回复窗口时直接回复繁忙提示）"""
+    enabled: bool = Field(default=True)
+    safety_factor: float = Field(default=1.0)  # 预估等待时间的放大系数
+    busy_reply: str = Field(default="🙏 当前咨询人数较多，您的问题已在排队处理，稍后将为您送达回复。")
+
+class KeywordsConfig(BaseModel):
+    """关键词快速回复配置"""
+    enabled: bool = Field(default=True)
+    rules_file: str = Field(default="keywords.yaml")  # 不存在时使用内置默认规则
+    reload_interval: float = Field(default=5.0)  # 检查规则文件变更的间隔（秒）
+
+class RoutingConfig(BaseModel):
+    """Dify应用路由配置（简单问题走快速应用，复杂问题走深度应用）"""
+    enabled: bool = Field(default=False)
+    fast_app: str = Field(default="fast")
+    deep_app: str = Field(default="default")
+    fast_max_chars: int = Field(default=30)  # 超过该长度的问题视为复杂问题
+    deep_keywords: List[str] = Field(default_factory=lambda: ["分析", "详细", "为什么", "对比", "比较", "方案", "代码", "总结", "写一"])
+    deep_depth: int = Field(default=6)  # 深度应用会话达到该轮数后继续留在深度应用
+    latency_alpha: float = Field(default=0.2)  # 首字节耗时EWMA平滑系数
+
+class PredictionConfig(BaseModel):
+    """被动回复超时预测配置"""
+    enabled: bool = Field(default=True)
+    min_probability: float = Field(default=0.2)  # 预测完成概率低于该值时提前转异步回复
+    min_samples: int = Field(default=50)  # 样本数不足时不做预测
+    learning_rate: float = Field(default=0.05)
+    l2: float = Field(default=0.001)
+
+class ConversationConfig(BaseModel):
+    """Dify会话轮换配置（会话历史越长首字节越慢，超过限制时开启新会话）"""
+    rotation_enabled: bool = Field(default=True)
+    max_turns: int = Field(default=20)  # 单个会话的最大轮数
+    max_age: int = Field(default=86400)  # 会话最长存活时间（秒）
+    max_tokens: int = Field(default=30000)  # 会话累计token上限
+    carry_summary: bool = Field(default=False)  # 新会话首轮带上最近几轮对话摘要
+    summary_turns: int = Field(default=2)  # 摘要包含的最近轮数
+    summary_chars: int = Field(default=100)  # 摘要中每条消息保留的字符数
+
+class FaqCacheConfig(BaseModel):
+    """近似重复问题缓存配置"""
+    enabled: bool = Field(default=False)
+    threshold: float = Field(default=0.6)  # 字符n-gram Jaccard相似度阈值，用 evaluate_faq_cache.py 调优
+    shingle_size: int = Field(default=2)  # 字符n-gram长度
+    num_perm: int = Field(default=64)  # MinHash签名长度
+    bands: int = Field(default=16)  # LSH分桶数（每桶 num_perm/bands 行）
+    min_chars: int = Field(default=4)  # 过短的问题不参与缓存
+    max_entries: int = Field(default=5000)
+    ttl: int = Field(default=3600)  # 缓存回答的有效期（秒）
+
+class TracingConfig(BaseModel):
+    """消息链路追踪配置"""
+    enabled: bool = Field(default=True)
+    buffer_size: int = Field(default=1000)  # 内存中保留的最近消息链路数
+    max_spans: int = Field(default=64)  # 单条链路最多记录的span数
+
+class WatchdogConfig(BaseModel):
+    """事件循环阻塞监测配置"""
+    enabled: bool = Field(default=True)
+    interval: float = Field(default=0.1)  # 心跳间隔（秒）
+    stall_threshold: float = Field(default=0.2)  # 心跳延迟超过该值视为阻塞并抓取调用栈（秒）
+    max_records: int = Field(default=50)  # 保留最近的阻塞记录数
+    stack_depth: int = Field(default=30)  # 调用栈最多记录的帧数
+
+class ReloadConfig(BaseModel):
+    """配置热加载"""
+    watch: bool = Field(default=True)  # 监测配置文件修改后自动重新加载
+    interval: float = Field(default=2.0)  # 检查配置文件修改时间的间隔（秒）
 
 class Config(BaseModel):
     """主配置类"""
@@ -73,8 +206,32 @@ class Config(BaseModel):
     logging: LoggingConfig = Field(default_factory=LoggingConfig)
     message: MessageConfig = Field(default_factory=MessageConfig)
     security: SecurityConfig = Field(default_factory=SecurityConfig)
+    queue: QueueConfig = Field(default_factory=QueueConfig)
+    scheduler: SchedulerConfig = Field(default_factory=SchedulerConfig)
+    admission: AdmissionConfig = Field(default_factory=AdmissionConfig)
+    keywords: KeywordsConfig = Field(default_factory=KeywordsConfig)
+    routing: RoutingConfig = Field(default_factory=RoutingConfig)
+    prediction: PredictionConfig = Field(default_factory=PredictionConfig)
+    conversation: ConversationConfig = Field(default_factory=ConversationConfig)
+    faq_cache: FaqCacheConfig = Field(default_factory=FaqCacheConfig)
+    tracing: TracingConfig = Field(default_factory=TracingConfig)
+    watchdog: WatchdogConfig = Field(default_factory=WatchdogConfig)
+    reload: ReloadConfig = Field(default_factory=ReloadConfig)
+
+CONFIG_PATH = "config.yaml"
+
+def read_config(config_path: str = CONFIG_PATH) -> Config:
+    """读取并校验配置文件，文件格式或字段有误时抛出异常"""
+    with open(config_path, 'r', encoding='utf-8') as f:
+        config_data = yaml.safe_load(f) or {}
+    
+    # 支持环境变量覆盖
+    if 'DIFY_API_KEY' in os.environ:
+        config_data.setdefault('dify', {})['api_key'] = os.environ['DIFY_API_KEY']
+    
+    return Config(**config_data)
 
-def load_config(config_path: str = "config.yaml") -> Config:
+def load_config(config_path: str = CONFIG_PATH) -> Config:
     """加载配置文件"""
     config_file = Path(config_path)
     
@@ -83,17 +240,56 @@ def load_config(config_path: str = "config.yaml") -> Config:
         return Config()
     
     try:
-        with open(config_file, 'r', encoding='utf-8') as f:
-            config_data = yaml.safe_load(f)
-        
-        # 支持环境变量覆盖
-        if 'DIFY_API_KEY' in os.environ:
-            config_data.setdefault('dify', {})['api_key'] = os.environ['DIFY_API_KEY']
-        
-        return Config(**config_data)
+        return read_config(config_path)
     except Exception as e:
         logger.error(f"加载配置文件失败: {e}")
         return Config()
 
+# 当前请求固定使用的配置快照
+_pinned_config: ContextVar[Optional[Config]] = ContextVar("pinned_config", default=None)
+
+class ConfigHolder:
+    """
+    全局配置入口
+    
+    热加载时整体换入一个新的 Config 快照（旧快照不再修改）。请求入口通过 pinned() 固定
+    当时的快照，请求及其派生的后台任务读取 config.<段>.<字段> 时始终得到同一个快照，
+    不会一半旧值一半新值；没有固定快照的代码读取最新配置。
+    """
+    
+    def __init__(self, initial: Config):
+        object.__setattr__(self, "_latest", initial)
+    
+    @property
+    def latest(self) -> Config:
+        return self._latest
+    
+    def snapshot(self) -> Config:
+        """当前上下文使用的配置快照"""
+        pinned = _pinned_config.get()
+        return pinned if pinned is not None else self._latest
+    
+    def swap(self, new_config: Config):
+        """换入新的配置快照（单次赋值，已固定旧快照的请求不受影响）"""
+        object.__setattr__(self, "_latest", new_config)
+    
+    @contextmanager
+    def pinned(self):
+        """在当前上下文中固定最新的配置快照"""
+        token = _pinned_config.set(self._latest)
+        try:
+            yield self._latest
+        finally:
+            _pinned_config.reset(token)
+    
+    def __getattr__(self, name):
+        return getattr(self.snapshot(), name)
+    
+    def __setattr__(self, name, value):
+        # 替换配置段（测试和脚本）时同样换入新快照，不修改任何已有快照
+        if name not in Config.model_fields:
+            raise AttributeError(f"未知的配置段: {name}")
+        self.swap(self._latest.model_copy(update={name: value}))
+
 # 全局配置实例
-config = load_config() 
\ No newline at end of file
+config = ConfigHolder(load_config()) 
\ No newline at end of file
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+配置热加载
+
+三种触发方式：监测 config.yaml 的修改时间（reload.watch）、SIGHUP信号、
+POST /api/admin/config/reload。重新加载时：
+
+1. 在线程中读取配置文件，用 Config 校验，校验失败保留当前配置
+2. 以校验后的配置生成新快照（需要重启的配置段沿用当前值），通过 config.swap() 整体换入。
+   请求入口已固定旧快照（config.pinned()），进行中的请求和它派生的后台任务继续使用旧快照完成
+3. 只重建依赖变化配置段的共享状态（关键词规则、FAQ缓存签名、限流计数）。Dify连接池、
+   公众号加密处理器、企业微信令牌按快照中的配置取用，不需要原地修改
+
+server、redis、queue、logging、tracing、watchdog 在启动时完成初始化（连接、消费者组、
+日志输出、监测线程等），热加载不替换这些配置段，只在结果中提示需要重启。
+多worker部署时管理接口只重新加载处理该请求的进程，文件监测和SIGHUP对每个进程生效。
+"""
+
+import asyncio
+import os
+import signal
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from .config import config, read_config, Config, CONFIG_PATH
+from .metrics import registry
+
+# 只在启动时读取的配置段
+RESTART_SECTIONS = ("server", "redis", "queue", "logging", "tracing", "watchdog")
+
+config_reloads_total = registry.counter(
+    "dify2wechat_config_reloads_total", "配置重新加载次数", ("source", "result"))
+
+def _rebuild_hooks() -> Dict[str, List[Callable[[], Any]]]:
+    """各配置段变化时需要重建的共享状态"""
+    from .faq_cache import faq_cache
+    from .keyword_router import keyword_router
+    from .rate_limiter import rate_limiter
+
+    return {
+        "keywords": [keyword_router.reload],
+        "faq_cache": [faq_cache.apply_config],
+        "security": [rate_limiter.apply_config],
+    }
+
+class ConfigReloader:
+    """配置文件监测与热加载"""
+
+    def __init__(self, config_path: str = CONFIG_PATH):
+        self.config_path = config_path
+        self.last_result: Dict[str, Any] = {}
+        self._mtime: Optional[float] = None
+        self._lock = asyncio.Lock()
+        self._watch_task: Optional[asyncio.Task] = None
+        self._signal_task: Optional[asyncio.Task] = None
+        self._signal_installed = False
+
+    def _file_mtime(self) -> Optional[float]:
+        try:
+            return os.path.getmtime(self.config_path)
+        except OSError:
+            return None
+
+    async def reload(self, source: str = "admin") -> Dict[str, Any]:
+        """重新加载配置，返回变化的配置段；配置无效时抛出异常并保留当前配置"""
+        async with self._lock:
+            self._mtime = self._file_mtime()
+            try:
+                new_config = await asyncio.to_thread(read_config, self.config_path)
+            except Exception:
+                config_reloads_total.inc(source, "invalid")
+                raise
+            changed, restart_required = self.apply(new_config)
+            config_reloads_total.inc(source, "changed" if changed else "unchanged")
+            self.last_result = {
+                "source": source,
+                "changed": changed,
+                "restart_required": restart_required,
+            }
+            if changed:
+                logger.info(f"🔁 配置已重新加载（{source}），变化: {', '.join(changed)}")
+            if self.last_result["restart_required"]:
+                logger.warning(f"⚠️ 以下配置段需要重启后生效: {', '.join(self.last_result['restart_required'])}")
+            return self.last_result
+
+    def apply(self, new_config: Config) -> Tuple[List[str], List[str]]:
+        """换入新快照并重建依赖变化配置段的共享状态，返回 (已生效的配置段, 需要重启的配置段)"""
+        current = config.latest
+        differs = [name for name in Config.model_fields if getattr(current, name) != getattr(new_config, name)]
+        changed = [name for name in differs if name not in RESTART_SECTIONS]
+        restart_required = [name for name in differs if name in RESTART_SECTIONS]
+        if not changed:
+            return changed, restart_required
+
+        snapshot = new_config.model_copy(update={name: getattr(current, name) for name in RESTART_SECTIONS})
+        config.swap(snapshot)
+
+        hooks = _rebuild_hooks()
+        callbacks: List[Callable[[], Any]] = []
+        for name in changed:
+            for callback in hooks.get(name, []):
+                if callback not in callbacks:
+                    callbacks.append(callback)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"重建服务失败 {getattr(callback, '__qualname__', callback)}: {e}")
+        return changed, restart_required
+
+    async def _reload_quietly(self, source: str):
+        """文件监测和SIGHUP触发的重新加载：失败时记录日志，保留当前配置"""
+        try:
+            await self.reload(source)
+        except Exception as e:
+            logger.error(f"配置重新加载失败（{source}），继续使用当前配置: {e}")
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(config.reload.interval)
+            mtime = self._file_mtime()
+            if mtime is not None and mtime != self._mtime:
+                await self._reload_quietly("watch")
+
+    def _on_sighup(self):
+        self._signal_task = asyncio.create_task(self._reload_quietly("sighup"))
+
+    def start(self):
+        """在事件循环中启动文件监测并注册SIGHUP"""
+        self._mtime = self._file_mtime()
+        if config.reload.watch and self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch())
+        if hasattr(signal, "SIGHUP") and not self._signal_installed:
+            try:
+                asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self._on_sighup)
+                self._signal_installed = True
+            except (NotImplementedError, RuntimeError, ValueError):
+                # 非主线程或不支持信号的平台，只能通过文件监测和管理接口重新加载
+                pass
+
+    async def stop(self):
+        if self._signal_installed:
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+            self._signal_installed = False
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            await asyncio.gather(self._watch_task, return_exceptions=True)
+            self._watch_task = None
+
+# 全局配置热加载实例
+config_reloader = ConfigReloader()
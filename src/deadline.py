@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+被动回复截止时间
+
+微信要求5秒内响应，这5秒从微信发出请求开始计算，而不是从handle_message开始。
+请求到达时（中间件中）创建Deadline，读取请求体、解密、Redis查询等各阶段都从
+同一个预算中扣除；等待Dify时只使用剩余预算，并为最后的XML序列化和加密预留时间。
+
+预留时间按最近观测到的序列化+加密耗时p99自适应调整，尽量用满5秒窗口。
+"""
+
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Optional
+from loguru import logger
+
+from .config import config
+
+class FinalizeTimer:
+    """记录回复序列化和加密的耗时，提供p99"""
+
+    def __init__(self, size: int = 500):
+        self.samples = deque(maxlen=size)
+        self._p99 = 0.0
+        self._dirty = 0
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+        self._dirty += 1
+
+    def p99(self) -> float:
+        # 每积累一批新样本才重新排序，避免每个请求都排序
+        if self._dirty >= 20 or (self._dirty and len(self.samples) < 20):
+            ordered = sorted(self.samples)
+            self._p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+            self._dirty = 0
+        return self._p99
+
+    def reserve(self) -> float:
+        """为序列化和加密预留的时间（秒）"""
+        return max(config.message.finalize_reserve_min, self.p99())
+
+class Deadline:
+    """一次被动回复请求的截止时间"""
+
+    def __init__(self, budget: float, started_at: Optional[float] = None):
+        self.budget = budget
+        self.started_at = started_at if started_at is not None else time.monotonic()
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    def remaining(self) -> float:
+        """距离截止时间的剩余秒数"""
+        return self.budget - self.elapsed()
+
+    def handler_budget(self) -> float:
+        """留出序列化和加密时间后，可用于生成回复的剩余秒数"""
+        return self.remaining() - finalize_timer.reserve()
+
+    def check(self, stage: str) -> float:
+        """阶段检查点：返回可用于生成回复的剩余预算"""
+        remaining = self.handler_budget()
+        logger.debug(f"⏱️ {stage} 完成，已用{self.elapsed():.3f}秒，剩余预算{remaining:.3f}秒")
+        return remaining
+
+# 全局序列化/加密耗时统计
+finalize_timer = FinalizeTimer()
+
+_current_deadline: ContextVar[Optional[Deadline]] = ContextVar("passive_reply_deadline", default=None)
+
+def start_deadline() -> Deadline:
+    """请求到达时创建截止时间：微信5秒窗口减去网络传输余量"""
+    deadline = Deadline(config.message.passive_window - config.message.network_margin)
+    _current_deadline.set(deadline)
+    return deadline
+
+def current_deadline() -> Optional[Deadline]:
+    """当前请求的截止时间（不在被动回复请求中时为None）"""
+    return _current_deadline.get()
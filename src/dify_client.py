@@ -6,29 +6,95 @@ Dify API客户端
 
 import httpx
 import asyncio
+import json
 import time
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Callable, Tuple
 from loguru import logger
 
 from .config import config
+from .scheduler import dify_scheduler, Priority
+from .metrics import (
+    dify_connect_seconds, dify_first_chunk_seconds, dify_total_seconds,
+    dify_tokens_per_second, dify_requests_total
+)
+from .live_stats import live_stats
+from .tracing import tracer, traced, KIND_CLIENT
 
 class DifyClient:
     """Dify API客户端"""
     
     def __init__(self):
-        self.api_base = config.dify.api_base
-        self.api_key = config.dify.api_key
-        self.timeout = config.message.timeout
-        self.verify_ssl = config.dify.verify_ssl
-        # 用于存储部分回复的字典，key为user_id
-        self.partial_responses = {}
+        # 流式调用的部分回复保存在调用自身的局部变量中（被取消时由同一协程返回），
+        # 不跨请求共享，因此不需要放到 state_store，多worker进程间也不会互相访问
+        # 复用的HTTP连接池，避免每次请求重新建立TCP/TLS连接；按证书校验开关区分，
+        # 热加载切换开关后进行中的请求继续使用原连接池
+        self._http_clients: Dict[bool, httpx.AsyncClient] = {}
+    
+    # 地址、密钥、超时和证书校验每次从当前请求固定的配置快照读取，热加载后新请求自动使用新值
+    @property
+    def api_base(self) -> str:
+        return config.dify.api_base
+    
+    @property
+    def api_key(self) -> str:
+        return config.dify.api_key
+    
+    @property
+    def timeout(self) -> int:
+        return config.message.timeout
+    
+    @property
+    def verify_ssl(self) -> bool:
+        return config.dify.verify_ssl
+    
+    def get_http_client(self) -> httpx.AsyncClient:
+        """获取共享的HTTP客户端（懒加载）"""
+        verify_ssl = self.verify_ssl
+        client = self._http_clients.get(verify_ssl)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                verify=verify_ssl,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+            )
+            self._http_clients[verify_ssl] = client
+        return client
+    
+    async def close(self):
+        """关闭HTTP连接池"""
+        clients, self._http_clients = list(self._http_clients.values()), {}
+        for client in clients:
+            if not client.is_closed:
+                await client.aclose()
+    
+    def app_endpoint(self, app: str) -> Tuple[str, str]:
+        """返回命名应用的 (api_base, api_key)，未配置的应用使用主应用"""
+        app_config = config.dify.apps.get(app)
+        if app_config is None:
+            return self.api_base, self.api_key
+        return app_config.api_base or self.api_base, app_config.api_key or self.api_key
+    
+    async def warm_up(self) -> bool:
+        """预热：建立到Dify的连接并校验API密钥"""
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        response = await self.get_http_client().get(
+            f"{self.api_base}/parameters",
+            headers=headers,
+            timeout=5.0
+        )
+        if response.status_code != 200:
+            logger.warning(f"Dify预热返回状态码: {response.status_code}")
+            return False
+        return True
         
+    @traced("dify.chat_completion", KIND_CLIENT)
     async def chat_completion(
         self, 
         message: str, 
         user_id: str,
         conversation_id: Optional[str] = None,
-        files: Optional[list] = None
+        files: Optional[list] = None,
+        priority: Priority = Priority.INTERACTIVE,
+        app: str = "default"
     ) -> Dict[str, Any]:
         """
         发送消息到Dify并获取回复
@@ -38,13 +104,16 @@ class DifyClient:
             user_id: 用户ID
             conversation_id: 会话ID（可选）
             files: 文件列表（可选）
+            priority: 调度优先级
+            app: Dify应用名（见 dify.apps）
             
         Returns:
             包含回复内容的字典
         """
         try:
+            api_base, api_key = self.app_endpoint(app)
             headers = {
-                "Authorization": f"Bearer {self.api_key}",
+                "Authorization": f"Bearer {api_key}",
                 "Content-Type": "application/json"
             }
             
@@ -63,31 +132,40 @@ class DifyClient:
             
             # 使用更短的超时时间和优化的连接设置
             timeout = httpx.Timeout(connect=1.0, read=self.timeout, write=1.0, pool=1.0)
-            async with httpx.AsyncClient(timeout=timeout, verify=self.verify_ssl) as client:
-                response = await client.post(
-                    f"{self.api_base}/chat-messages",
-                    headers=headers,
-                    json=payload
-                )
+            client = self.get_http_client()
+            tracer.set_attribute("dify.app", app)
+            async with dify_scheduler.slot(user_id, priority, message):
+                tracer.add_event("scheduler_slot_acquired")
+                with dify_total_seconds.time(app, "blocking"):
+                    response = await client.post(
+                        f"{api_base}/chat-messages",
+                        headers=headers,
+                        json=payload,
+                        timeout=timeout
+                    )
+            
+            if response.status_code == 200:
+                dify_requests_total.inc(app, "success")
+                result = response.json()
+                logger.debug(f"Dify API调用成功，用户: {user_id}")
+                return {
+                    "success": True,
+                    "answer": result.get("answer", ""),
+                    "conversation_id": result.get("conversation_id", ""),
+                    "message_id": result.get("id", ""),
+                    "usage": result.get("metadata", {}).get("usage", {})
+                }
+            else:
+                dify_requests_total.inc(app, "http_error")
+                logger.error(f"Dify API调用失败: {response.status_code}, {response.text}")
+                return {
+                    "success": False,
+                    "error": f"API调用失败: {response.status_code}",
+                    "answer": "抱歉，我暂时无法回复，请稍后再试。"
+                }
                 
-                if response.status_code == 200:
-                    result = response.json()
-                    logger.info(f"Dify API调用成功，用户: {user_id}")
-                    return {
-                        "success": True,
-                        "answer": result.get("answer", ""),
-                        "conversation_id": result.get("conversation_id", ""),
-                        "message_id": result.get("id", "")
-                    }
-                else:
-                    logger.error(f"Dify API调用失败: {response.status_code}, {response.text}")
-                    return {
-                        "success": False,
-                        "error": f"API调用失败: {response.status_code}",
-                        "answer": "抱歉，我暂时无法回复，请稍后再试。"
-                    }
-                    
         except httpx.TimeoutException:
+            dify_requests_total.inc(app, "timeout")
             logger.error(f"Dify API调用超时，用户: {user_id}")
             # 超时时返回友好提示，而不是错误
             return {
@@ -96,6 +174,7 @@ class DifyClient:
                 "answer": "我正在思考中... 🤔"
             }
         except Exception as e:
+            dify_requests_total.inc(app, "error")
             logger.error(f"Dify API调用异常: {e}")
             return {
                 "success": False,
@@ -131,27 +210,28 @@ class DifyClient:
                 "limit": limit
             }
             
-            async with httpx.AsyncClient(timeout=self.timeout, verify=self.verify_ssl) as client:
-                response = await client.get(
-                    f"{self.api_base}/messages",
-                    headers=headers,
-                    params=params
-                )
+            client = self.get_http_client()
+            response = await client.get(
+                f"{self.api_base}/messages",
+                headers=headers,
+                params=params,
+                timeout=self.timeout
+            )
+            
+            if response.status_code == 200:
+                result = response.json()
+                return {
+                    "success": True,
+                    "messages": result.get("data", [])
+                }
+            else:
+                logger.error(f"获取消息历史失败: {response.status_code}")
+                return {
+                    "success": False,
+                    "error": f"获取失败: {response.status_code}",
+                    "messages": []
+                }
                 
-                if response.status_code == 200:
-                    result = response.json()
-                    return {
-                        "success": True,
-                        "messages": result.get("data", [])
-                    }
-                else:
-                    logger.error(f"获取消息历史失败: {response.status_code}")
-                    return {
-                        "success": False,
-                        "error": f"获取失败: {response.status_code}",
-                        "messages": []
-                    }
-                    
         except Exception as e:
             logger.error(f"获取消息历史异常: {e}")
             return {
@@ -160,19 +240,27 @@ class DifyClient:
                 "messages": []
             }
 
+    @traced("dify.chat_completion_streaming", KIND_CLIENT)
     async def chat_completion_streaming(
         self, 
         message: str, 
         user_id: str,
         conversation_id: Optional[str] = None,
-        files: Optional[list] = None
+        files: Optional[list] = None,
+        priority: Priority = Priority.INTERACTIVE,
+        on_chunk: Optional[Callable[[str], None]] = None,
+        app: str = "default"
     ) -> Dict[str, Any]:
         """
         使用流式模式发送消息到Dify并获取回复（更快的首字节时间）
+        
+        on_chunk: 每收到一个数据块时以当前累计的回复内容调用（同步回调，需保持轻量）
+        app: Dify应用名（见 dify.apps）
         """
         try:
+            api_base, api_key = self.app_endpoint(app)
             headers = {
-                "Authorization": f"Bearer {self.api_key}",
+                "Authorization": f"Bearer {api_key}",
                 "Content-Type": "application/json"
             }
             
@@ -193,85 +281,105 @@ class DifyClient:
             # 微信层面会在4.5秒时截断并返回"我在思考中"，这里设置更长的超时让Dify完整响应
             timeout = httpx.Timeout(connect=5.0, read=60.0, write=5.0, pool=5.0)  # 读取超时60秒，给Dify充分时间
             
-            async with httpx.AsyncClient(timeout=timeout, verify=self.verify_ssl) as client:
+            client = self.get_http_client()
+            tracer.set_attribute("dify.app", app)
+            async with dify_scheduler.slot(user_id, priority, message):
+                tracer.add_event("scheduler_slot_acquired")
+                request_start = time.perf_counter()
                 async with client.stream(
                     "POST",
-                    f"{self.api_base}/chat-messages",
+                    f"{api_base}/chat-messages",
                     headers=headers,
-                    json=payload
+                    json=payload,
+                    timeout=timeout
                 ) as response:
-                    
+                
+                    dify_connect_seconds.observe(time.perf_counter() - request_start, app)
+                    tracer.add_event("response_headers", status_code=response.status_code)
                     if response.status_code != 200:
+                        dify_requests_total.inc(app, "http_error")
                         logger.error(f"Dify API调用失败: {response.status_code}")
                         return {
                             "success": False,
                             "error": f"API调用失败: {response.status_code}",
                             "answer": "抱歉，我暂时无法回复，请稍后再试。"
                         }
-                    
+                
                     # 处理流式响应 - 支持部分内容获取
                     answer = ""
                     conversation_id_result = ""
                     message_id = ""
+                    usage = {}
                     start_time = time.time()
                     first_chunk_received = False
-                    
-                    # 清除之前的部分回复
-                    self.partial_responses[user_id] = {
-                        "answer": "",
-                        "first_chunk_time": None,
-                        "conversation_id": "",
-                        "message_id": ""
-                    }
-                    
+                    first_chunk_time = None
+                
                     try:
                         async for line in response.aiter_lines():
                             if line.startswith("data: "):
                                 try:
-                                    import json
                                     data = json.loads(line[6:])  # 移除 "data: " 前缀
-                                    
+                                
                                     if data.get("event") == "message":
                                         answer += data.get("answer", "")
-                                        # 实时更新部分回复
-                                        self.partial_responses[user_id]["answer"] = answer
-                                        self.partial_responses[user_id]["conversation_id"] = data.get("conversation_id", "")
-                                        self.partial_responses[user_id]["message_id"] = data.get("id", "")
-                                        
+                                        # 实时记录部分回复，被取消时返回
+                                        conversation_id_result = data.get("conversation_id", "")
+                                        message_id = data.get("id", "")
+                                        if on_chunk is not None:
+                                            on_chunk(answer)
+                                    
                                         if not first_chunk_received:
                                             first_chunk_received = True
                                             first_chunk_time = time.time() - start_time
-                                            self.partial_responses[user_id]["first_chunk_time"] = first_chunk_time
-                                            logger.info(f"收到首个数据块，耗时{first_chunk_time:.2f}秒")
-                                        
+                                            first_chunk_at = time.perf_counter()
+                                            dify_first_chunk_seconds.observe(first_chunk_at - request_start, app)
+                                            live_stats.dify_first_chunk.record(first_chunk_at - request_start)
+                                            tracer.add_event("first_chunk")
+                                            logger.debug(f"收到首个数据块，耗时{first_chunk_time:.2f}秒")
+                                    
                                     elif data.get("event") == "message_end":
                                         conversation_id_result = data.get("conversation_id", "")
                                         message_id = data.get("id", "")
+                                        usage = data.get("metadata", {}).get("usage", {})
                                         break
                                 except json.JSONDecodeError:
                                     continue
                     except asyncio.CancelledError:
                         # 被取消时，返回部分内容
+                        dify_requests_total.inc(app, "partial")
+                        tracer.set_attribute("dify.partial", True)
                         logger.info(f"流式处理被取消，返回部分内容，用户: {user_id}")
-                        partial = self.partial_responses.get(user_id, {})
                         return {
                             "success": True,
-                            "answer": partial.get("answer", ""),
-                            "conversation_id": partial.get("conversation_id", ""),
-                            "message_id": partial.get("message_id", ""),
+                            "answer": answer,
+                            "conversation_id": conversation_id_result,
+                            "message_id": message_id,
+                            "first_chunk_time": first_chunk_time,
                             "partial": True
                         }
-                    
+                
                     # 正常完成，返回结果
-                    logger.info(f"Dify API流式调用成功，用户: {user_id}")
+                    finished_at = time.perf_counter()
+                    dify_total_seconds.observe(finished_at - request_start, app, "streaming")
+                    live_stats.dify_total.record(finished_at - request_start)
+                    dify_requests_total.inc(app, "success")
+                    if first_chunk_received and finished_at > first_chunk_at:
+                        tokens = usage.get("completion_tokens") or len(answer)
+                        dify_tokens_per_second.observe(tokens / (finished_at - first_chunk_at), app)
+                    tracer.set_attribute("dify.message_id", message_id)
+                    tracer.set_attribute("dify.answer_chars", len(answer))
+                    logger.debug(f"Dify API流式调用成功，用户: {user_id}")
                     return {
                         "success": True,
                         "answer": answer,
                         "conversation_id": conversation_id_result,
-                        "message_id": message_id
+                        "message_id": message_id,
+                        "usage": usage,
+                        "first_chunk_time": first_chunk_time
                     }
-                    
+                
         except httpx.TimeoutException:
+            dify_requests_total.inc(app, "timeout")
             logger.error(f"Dify API流式调用超时，用户: {user_id}")
             return {
                 "success": False,
@@ -279,53 +387,13 @@ class DifyClient:
                 "answer": "我正在思考中... 🤔"
             }
         except Exception as e:
+            dify_requests_total.inc(app, "error")
             logger.error(f"Dify API流式调用异常: {e}")
             return {
                 "success": False,
                 "error": str(e),
                 "answer": "系统异常，请稍后再试。"
             }
-    
-    def get_partial_response(self, user_id: str) -> Dict[str, Any]:
-        """获取用户的部分回复"""
-        partial = self.partial_responses.get(user_id, {})
-        first_chunk_time = partial.get("first_chunk_time")
-        answer = partial.get("answer", "")
-        
-        if first_chunk_time is None:
-            # 没有收到首字节，返回俏皮回复
-            return {
-                "success": False,
-                "error": "首字节超时",
-                "answer": "哎呀，我的大脑有点卡顿了 🤔 可能是在思考太深奥的问题！要不换个简单点的问题试试？😊",
-                "partial": False
-            }
-        elif first_chunk_time <= 4.5:
-            # 首字节在4.5秒内，返回部分内容
-            if answer:
-                return {
-                    "success": True,
-                    "answer": answer,
-                    "conversation_id": partial.get("conversation_id", ""),
-                    "message_id": partial.get("message_id", ""),
-                    "partial": True
-                }
-            else:
-                return {
-                    "success": True,
-                    "answer": "我正在思考中... 🤔",
-                    "conversation_id": partial.get("conversation_id", ""),
-                    "message_id": partial.get("message_id", ""),
-                    "partial": True
-                }
-        else:
-            # 首字节超过4.5秒，返回俏皮回复
-            return {
-                "success": False,
-                "error": "首字节超时",
-                "answer": "我的思考速度有点跟不上你的节奏呢 🐌 让我缓缓，或者你可以问个更直接的问题？✨",
-                "partial": False
-            }
 
 # 全局Dify客户端实例
 dify_client = DifyClient() 
\ No newline at end of file
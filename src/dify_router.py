@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dify应用路由
+
+在DifyClient之前按预估代价为每条消息选择Dify应用：寒暄、简短查询走快速应用，
+长问题、包含分析类关键词或已经进行多轮的会话走深度应用。深度应用最近的首字节
+耗时超过被动回复窗口时，对需要被动回复的消息提高走深度应用的门槛。
+
+每次路由决策和对应应用的耗时结果都会记录日志，用于调整阈值。路由时读取的会话数据
+随决策一起传给 start_turn，每条消息每个应用的会话只读取一次。
+"""
+
+import asyncio
+import time
+from typing import Dict, Any, Callable, List, NamedTuple, Optional, Tuple
+from loguru import logger
+
+from .config import config
+from .dify_client import dify_client
+from .scheduler import Priority
+from .session_manager import session_manager
+from .latency_predictor import latency_predictor
+from .tracing import tracer
+
+class _AppLatency:
+    """单个应用的耗时统计"""
+
+    def __init__(self):
+        self.first_chunk_ewma: Optional[float] = None
+        self.total_ewma: Optional[float] = None
+        self.requests = 0
+        self.partial = 0
+        self.failed = 0
+
+    @staticmethod
+    def _ewma(current: Optional[float], value: float) -> float:
+        alpha = config.routing.latency_alpha
+        return value if current is None else alpha * value + (1 - alpha) * current
+
+    def observe(self, first_chunk_time: Optional[float], elapsed: float, success: bool, partial: bool):
+        self.requests += 1
+        if not success:
+            self.failed += 1
+        elif partial:
+            self.partial += 1
+        # 未收到首字节时以总耗时作为首字节耗时的下界
+        self.first_chunk_ewma = self._ewma(self.first_chunk_ewma, first_chunk_time if first_chunk_time is not None else elapsed)
+        self.total_ewma = self._ewma(self.total_ewma, elapsed)
+
+class Route(NamedTuple):
+    """一条消息的路由决策"""
+    app: str
+    reasons: List[str]
+    session: Dict[str, Any]  # 所选应用下的会话数据
+
+class DifyRouter:
+    """按预估代价选择Dify应用"""
+
+    def __init__(self):
+        self.latency: Dict[str, _AppLatency] = {}
+        self.decisions: Dict[str, int] = {}
+
+    def _latency(self, app: str) -> _AppLatency:
+        if app not in self.latency:
+            self.latency[app] = _AppLatency()
+        return self.latency[app]
+
+    async def route(self, message: str, user_id: str, latency_sensitive: bool = False) -> Route:
+        """选择应用并读取该应用下的会话数据"""
+        routing = config.routing
+        try:
+            deep_session = await session_manager.load_session(user_id, routing.deep_app)
+        except Exception as e:
+            logger.error(f"读取会话失败: {e}")
+            deep_session = {}
+        app, reasons = self.choose(message, deep_session.get('turns', 0), latency_sensitive)
+        if app == routing.deep_app:
+            return Route(app, reasons, deep_session)
+        try:
+            session = await session_manager.load_session(user_id, app)
+        except Exception as e:
+            logger.error(f"读取会话失败: {e}")
+            session = {}
+        return Route(app, reasons, session)
+
+    def choose(self, message: str, deep_turns: int = 0, latency_sensitive: bool = False) -> Tuple[str, List[str]]:
+        """返回 (应用名, 选择依据)，deep_turns 为深度应用会话已进行的轮数"""
+        routing = config.routing
+        if not routing.enabled or routing.fast_app not in config.dify.apps:
+            return routing.deep_app, []
+
+        reasons = []
+        if len(message) > routing.fast_max_chars:
+            reasons.append("长问题")
+        if any(keyword in message for keyword in routing.deep_keywords):
+            reasons.append("关键词")
+        if deep_turns >= routing.deep_depth:
+            reasons.append("会话深度")
+
+        required = 1
+        deep_first_chunk = self._latency(routing.deep_app).first_chunk_ewma
+        if latency_sensitive and deep_first_chunk is not None and deep_first_chunk > config.message.passive_reply_timeout:
+            # 深度应用最近首字节已超过被动回复窗口，只有多个特征同时命中才走深度应用
+            required = 2
+
+        app = routing.deep_app if len(reasons) >= required else routing.fast_app
+        if required > 1:
+            reasons.append(f"深度应用首字节{deep_first_chunk:.2f}秒")
+        return app, reasons
+
+    def predict_timeout(self, message: str, user_id: str, route: Route) -> bool:
+        """预测消息在被动回复窗口内无法完成"""
+        return latency_predictor.predict_timeout(message, user_id, route.app)
+
+    def observe(self, app: str, result: Dict[str, Any], elapsed: float):
+        """记录应用耗时结果"""
+        first_chunk_time = result.get("first_chunk_time")
+        success = bool(result.get("success"))
+        partial = bool(result.get("partial"))
+        self._latency(app).observe(first_chunk_time, elapsed, success, partial)
+        outcome = "失败" if not success else "部分回复" if partial else "完成"
+        first_chunk = f"{first_chunk_time:.2f}秒" if first_chunk_time is not None else "无"
+        logger.info(f"🧭 应用 {app} {outcome}，首字节: {first_chunk}，总耗时: {elapsed:.2f}秒")
+
+    async def chat(
+        self,
+        message: str,
+        user_id: str,
+        priority: Priority = Priority.INTERACTIVE,
+        latency_sensitive: bool = False,
+        on_chunk: Optional[Callable[[str], None]] = None,
+        route: Optional[Route] = None
+    ) -> Dict[str, Any]:
+        """选择应用并调用Dify（流式模式），同时维护该应用下的会话
+
+        route 为调用方已做出的路由决策（例如预测超时时已读取会话），不传时在这里路由。
+        返回结果额外包含 app（所选应用）和 context_free（是否为无上下文的新会话首轮）。
+        """
+        if route is None:
+            route = await self.route(message, user_id, latency_sensitive)
+        app, reasons = route.app, route.reasons
+        self.decisions[app] = self.decisions.get(app, 0) + 1
+        if config.routing.enabled:
+            logger.info(f"🧭 路由到应用 {app}，依据: {','.join(reasons) or '简单问题'}，用户: {user_id}")
+
+        # 获取会话ID（超过轮换限制时开启新会话）
+        with tracer.span("session.start_turn"):
+            conversation_id, query = await session_manager.start_turn(user_id, message, app, route.session)
+
+        start_time = time.time()
+        try:
+            result = await dify_client.chat_completion_streaming(
+                message=query,
+                user_id=user_id,
+                conversation_id=conversation_id,
+                priority=priority,
+                on_chunk=on_chunk,
+                app=app
+            )
+        except asyncio.CancelledError:
+            # 被动回复超时被取消（例如仍在排队），同样作为超时样本
+            latency_predictor.observe(message, user_id, app, finished=False)
+            raise
+        elapsed = time.time() - start_time
+        self.observe(app, result, elapsed)
+        latency_predictor.observe(
+            message, user_id, app,
+            finished=bool(result.get("success")) and not result.get("partial")
+            and elapsed <= config.message.passive_reply_timeout
+        )
+
+        # 保存会话ID并累计用量
+        with tracer.span("session.record_turn"):
+            await session_manager.record_turn(user_id, result, message, app)
+
+        result["app"] = app
+        result["context_free"] = conversation_id is None and query == message
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        """获取路由统计"""
+        return {
+            "enabled": config.routing.enabled,
+            "decisions": dict(self.decisions),
+            "apps": {
+                app: {
+                    "requests": latency.requests,
+                    "partial": latency.partial,
+                    "failed": latency.failed,
+                    "first_chunk_ewma": round(latency.first_chunk_ewma or 0.0, 4),
+                    "total_ewma": round(latency.total_ewma or 0.0, 4),
+                }
+                for app, latency in self.latency.items()
+            },
+        }
+
+# 全局Dify应用路由实例
+dify_router = DifyRouter()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+近似重复问题缓存（MinHash + LSH）
+
+对最近无上下文（新会话首轮）的Dify回答建立进程内索引：问题按字符n-gram切分，
+计算MinHash签名并按band分桶。新问题只与同桶候选比较，Jaccard相似度超过阈值时
+直接返回缓存的回答，不再调用Dify。索引条目数有上限并按TTL过期。
+"""
+
+import re
+import time
+import zlib
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Set, Tuple
+from loguru import logger
+
+from .config import config
+
+# MinHash使用的梅森素数和随机种子（固定种子保证签名在进程间一致，便于离线评估）
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_STRIP_PATTERN = re.compile(r"[\s\W_]+", re.UNICODE)
+
+def shingles(text: str, size: int) -> Set[str]:
+    """去掉空白和标点后切分为字符n-gram"""
+    text = _STRIP_PATTERN.sub("", text.lower())
+    if len(text) <= size:
+        return {text} if text else set()
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+def jaccard(a: Set[str], b: Set[str]) -> float:
+    """Jaccard相似度"""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+class MinHasher:
+    """MinHash签名生成器"""
+
+    def __init__(self, num_perm: int, seed: int = 20240601):
+        # 线性同余生成 (a, b) 参数，避免依赖random模块的全局状态
+        params = []
+        state = seed
+        for _ in range(num_perm):
+            state = (state * 6364136223846793005 + 1442695040888963407) % (1 << 64)
+            a = (state >> 3) % _MERSENNE_PRIME or 1
+            state = (state * 6364136223846793005 + 1442695040888963407) % (1 << 64)
+            b = (state >> 3) % _MERSENNE_PRIME
+            params.append((a, b))
+        self.params = params
+
+    def signature(self, shingle_set: Set[str]) -> Tuple[int, ...]:
+        hashes = [zlib.crc32(s.encode("utf-8")) for s in shingle_set]
+        if not hashes:
+            return tuple(_MAX_HASH for _ in self.params)
+        return tuple(
+            min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes)
+            for a, b in self.params
+        )
+
+class _Entry:
+    __slots__ = ("query", "answer", "shingles", "signature", "created_at")
+
+    def __init__(self, query: str, answer: str, shingle_set: Set[str], signature: Tuple[int, ...]):
+        self.query = query
+        self.answer = answer
+        self.shingles = shingle_set
+        self.signature = signature
+        self.created_at = time.time()
+
+class FAQCache:
+    """基于MinHash LSH的近似重复问题缓存"""
+
+    def __init__(self):
+        self._build()
+        self.hits = 0
+        self.misses = 0
+
+    def _build(self):
+        """按配置创建MinHash和LSH分桶（清空已缓存的问题）"""
+        cache_config = config.faq_cache
+        self.shingle_size = cache_config.shingle_size
+        self.bands = cache_config.bands
+        self.rows = max(1, cache_config.num_perm // cache_config.bands)
+        self.hasher = MinHasher(self.bands * self.rows)
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._buckets: List[Dict[Tuple[int, ...], Set[int]]] = [dict() for _ in range(self.bands)]
+        self._next_id = 0
+
+    def apply_config(self):
+        """配置热加载：签名参数变化时旧签名不再可比，重建缓存；阈值、有效期等直接生效"""
+        cache_config = config.faq_cache
+        rows = max(1, cache_config.num_perm // cache_config.bands)
+        if (cache_config.shingle_size, cache_config.bands, rows) != (self.shingle_size, self.bands, self.rows):
+            self._build()
+            logger.info("🔁 FAQ缓存签名参数已变化，缓存已重建")
+
+    def _band_keys(self, signature: Tuple[int, ...]) -> List[Tuple[int, ...]]:
+        return [signature[i * self.rows:(i + 1) * self.rows] for i in range(self.bands)]
+
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return
+        for band, key in enumerate(self._band_keys(entry.signature)):
+            bucket = self._buckets[band].get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[band][key]
+
+    def _evict(self):
+        """淘汰过期和超出容量的条目（按插入顺序，最旧的在前）"""
+        expire_before = time.time() - config.faq_cache.ttl
+        while self._entries:
+            entry_id, entry = next(iter(self._entries.items()))
+            if entry.created_at >= expire_before and len(self._entries) <= config.faq_cache.max_entries:
+                break
+            self._remove(entry_id)
+
+    def similarity_candidates(self, query: str) -> Tuple[Set[str], List[Tuple[float, _Entry]]]:
+        """返回问题的shingle集合和同桶候选（按相似度降序）"""
+        shingle_set = shingles(query, self.shingle_size)
+        signature = self.hasher.signature(shingle_set)
+        candidate_ids: Set[int] = set()
+        for band, key in enumerate(self._band_keys(signature)):
+            candidate_ids |= self._buckets[band].get(key, set())
+        scored = [
+            (jaccard(shingle_set, self._entries[entry_id].shingles), self._entries[entry_id])
+            for entry_id in candidate_ids if entry_id in self._entries
+        ]
+        scored.sort(key=lambda item: item[0], reverse=True)
+        return shingle_set, scored
+
+    def lookup(self, query: str) -> Optional[str]:
+        """查找近似问题的缓存回答"""
+        if not config.faq_cache.enabled or len(query) < config.faq_cache.min_chars:
+            return None
+        self._evict()
+        _, scored = self.similarity_candidates(query)
+        if scored and scored[0][0] >= config.faq_cache.threshold:
+            similarity, entry = scored[0]
+            self.hits += 1
+            logger.info(f"📚 命中近似问题缓存，相似度{similarity:.2f}: {entry.query[:30]}")
+            return entry.answer
+        self.misses += 1
+        return None
+
+    def remember(self, query: str, answer: str, context_free: bool):
+        """缓存无上下文的回答；有会话上下文的回答依赖历史，不可复用"""
+        if (not config.faq_cache.enabled or not context_free
+                or len(query) < config.faq_cache.min_chars or not answer):
+            return
+        shingle_set = shingles(query, self.shingle_size)
+        if not shingle_set:
+            return
+        signature = self.hasher.signature(shingle_set)
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = _Entry(query, answer, shingle_set, signature)
+        for band, key in enumerate(self._band_keys(signature)):
+            self._buckets[band].setdefault(key, set()).add(entry_id)
+        self._evict()
+
+    def stats(self) -> Dict[str, Any]:
+        """获取缓存统计"""
+        return {
+            "enabled": config.faq_cache.enabled,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+# 全局近似问题缓存实例
+faq_cache = FAQCache()
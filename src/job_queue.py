@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+基于Redis Streams的持久化任务队列
+
+Webhook进程只负责把消息写入Stream，独立的worker进程通过消费者组读取、
+处理并ack；worker崩溃后未ack的任务会被其他worker通过XAUTOCLAIM接管。
+
+入队时附带当前链路的traceparent，worker处理任务时在同一trace下继续记录span
+（记录在worker进程自己的链路缓冲区中）。
+"""
+
+import asyncio
+import json
+import os
+import socket
+import time
+from typing import Dict, Any, Optional, List, Tuple, Callable, Awaitable
+from loguru import logger
+from redis.exceptions import ResponseError
+
+from .config import config
+from .session_manager import session_manager
+from .metrics import registry
+from .tracing import tracer
+
+# 任务类型
+JOB_OFFICIAL_REPLY = "official_reply"  # 公众号：生成完整回复并通过客服消息发送
+JOB_WORK_MESSAGE = "work_message"      # 企业微信：处理消息并主动推送
+
+JobHandler = Callable[[Dict[str, Any]], Awaitable[None]]
+
+class JobFailed(Exception):
+    """任务处理失败：不ack，超时后被重新接管，超过投递次数转入死信流"""
+
+class JobQueue:
+    """Redis Streams任务队列"""
+
+    def __init__(self):
+        self.stream = config.queue.stream
+        self.group = config.queue.group
+        self.dead_letter_stream = config.queue.dead_letter_stream
+        self._group_ready = False
+        # 最近一次读取的流长度，供 /metrics 采集（采集函数是同步的，不能在其中访问Redis）
+        self.last_length: Optional[int] = None
+
+    @property
+    def enabled(self) -> bool:
+        return config.queue.enabled
+
+    async def ensure_group(self):
+        """创建消费者组（流不存在时一并创建）"""
+        if self._group_ready:
+            return
+        redis_client = session_manager.get_async_redis()
+        try:
+            await redis_client.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+            logger.info(f"创建消费者组: {self.stream}/{self.group}")
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._group_ready = True
+
+    async def enqueue(self, kind: str, payload: Dict[str, Any]) -> Optional[str]:
+        """写入任务，失败时返回None，由调用方降级为进程内处理"""
+        try:
+            redis_client = session_manager.get_async_redis()
+            fields = {
+                "kind": kind,
+                "payload": json.dumps(payload, ensure_ascii=False),
+                "enqueued_at": f"{time.time():.3f}"
+            }
+            traceparent = tracer.traceparent()
+            if traceparent:
+                fields["traceparent"] = traceparent
+            entry_id = await redis_client.xadd(
+                self.stream,
+                fields,
+                maxlen=config.queue.max_len,
+                approximate=True
+            )
+            logger.info(f"任务已入队: {kind} {entry_id}")
+            return entry_id
+        except Exception as e:
+            logger.error(f"任务入队失败: {e}")
+            return None
+
+    async def read(self, consumer: str, count: int) -> List[Tuple[str, Dict[str, str]]]:
+        """读取新任务"""
+        await self.ensure_group()
+        redis_client = session_manager.get_async_redis()
+        result = await redis_client.xreadgroup(
+            self.group, consumer, {self.stream: ">"},
+            count=count, block=config.queue.block_ms
+        )
+        if not result:
+            return []
+        return result[0][1]
+
+    async def reclaim(self, consumer: str, count: int) -> List[Tuple[str, Dict[str, str]]]:
+        """接管长时间未ack的任务（原worker可能已崩溃）"""
+        await self.ensure_group()
+        redis_client = session_manager.get_async_redis()
+        result = await redis_client.xautoclaim(
+            self.stream, self.group, consumer,
+            min_idle_time=config.queue.claim_idle_ms,
+            start_id="0-0", count=count
+        )
+        # redis-py返回 [next_id, entries, deleted_ids]
+        entries = result[1] if len(result) > 1 else []
+        return [(entry_id, fields) for entry_id, fields in entries if fields]
+
+    async def delivery_count(self, entry_id: str) -> int:
+        """获取任务的投递次数"""
+        redis_client = session_manager.get_async_redis()
+        pending = await redis_client.xpending_range(
+            self.stream, self.group, min=entry_id, max=entry_id, count=1
+        )
+        return pending[0]["times_delivered"] if pending else 0
+
+    async def ack(self, entry_id: str):
+        """确认任务完成并从流中删除"""
+        redis_client = session_manager.get_async_redis()
+        await redis_client.xack(self.stream, self.group, entry_id)
+        await redis_client.xdel(self.stream, entry_id)
+
+    async def dead_letter(self, entry_id: str, fields: Dict[str, str]):
+        """多次失败的任务转入死信流"""
+        redis_client = session_manager.get_async_redis()
+        await redis_client.xadd(
+            self.dead_letter_stream,
+            {**fields, "original_id": entry_id, "failed_at": f"{time.time():.3f}"},
+            maxlen=config.queue.max_len,
+            approximate=True
+        )
+        await self.ack(entry_id)
+        logger.error(f"任务多次失败，已转入死信流: {entry_id}")
+
+    async def refresh_length(self) -> int:
+        """读取流长度并缓存到 last_length"""
+        self.last_length = await session_manager.get_async_redis().xlen(self.stream)
+        return self.last_length
+
+    async def stats(self) -> Dict[str, Any]:
+        """获取队列统计"""
+        redis_client = session_manager.get_async_redis()
+        await self.ensure_group()
+        length = await self.refresh_length()
+        pending = await redis_client.xpending(self.stream, self.group)
+        return {
+            "stream": self.stream,
+            "length": length,
+            "pending": pending.get("pending", 0),
+            "consumers": pending.get("consumers", [])
+        }
+
+class JobWorker:
+    """任务消费者，一个进程内运行多个并发消费协程"""
+
+    def __init__(self, queue: JobQueue, handlers: Dict[str, JobHandler]):
+        self.queue = queue
+        self.handlers = handlers
+        self.consumer_prefix = f"{socket.gethostname()}-{os.getpid()}"
+        self._stopping = asyncio.Event()
+
+    def stop(self):
+        """通知所有消费协程在当前任务完成后退出"""
+        self._stopping.set()
+
+    async def process(self, entry_id: str, fields: Dict[str, str], reclaimed: bool = False):
+        """处理单个任务，成功后ack；失败不ack，等待超时后被重新接管"""
+        kind = fields.get("kind", "")
+        handler = self.handlers.get(kind)
+        if handler is None:
+            logger.error(f"未知任务类型: {kind}，直接丢弃 {entry_id}")
+            await self.queue.ack(entry_id)
+            return
+
+        if reclaimed and await self.queue.delivery_count(entry_id) > config.queue.max_deliveries:
+            await self.queue.dead_letter(entry_id, fields)
+            return
+
+        try:
+            payload = json.loads(fields.get("payload", "{}"))
+            enqueued_at = float(fields.get("enqueued_at", 0) or 0)
+            attributes = {"job.entry_id": entry_id}
+            if enqueued_at:
+                attributes["job.queued_seconds"] = round(time.time() - enqueued_at, 3)
+                logger.info(f"开始处理任务 {kind} {entry_id}，排队耗时{time.time() - enqueued_at:.2f}秒")
+            message = payload.get("message") or {}
+            # 每个任务固定一份配置快照，处理过程中热加载不影响它
+            with config.pinned(), tracer.trace(f"job.{kind}", traceparent=fields.get("traceparent"),
+                                               msg_id=message.get("MsgId"), **attributes):
+                await handler(payload)
+            await self.queue.ack(entry_id)
+        except Exception as e:
+            # 不ack：claim_idle_ms 后被XAUTOCLAIM接管重试，超过 max_deliveries 转入死信流
+            logger.error(f"任务处理失败 {kind} {entry_id}: {e}")
+
+    async def consume(self, index: int):
+        """单个消费协程：先接管超时任务，再读取新任务"""
+        consumer = f"{self.consumer_prefix}-{index}"
+        logger.info(f"消费者启动: {consumer}")
+        while not self._stopping.is_set():
+            try:
+                for entry_id, fields in await self.queue.reclaim(consumer, count=1):
+                    logger.warning(f"接管超时任务: {entry_id}")
+                    await self.process(entry_id, fields, reclaimed=True)
+
+                for entry_id, fields in await self.queue.read(consumer, count=1):
+                    await self.process(entry_id, fields)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"消费者 {consumer} 异常: {e}")
+                await asyncio.sleep(1)
+        logger.info(f"消费者退出: {consumer}")
+
+    async def run(self, concurrency: Optional[int] = None):
+        """运行消费协程直到stop()被调用"""
+        concurrency = concurrency or config.queue.concurrency
+        await self.queue.ensure_group()
+        await asyncio.gather(*(self.consume(i) for i in range(concurrency)))
+
+# 全局任务队列实例
+job_queue = JobQueue()
+
+def _collect_queue_length():
+    """采集任务流长度（/metrics 渲染前异步刷新的缓存值）"""
+    if not job_queue.enabled or job_queue.last_length is None:
+        return []
+    return [((job_queue.stream,), job_queue.last_length)]
+
+registry.gauge("dify2wechat_job_queue_length", "任务队列流长度", ("stream",), _collect_queue_length)
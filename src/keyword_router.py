@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+关键词快速路由
+
+在调用Dify之前对用户消息做关键词匹配，命中规则时直接返回静态回复或执行内置动作
+（清除历史、帮助等），不再经过Dify往返。
+
+规则文件格式（YAML）：
+    rules:
+      - keywords: ["帮助", "help"]     # 默认整句匹配
+        action: help
+      - keywords: ["退款"]
+        match: contains                # 消息中包含关键词即命中
+        reply: "退款请联系..."
+      - pattern: "^CODE\\d{4}$"        # 正则规则
+        reply: "活动码已收到！"
+
+整句匹配用字典查找，包含匹配用Aho-Corasick自动机一次扫描完成，
+规则在加载时编译一次；规则文件修改后按 reload_interval 自动重新加载。
+"""
+
+import os
+import re
+import time
+from collections import deque
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Tuple
+import yaml
+from loguru import logger
+
+from .config import config
+from .menu_manager import menu_manager
+
+# 内置动作对应的菜单事件（复用菜单点击的回复）
+ACTIONS = {
+    "start_chat": "START_CHAT",
+    "clear_history": "CLEAR_HISTORY",
+    "help": "HELP_INFO",
+    "contact_service": "CONTACT_SERVICE",
+    "about": "ABOUT_US",
+}
+
+# 未配置规则文件时使用的默认规则
+DEFAULT_RULES = [
+    {"keywords": ["帮助", "使用帮助", "help"], "action": "help"},
+    {"keywords": ["人工客服", "联系客服"], "action": "contact_service"},
+    {"keywords": ["清除历史", "清空记录", "清除记录"], "action": "clear_history"},
+    {"keywords": ["关于我们"], "action": "about"},
+]
+
+def normalize(text: str) -> str:
+    """匹配前的归一化：去空白、转小写"""
+    return text.strip().lower()
+
+class AhoCorasick:
+    """Aho-Corasick多模式匹配自动机"""
+
+    def __init__(self):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        # 每个状态命中的模式值（已合并失败链上的输出）
+        self.output: List[List[int]] = [[]]
+
+    def add(self, pattern: str, value: int):
+        state = 0
+        for ch in pattern:
+            next_state = self.goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][ch] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+            state = next_state
+        self.output[state].append(value)
+
+    def build(self):
+        """按BFS构建失败指针"""
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail_state = self.fail[state]
+                while fail_state and ch not in self.goto[fail_state]:
+                    fail_state = self.fail[fail_state]
+                self.fail[next_state] = self.goto[fail_state].get(ch, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def first_match(self, text: str) -> Optional[int]:
+        """返回文本中命中的最小模式值（即优先级最高的规则）"""
+        best = None
+        state = 0
+        goto, fail, output = self.goto, self.fail, self.output
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                candidate = min(output[state])
+                if best is None or candidate < best:
+                    best = candidate
+        return best
+
+class _CompiledRules:
+    """编译后的规则集合，重新加载时整体替换"""
+
+    def __init__(self, rules: List[Dict[str, Any]]):
+        self.rules = rules
+        self.exact: Dict[str, int] = {}
+        self.automaton = AhoCorasick()
+        self.patterns: List[Tuple[int, re.Pattern]] = []
+
+        for index, rule in enumerate(rules):
+            for keyword in rule.get("keywords", []):
+                keyword = normalize(str(keyword))
+                if not keyword:
+                    continue
+                if rule.get("match", "exact") == "contains":
+                    self.automaton.add(keyword, index)
+                else:
+                    self.exact.setdefault(keyword, index)
+            if rule.get("pattern"):
+                self.patterns.append((index, re.compile(rule["pattern"], re.IGNORECASE)))
+        self.automaton.build()
+
+    def match(self, text: str) -> Optional[Dict[str, Any]]:
+        """按 整句 -> 包含 -> 正则 的顺序匹配，同类中规则顺序靠前者优先"""
+        text = normalize(text)
+        index = self.exact.get(text)
+        if index is None:
+            index = self.automaton.first_match(text)
+        if index is None:
+            for pattern_index, pattern in self.patterns:
+                if pattern.search(text):
+                    index = pattern_index
+                    break
+        return self.rules[index] if index is not None else None
+
+class KeywordRouter:
+    """关键词路由器"""
+
+    def __init__(self):
+        self._compiled = _CompiledRules([])
+        self._loaded_mtime: Optional[float] = None
+        self._last_check = 0.0
+        self.hits = 0
+        self.reload()
+
+    @property
+    def rules_file(self) -> Path:
+        return Path(config.keywords.rules_file)
+
+    def reload(self) -> int:
+        """加载并编译规则，失败时保留旧规则"""
+        rules_file = self.rules_file
+        try:
+            if rules_file.exists():
+                with open(rules_file, 'r', encoding='utf-8') as f:
+                    rules = (yaml.safe_load(f) or {}).get("rules", [])
+                self._loaded_mtime = os.path.getmtime(rules_file)
+            else:
+                rules = DEFAULT_RULES
+                self._loaded_mtime = None
+            for rule in rules:
+                if not rule.get("reply") and rule.get("action") not in ACTIONS:
+                    raise ValueError(f"规则缺少reply或有效action: {rule}")
+            self._compiled = _CompiledRules(rules)
+            logger.info(f"关键词规则已加载: {len(rules)} 条")
+        except Exception as e:
+            logger.error(f"加载关键词规则失败，继续使用旧规则: {e}")
+        return len(self._compiled.rules)
+
+    def _maybe_reload(self):
+        """规则文件修改后自动重新加载（按间隔检查mtime）"""
+        now = time.monotonic()
+        if now - self._last_check < config.keywords.reload_interval:
+            return
+        self._last_check = now
+        try:
+            mtime = os.path.getmtime(self.rules_file) if self.rules_file.exists() else None
+        except OSError:
+            return
+        if mtime != self._loaded_mtime:
+            self.reload()
+
+    def match(self, content: str) -> Optional[Dict[str, Any]]:
+        """匹配消息，返回命中的规则"""
+        if not config.keywords.enabled:
+            return None
+        self._maybe_reload()
+        return self._compiled.match(content)
+
+    async def reply_for(self, rule: Dict[str, Any], user_id: str) -> str:
+        """生成命中规则的回复"""
+        if rule.get("reply"):
+            return rule["reply"]
+        return await menu_manager.get_click_reply(ACTIONS[rule["action"]], user_id)
+
+    async def reply(self, rule: Dict[str, Any], user_id: str) -> str:
+        """回复已命中的规则并计数（调用方已经用 match 匹配过时使用）"""
+        self.hits += 1
+        logger.info(f"⚡ 关键词快速回复，用户: {user_id}")
+        return await self.reply_for(rule, user_id)
+
+    async def route(self, content: str, user_id: str) -> Optional[str]:
+        """命中规则时返回回复文本，否则返回None"""
+        rule = self.match(content)
+        if rule is None:
+            return None
+        return await self.reply(rule, user_id)
+
+# 全局关键词路由器实例
+keyword_router = KeywordRouter()
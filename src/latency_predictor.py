@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+被动回复超时预测
+
+用在线逻辑回归估计一条消息能否在被动回复窗口内完成：特征包括所选Dify应用、
+问题长度分桶、是否包含分析类关键词以及该用户最近的超时率。每次Dify调用结束后
+（无论被动还是异步）都用“是否在窗口内完成”更新一次模型。
+
+预测完成概率过低时直接回复等待提示并启动异步回复，比等满4.5秒再降级早4.5秒开始。
+"""
+
+import math
+from collections import OrderedDict
+from typing import Dict, Any
+from loguru import logger
+
+from .config import config
+
+# 问题长度分桶边界（字符数）
+LENGTH_BUCKETS = (10, 30, 80, 200)
+# 记录超时率的用户数上限
+MAX_TRACKED_USERS = 10000
+
+class LatencyPredictor:
+    """在线逻辑回归：预测Dify调用在预算内完成的概率"""
+
+    def __init__(self):
+        self.weights: Dict[str, float] = {}
+        self.user_timeout_rate: "OrderedDict[str, float]" = OrderedDict()
+        self.samples = 0
+        self.predicted_slow = 0
+
+    def features(self, message: str, user_id: str, app: str) -> Dict[str, float]:
+        """提取特征（稀疏表示）"""
+        length = len(message)
+        bucket = sum(1 for edge in LENGTH_BUCKETS if length > edge)
+        features = {
+            "bias": 1.0,
+            f"app:{app}": 1.0,
+            f"len:{bucket}": 1.0,
+            "user_timeout_rate": self.user_timeout_rate.get(user_id, 0.0),
+        }
+        if any(keyword in message for keyword in config.routing.deep_keywords):
+            features["keyword"] = 1.0
+        return features
+
+    def _score(self, features: Dict[str, float]) -> float:
+        z = sum(self.weights.get(name, 0.0) * value for name, value in features.items())
+        z = max(-30.0, min(30.0, z))
+        return 1.0 / (1.0 + math.exp(-z))
+
+    def probability(self, message: str, user_id: str, app: str) -> float:
+        """预测在被动回复窗口内完成的概率"""
+        return self._score(self.features(message, user_id, app))
+
+    def predict_timeout(self, message: str, user_id: str, app: str) -> bool:
+        """样本足够且完成概率低于阈值时返回True"""
+        prediction = config.prediction
+        if not prediction.enabled or self.samples < prediction.min_samples:
+            return False
+        probability = self.probability(message, user_id, app)
+        if probability < prediction.min_probability:
+            self.predicted_slow += 1
+            logger.info(f"🔮 预测难以在窗口内完成（概率{probability:.2f}），提前转异步回复，用户: {user_id}")
+            return True
+        return False
+
+    def observe(self, message: str, user_id: str, app: str, finished: bool):
+        """用一次Dify调用的结果更新模型"""
+        prediction = config.prediction
+        # 先用更新前的用户超时率作为特征，与预测时保持一致
+        features = self.features(message, user_id, app)
+        error = (1.0 if finished else 0.0) - self._score(features)
+        for name, value in features.items():
+            weight = self.weights.get(name, 0.0)
+            self.weights[name] = weight + prediction.learning_rate * (error * value - prediction.l2 * weight)
+        self.samples += 1
+
+        timed_out = 0.0 if finished else 1.0
+        rate = self.user_timeout_rate.pop(user_id, timed_out)
+        self.user_timeout_rate[user_id] = 0.5 * rate + 0.5 * timed_out
+        while len(self.user_timeout_rate) > MAX_TRACKED_USERS:
+            self.user_timeout_rate.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        """获取预测器统计"""
+        return {
+            "enabled": config.prediction.enabled,
+            "samples": self.samples,
+            "predicted_slow": self.predicted_slow,
+            "weights": {name: round(weight, 4) for name, weight in sorted(self.weights.items())},
+        }
+
+# 全局超时预测器实例
+latency_predictor = LatencyPredictor()
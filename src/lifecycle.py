@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+应用生命周期管理：启动预热与优雅关闭
+"""
+
+import asyncio
+import time
+from typing import Dict, Any, Awaitable, Callable
+from loguru import logger
+
+from .config import config
+from .dify_client import dify_client
+from .session_manager import session_manager
+from .menu_manager import menu_manager
+from .wechat_official import wechat_official_handler
+from .work_wechat import work_wechat_handler
+from .job_queue import job_queue
+
+async def _run_step(name: str, step: Callable[[], Awaitable[Any]]) -> Dict[str, Any]:
+    """执行单个预热步骤，失败不影响启动"""
+    start_time = time.time()
+    try:
+        result = await asyncio.wait_for(step(), timeout=config.server.warmup_timeout)
+        ok = result is not False
+    except Exception as e:
+        logger.warning(f"预热步骤失败 {name}: {e!r}")
+        ok = False
+    return {"name": name, "ok": ok, "elapsed": round(time.time() - start_time, 3)}
+
+def build_services():
+    """创建各单例的外部客户端：连接Redis、创建微信客户端和加解密处理器
+
+    模块导入时只构造轻量对象，这里的阻塞操作在线程中执行，首个请求不再承担连接开销。
+    """
+    session_manager.connect()
+    if config.wechat_official.enabled:
+        wechat_official_handler.build_clients()
+        menu_manager.wechat_client
+
+def start_background_tasks():
+    """启动依赖事件循环的后台任务（Webhook进程和队列worker进程都需要）"""
+    if config.work_wechat.enabled:
+        work_wechat_handler.start_token_refresher()
+
+async def _ping_redis():
+    if session_manager.redis_client is None:
+        return False
+    return await session_manager.get_async_redis().ping()
+
+async def warm_up() -> Dict[str, Any]:
+    """创建服务后并发预热连接池、访问令牌和上游服务"""
+    started_at = time.time()
+    try:
+        await asyncio.wait_for(asyncio.to_thread(build_services), timeout=config.server.warmup_timeout)
+    except Exception as e:
+        logger.warning(f"创建服务失败: {e!r}")
+    logger.debug(f"服务创建耗时 {time.time() - started_at:.3f}s")
+    start_background_tasks()
+    
+    steps = {
+        "redis": _ping_redis,
+        "dify": dify_client.warm_up,
+    }
+    if job_queue.enabled:
+        steps["job_queue"] = job_queue.ensure_group
+    if config.wechat_official.enabled:
+        steps["wechat_official"] = wechat_official_handler.warm_up
+    if config.work_wechat.enabled:
+        steps["work_wechat"] = work_wechat_handler.warm_up
+
+    results = await asyncio.gather(*(_run_step(name, step) for name, step in steps.items()))
+    summary = {result["name"]: result for result in results}
+    logger.info(f"🔥 启动预热完成: " + ", ".join(
+        f"{name}={'ok' if result['ok'] else 'failed'}({result['elapsed']}s)"
+        for name, result in summary.items()
+    ))
+    return summary
+
+async def shutdown():
+    """优雅关闭：等待或持久化进行中的异步任务，然后释放连接"""
+    await asyncio.gather(
+        wechat_official_handler.drain_async_tasks(config.server.shutdown_grace_period),
+        work_wechat_handler.pool.stop(config.server.shutdown_grace_period),
+        work_wechat_handler.drain_notices(config.server.shutdown_grace_period)
+    )
+
+    for close in (dify_client.close, wechat_official_handler.close, work_wechat_handler.close):
+        try:
+            await close()
+        except Exception as e:
+            logger.warning(f"关闭连接失败: {e}")
+
+    if session_manager.async_redis_client is not None:
+        await session_manager.async_redis_client.aclose()
+        session_manager.async_redis_client = None
+    logger.info("👋 服务已优雅关闭")
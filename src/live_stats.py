@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+实时统计
+
+为 /api/stats 提供滚动窗口统计：1/5/15分钟消息速率、Dify首字节和总耗时的
+p50/p95/p99、被动回复命中率。所有结构都是固定内存，每次记录O(1)：
+
+- 速率按5秒一格的环形计数器统计，读取时对窗口内的格子求和
+- 百分位使用HDR风格的对数-线性直方图（相对误差约3%），按分钟轮换，
+  读取时合并最近5分钟的直方图
+"""
+
+import math
+import time
+from typing import Dict, Any, List, Optional
+
+# 速率统计的格子宽度（秒）和保留时长（15分钟）
+RATE_SLOT_SECONDS = 5
+RATE_SLOTS = 15 * 60 // RATE_SLOT_SECONDS
+
+# 直方图：记录微秒值，每个2的幂区间划分为32个线性子桶
+SUB_BUCKETS = 32
+MAX_EXPONENT = 32  # 最大约 2^32 微秒（约71分钟）
+HISTOGRAM_MINUTES = 5
+
+class RollingCounter:
+    """环形计数器：统计最近15分钟内的事件数"""
+
+    def __init__(self):
+        self.counts = [0] * RATE_SLOTS
+        self.slot_ids = [-1] * RATE_SLOTS
+
+    def add(self, amount: int = 1, now: Optional[float] = None):
+        slot_id = int((now if now is not None else time.time()) // RATE_SLOT_SECONDS)
+        index = slot_id % RATE_SLOTS
+        if self.slot_ids[index] != slot_id:
+            self.slot_ids[index] = slot_id
+            self.counts[index] = 0
+        self.counts[index] += amount
+
+    def total(self, window_seconds: int, now: Optional[float] = None) -> int:
+        """最近window_seconds秒内的事件数"""
+        current = int((now if now is not None else time.time()) // RATE_SLOT_SECONDS)
+        oldest = current - window_seconds // RATE_SLOT_SECONDS + 1
+        return sum(
+            count for count, slot_id in zip(self.counts, self.slot_ids)
+            if oldest <= slot_id <= current
+        )
+
+    def rates(self) -> Dict[str, float]:
+        """1/5/15分钟平均速率（次/分钟）"""
+        now = time.time()
+        return {
+            f"{minutes}m": round(self.total(minutes * 60, now) / minutes, 2)
+            for minutes in (1, 5, 15)
+        }
+
+class LogLinearHistogram:
+    """HDR风格的对数-线性直方图（固定内存）"""
+
+    def __init__(self):
+        self.counts = [0] * (MAX_EXPONENT * SUB_BUCKETS)
+        self.total = 0
+
+    @staticmethod
+    def _index(micros: int) -> int:
+        if micros < 1:
+            return 0
+        mantissa, exponent = math.frexp(micros)  # micros = mantissa * 2^exponent，mantissa ∈ [0.5, 1)
+        exponent = min(exponent, MAX_EXPONENT - 1)
+        sub = min(SUB_BUCKETS - 1, int((mantissa - 0.5) * 2 * SUB_BUCKETS))
+        return exponent * SUB_BUCKETS + sub
+
+    @staticmethod
+    def _value(index: int) -> float:
+        """子桶中点对应的值（微秒）"""
+        exponent, sub = divmod(index, SUB_BUCKETS)
+        return (0.5 + (sub + 0.5) / (2 * SUB_BUCKETS)) * (2 ** exponent)
+
+    def record(self, seconds: float):
+        self.counts[self._index(int(seconds * 1_000_000))] += 1
+        self.total += 1
+
+    def clear(self):
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+        self.total = 0
+
+    @classmethod
+    def percentiles(cls, histograms: List["LogLinearHistogram"], quantiles=(0.5, 0.95, 0.99)) -> Dict[str, Any]:
+        """合并多个直方图并计算百分位（秒）"""
+        total = sum(histogram.total for histogram in histograms)
+        result: Dict[str, Any] = {"count": total}
+        if total == 0:
+            result.update({f"p{int(q * 100)}": None for q in quantiles})
+            return result
+        merged = [sum(column) for column in zip(*(histogram.counts for histogram in histograms))]
+        targets = [(q, max(1, math.ceil(q * total))) for q in quantiles]
+        cumulative = 0
+        target_index = 0
+        for index, count in enumerate(merged):
+            if not count:
+                continue
+            cumulative += count
+            while target_index < len(targets) and cumulative >= targets[target_index][1]:
+                q = targets[target_index][0]
+                result[f"p{int(q * 100)}"] = round(cls._value(index) / 1_000_000, 4)
+                target_index += 1
+            if target_index == len(targets):
+                break
+        return result
+
+class RollingHistogram:
+    """按分钟轮换的直方图，统计最近5分钟"""
+
+    def __init__(self):
+        self.histograms = [LogLinearHistogram() for _ in range(HISTOGRAM_MINUTES)]
+        self.minute_ids = [-1] * HISTOGRAM_MINUTES
+
+    def record(self, seconds: float):
+        minute_id = int(time.time() // 60)
+        index = minute_id % HISTOGRAM_MINUTES
+        if self.minute_ids[index] != minute_id:
+            self.minute_ids[index] = minute_id
+            self.histograms[index].clear()
+        self.histograms[index].record(seconds)
+
+    def percentiles(self) -> Dict[str, Any]:
+        current = int(time.time() // 60)
+        recent = [
+            histogram for histogram, minute_id in zip(self.histograms, self.minute_ids)
+            if current - HISTOGRAM_MINUTES < minute_id <= current
+        ]
+        return LogLinearHistogram.percentiles(recent)
+
+# 公众号中算作“降级为异步”的回复方式
+FALLBACK_OUTCOMES = ("async", "budget_exhausted", "predicted_slow", "shed", "queued")
+
+class LiveStats:
+    """实时统计汇总"""
+
+    def __init__(self):
+        self.messages: Dict[str, RollingCounter] = {}
+        self.outcomes: Dict[str, RollingCounter] = {}
+        self.dify_first_chunk = RollingHistogram()
+        self.dify_total = RollingHistogram()
+
+    def record_message(self, channel: str):
+        counter = self.messages.get(channel)
+        if counter is None:
+            counter = self.messages[channel] = RollingCounter()
+        counter.add()
+
+    def record_outcome(self, outcome: str):
+        counter = self.outcomes.get(outcome)
+        if counter is None:
+            counter = self.outcomes[outcome] = RollingCounter()
+        counter.add()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """最近的速率、百分位和被动回复命中率"""
+        window = 15 * 60
+        outcomes = {outcome: counter.total(window) for outcome, counter in self.outcomes.items()}
+        passive = outcomes.get("passive", 0) + outcomes.get("faq_cache", 0)
+        fallback = sum(outcomes.get(outcome, 0) for outcome in FALLBACK_OUTCOMES)
+        return {
+            "message_rate_per_minute": {channel: counter.rates() for channel, counter in self.messages.items()},
+            "dify_latency_5m": {
+                "first_chunk": self.dify_first_chunk.percentiles(),
+                "total": self.dify_total.percentiles(),
+            },
+            "official_outcomes_15m": outcomes,
+            "passive_hit_ratio_15m": round(passive / (passive + fallback), 4) if passive + fallback else None,
+        }
+
+# 全局实时统计实例
+live_stats = LiveStats()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+事件循环阻塞监测
+
+事件循环中的心跳协程每隔 interval 秒醒来一次，醒来的延迟即事件循环滞后时间。
+独立的守护线程检查心跳：超过 stall_threshold 没有醒来说明事件循环正被同步调用
+阻塞，此时通过 sys._current_frames() 抓取事件循环线程的调用栈，记录阻塞位置
+（最内层的项目代码帧）。事件循环恢复后补记阻塞时长。
+
+心跳每100毫秒一次、线程只比较时间戳，开销可以忽略，默认常开。
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+from loguru import logger
+
+from .config import config
+from .live_stats import RollingHistogram
+from .metrics import registry
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+event_loop_lag_seconds = registry.histogram(
+    "dify2wechat_event_loop_lag_seconds", "事件循环心跳延迟", (), LAG_BUCKETS)
+event_loop_stalls_total = registry.counter(
+    "dify2wechat_event_loop_stalls_total", "事件循环阻塞次数（按阻塞位置）", ("location",))
+
+def _project_path(filename: str) -> Optional[str]:
+    """项目内文件返回相对路径，第三方库和标准库返回None"""
+    path = os.path.abspath(filename)
+    if not path.startswith(PROJECT_ROOT + os.sep) or f"{os.sep}site-packages{os.sep}" in path:
+        return None
+    return os.path.relpath(path, PROJECT_ROOT)
+
+class LoopWatchdog:
+    """事件循环心跳与阻塞调用栈采集"""
+
+    def __init__(self):
+        self.records: Deque[Dict[str, Any]] = deque(maxlen=config.watchdog.max_records)
+        self.lag = RollingHistogram()
+        self.max_lag = 0.0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._last_beat = 0.0
+        self._beat = 0
+        self._pending: Optional[Dict[str, Any]] = None
+
+    @property
+    def running(self) -> bool:
+        return self._heartbeat_task is not None and not self._heartbeat_task.done()
+
+    def start(self):
+        """在事件循环中启动心跳协程和监测线程"""
+        if not config.watchdog.enabled or self.running:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.perf_counter()
+        self._stop.clear()
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+        logger.info(f"🐶 事件循环监测已启动，阻塞阈值: {config.watchdog.stall_threshold}秒")
+
+    async def stop(self):
+        self._stop.set()
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            await asyncio.gather(self._heartbeat_task, return_exceptions=True)
+            self._heartbeat_task = None
+
+    async def _heartbeat(self):
+        interval = config.watchdog.interval
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            now = time.perf_counter()
+            lag = max(0.0, now - started - interval)
+            self._last_beat = now
+            self._beat += 1
+            event_loop_lag_seconds.observe(lag)
+            self.lag.record(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+            pending, self._pending = self._pending, None
+            if pending is not None:
+                # 监测线程已抓取调用栈，事件循环恢复后补记阻塞时长
+                pending["duration"] = round(lag, 4)
+                event_loop_stalls_total.inc(pending["location"])
+                logger.warning(f"🐢 事件循环阻塞{lag:.3f}秒，位置: {pending['location']}，任务: {pending['task']}")
+
+    def _watch(self):
+        """监测线程：心跳超时时抓取事件循环线程的调用栈"""
+        captured_beat = -1
+        interval = config.watchdog.interval
+        check_every = max(0.01, min(interval, config.watchdog.stall_threshold) / 2)
+        while not self._stop.wait(check_every):
+            beat = self._beat
+            overdue = time.perf_counter() - self._last_beat - interval
+            if overdue >= config.watchdog.stall_threshold and beat != captured_beat:
+                captured_beat = beat
+                record = self._capture()
+                if record is not None:
+                    self.records.append(record)
+                    self._pending = record
+
+    def _capture(self) -> Optional[Dict[str, Any]]:
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return None
+        stack = traceback.extract_stack(frame, limit=config.watchdog.stack_depth)
+        location = None
+        for entry in reversed(stack):
+            path = _project_path(entry.filename)
+            if path is not None:
+                location = f"{path}:{entry.lineno} {entry.name}"
+                break
+        if location is None and stack:
+            location = f"{os.path.basename(stack[-1].filename)}:{stack[-1].lineno} {stack[-1].name}"
+
+        # 阻塞期间事件循环线程不会切换任务，此时读取的当前任务即阻塞的协程
+        task = asyncio.tasks._current_tasks.get(self._loop) if hasattr(asyncio.tasks, "_current_tasks") else None
+        coro = task.get_coro() if task is not None else None
+        return {
+            "at": time.time(),
+            "duration": None,
+            "location": location or "unknown",
+            "task": task.get_name() if task is not None else None,
+            "coroutine": getattr(coro, "__qualname__", None),
+            "stack": [f"{entry.filename}:{entry.lineno} in {entry.name}: {entry.line}" for entry in stack],
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        """阻塞统计和最近的阻塞记录（最新的在前）"""
+        by_location: Dict[str, float] = {}
+        for (location,), count in event_loop_stalls_total.items():
+            by_location[location] = count
+        records: List[Dict[str, Any]] = list(self.records)
+        return {
+            "enabled": config.watchdog.enabled,
+            "running": self.running,
+            "stall_threshold": config.watchdog.stall_threshold,
+            "lag_5m": self.lag.percentiles(),
+            "max_lag": round(self.max_lag, 4),
+            "stalls_by_location": by_location,
+            "recent": records[::-1],
+        }
+
+# 全局事件循环监测实例
+loop_watchdog = LoopWatchdog()
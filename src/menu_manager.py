@@ -8,24 +8,80 @@ import httpx
 import json
 from typing import Dict, List, Any
 from loguru import logger
-from wechatpy import WeChatClient
 
 from .config import config
+from .session_manager import session_manager
+from .wechat_clients import get_wechat_client
 
 class MenuManager:
     """微信公众号菜单管理器"""
     
-    def __init__(self):
-        self.app_id = config.wechat_official.app_id
-        self.app_secret = config.wechat_official.app_secret
-        self.wechat_client = None
-        
-        if self.app_id and self.app_secret:
+    @property
+    def wechat_client(self):
+        """微信客户端（与公众号消息处理器共用，未配置AppSecret时为None）"""
+        return get_wechat_client(config.wechat_official.app_id, config.wechat_official.app_secret)
+    
+    async def get_click_reply(self, event_key: str, user_id: str) -> str:
+        """获取菜单点击（或对应关键词）的回复文本"""
+        if event_key == 'AI_CHAT' or event_key == 'START_CHAT':
+            response_text = "🤖 AI助手已准备就绪！\n\n请直接发送消息开始对话：\n• 问我任何问题\n• 寻求建议和帮助\n• 进行有趣的聊天\n\n我会尽我所能为你提供帮助！ ✨"
+            
+        elif event_key == 'CLEAR_HISTORY':
+            # 清除用户会话历史
             try:
-                self.wechat_client = WeChatClient(self.app_id, self.app_secret)
-                logger.info("菜单管理器初始化成功")
+                await session_manager.clear_conversation(user_id)
+                response_text = "🔄 会话历史已清除！\n\n你现在可以开始一个全新的对话。之前的聊天记录已被清空，我将不会记住之前的对话内容。"
             except Exception as e:
-                logger.error(f"菜单管理器初始化失败: {e}")
+                logger.error(f"清除会话历史失败: {e}")
+                response_text = "❌ 清除历史记录时发生错误，请稍后再试。"
+        
+        elif event_key == 'HELP_INFO':
+            response_text = """ℹ️ 使用帮助
+
+🤖 我是基于Dify的AI智能助手，具有以下功能：
+
+💬 **对话功能**
+• 直接发送文字消息与我对话
+• 支持多轮连续对话
+• 记住对话上下文
+
+🔧 **菜单功能**  
+• 🤖 AI助手：快速开始对话
+• 🔄 清除历史：清空聊天记录
+• ℹ️ 使用帮助：查看此帮助信息
+
+⚡ **使用技巧**
+• 可以问我任何问题
+• 支持中英文对话
+• 回复会在5秒内送达
+
+有问题随时问我哦！ 😊"""
+        
+        elif event_key == 'CONTACT_SERVICE':
+            response_text = "📞 联系客服\n\n如需人工客服帮助，请：\n• 发送「人工客服」关键词\n• 或添加客服微信：your-service-wechat\n• 或发送邮件至：service@yourcompany.com\n\n我们将尽快为您提供帮助！"
+        
+        elif event_key == 'ABOUT_US':
+            response_text = """⭐ 关于我们
+
+🚀 **项目简介**
+Dify2WeChat是一个开源的微信AI接入方案，让AI助手轻松融入微信生态。
+
+🛠️ **技术特点**
+• 基于Dify AI平台
+• 支持微信公众号和企业微信
+• 高性能异步处理
+• 完善的会话管理
+
+🌟 **开源地址**
+GitHub: dify2wechat
+
+💪 让AI更好地服务每一个人！"""
+        
+        else:
+            # 未知菜单事件
+            response_text = f"🤔 收到菜单点击事件：{event_key}\n\n请直接发送消息与我对话，或使用菜单中的其他功能。"
+        
+        return response_text
     
     async def create_menu(self, menu_data: Dict[str, Any] = None) -> bool:
         """创建自定义菜单"""
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Prometheus指标
+
+轻量的进程内指标实现（计数器、直方图、按需采集的仪表），由 /metrics 以Prometheus
+文本格式输出。inc/observe 只做一次字典查找和二分查找（标签元组作为字典键），不加锁、不做格式化；
+time() 是上下文管理器，每次调用会多创建一个生成器对象，适合按请求计时，不宜放在紧密循环中。
+"""
+
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+Labels = Tuple[str, ...]
+
+# 默认的耗时直方图分桶（秒），覆盖毫秒级阶段到60秒的Dify调用
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 4.0, 4.5, 5.0, 10.0, 30.0, 60.0)
+RATE_BUCKETS = (1, 5, 10, 20, 40, 80, 160, 320)
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    """只增计数器"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def get(self, *labels: str) -> float:
+        return self._values.get(labels, 0.0)
+
+    def items(self) -> Iterable[Tuple[Labels, float]]:
+        """各组标签及其计数"""
+        return list(self._values.items())
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.label_names, labels)} {value}"
+
+class Histogram:
+    """固定分桶直方图"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # 每组标签：[各分桶计数..., +Inf计数, 总和]
+        self._values: Dict[Labels, List[float]] = {}
+
+    def observe(self, value: float, *labels: str):
+        series = self._values.get(labels)
+        if series is None:
+            series = self._values[labels] = [0.0] * (len(self.buckets) + 2)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    @contextmanager
+    def time(self, *labels: str):
+        """记录代码块耗时"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self) -> Iterable[str]:
+        for labels, series in self._values.items():
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                bucket_labels = _format_labels(self.label_names, labels, f'le="{bound}"')
+                yield f"{self.name}_bucket{bucket_labels} {cumulative}"
+            cumulative += series[len(self.buckets)]
+            bucket_labels = _format_labels(self.label_names, labels, 'le="+Inf"')
+            yield f"{self.name}_bucket{bucket_labels} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.label_names, labels)} {series[-1]}"
+            yield f"{self.name}_count{_format_labels(self.label_names, labels)} {cumulative}"
+
+class CallbackGauge:
+    """采集时调用回调取值的仪表，用于队列深度等已有状态"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str],
+                 collect: Callable[[], Iterable[Tuple[Labels, float]]]):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.collect = collect
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in self.collect():
+            yield f"{self.name}{_format_labels(self.label_names, labels)} {value}"
+
+class Registry:
+    """指标注册表"""
+
+    def __init__(self):
+        self.metrics: List = []
+
+    def counter(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, documentation, label_names)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, label_names, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, documentation: str, label_names: Sequence[str],
+              collect: Callable[[], Iterable[Tuple[Labels, float]]]) -> CallbackGauge:
+        metric = CallbackGauge(name, documentation, label_names, collect)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """输出Prometheus文本格式"""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                lines.extend(metric.samples())
+            except Exception as e:
+                lines.append(f"# 采集失败: {e}")
+        return "\n".join(lines) + "\n"
+
+# 全局指标注册表
+registry = Registry()
+
+webhook_seconds = registry.histogram(
+    "dify2wechat_webhook_seconds", "Webhook请求总耗时", ("channel",))
+xml_parse_seconds = registry.histogram(
+    "dify2wechat_xml_parse_seconds", "XML消息解析耗时", ("channel",))
+decrypt_seconds = registry.histogram(
+    "dify2wechat_decrypt_seconds", "消息解密耗时", ("channel",))
+redis_op_seconds = registry.histogram(
+    "dify2wechat_session_op_seconds", "会话存储操作耗时", ("op",))
+dify_connect_seconds = registry.histogram(
+    "dify2wechat_dify_connect_seconds", "Dify请求到收到响应头的耗时", ("app",))
+dify_first_chunk_seconds = registry.histogram(
+    "dify2wechat_dify_first_chunk_seconds", "Dify首个数据块耗时", ("app",))
+dify_total_seconds = registry.histogram(
+    "dify2wechat_dify_total_seconds", "Dify调用总耗时", ("app", "mode"))
+dify_tokens_per_second = registry.histogram(
+    "dify2wechat_dify_tokens_per_second", "Dify生成速度（首字节之后）", ("app",), RATE_BUCKETS)
+dify_requests_total = registry.counter(
+    "dify2wechat_dify_requests_total", "Dify调用次数", ("app", "result"))
+reply_outcome_total = registry.counter(
+    "dify2wechat_reply_outcome_total", "消息回复方式（被动、异步、削峰等）", ("channel", "outcome"))
+reply_send_seconds = registry.histogram(
+    "dify2wechat_reply_send_seconds", "主动推送消息（客服消息/应用消息）耗时", ("channel",))
+reply_send_errors_total = registry.counter(
+    "dify2wechat_reply_send_errors_total", "主动推送消息失败次数", ("channel", "errcode"))
+token_refresh_total = registry.counter(
+    "dify2wechat_token_refresh_total", "访问令牌刷新次数", ("channel",))
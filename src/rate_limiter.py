@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+消息限流
+
+按用户（FromUserName）和来源IP限制消息频率，超限的消息在调用Dify和读写会话之前
+直接回复固定提示。
+
+两级检查：
+- 进程内令牌桶：容量为窗口内的限额，按限额/窗口的速率补充，持续刷屏的用户在本地
+  就被拒绝，不需要访问Redis
+- Redis滑动窗口：本地放行后通过Lua脚本原子地检查并记录，多个worker进程共享同一
+  限额；Redis不可用时以本地令牌桶的结果为准
+
+被拒绝的消息不计入限额：某一级拒绝时退还已从本地令牌桶取出的令牌（Redis窗口拒绝时
+本身不记录），刷屏期间被拒的消息不会继续消耗令牌而延长限流时间。
+"""
+
+import itertools
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import Request
+from loguru import logger
+
+from .config import config
+from .session_manager import session_manager
+from .state_store import state_store
+from .metrics import registry
+
+# 本地令牌桶数量上限，超过时清理已补满的桶
+MAX_LOCAL_BUCKETS = 10000
+
+# KEYS: 各限流键；ARGV: 当前毫秒时间、窗口毫秒数、本次请求的唯一成员、各键的限额
+# 任一键超限时不记录本次请求，返回超限键的序号（从1开始），全部放行返回0
+SLIDING_WINDOW_SCRIPT = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+for i, key in ipairs(KEYS) do
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+    if redis.call('ZCARD', key) >= tonumber(ARGV[3 + i]) then
+        return i
+    end
+end
+for i, key in ipairs(KEYS) do
+    redis.call('ZADD', key, now, ARGV[3])
+    redis.call('PEXPIRE', key, window)
+end
+return 0
+"""
+
+rate_limited_total = registry.counter(
+    "dify2wechat_rate_limited_total", "被限流的消息数", ("channel", "scope"))
+
+def client_ip(request: Request) -> str:
+    """请求来源IP"""
+    if config.security.trust_proxy_headers:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else ""
+
+class RateLimiter:
+    """本地令牌桶 + Redis滑动窗口限流"""
+
+    def __init__(self):
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._script = None
+        self._sequence = itertools.count()
+
+    def apply_config(self):
+        """配置热加载：按新的限额和窗口重新计数"""
+        self._buckets.clear()
+
+    def _take_local(self, key: str, limit: int) -> bool:
+        """进程内令牌桶"""
+        window = config.security.rate_limit_window
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.get(key, (float(limit), now))
+        tokens = min(float(limit), tokens + (now - updated_at) * limit / window)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now)
+            return False
+        self._buckets[key] = (tokens - 1, now)
+        if len(self._buckets) > MAX_LOCAL_BUCKETS:
+            self._prune(now, window)
+        return True
+
+    def _refund_local(self, key: str, limit: int):
+        """退还一个令牌（消息最终被拒绝时调用）"""
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            self._buckets[key] = (min(float(limit), bucket[0] + 1), bucket[1])
+
+    def _prune(self, now: float, window: float):
+        """清理一个窗口内没有请求（令牌已补满）的桶"""
+        self._buckets = {
+            key: bucket for key, bucket in self._buckets.items() if now - bucket[1] < window
+        }
+
+    async def _take_shared(self, keys: List[str], limits: List[int]) -> int:
+        """Redis滑动窗口，返回超限键的序号（0表示放行）"""
+        if session_manager.redis_client is None:
+            return 0
+        try:
+            if self._script is None:
+                self._script = session_manager.get_async_redis().register_script(SLIDING_WINDOW_SCRIPT)
+            now_ms = int(time.time() * 1000)
+            member = f"{now_ms}-{os.getpid()}-{next(self._sequence)}"
+            args = [now_ms, config.security.rate_limit_window * 1000, member, *limits]
+            return int(await self._script(keys=[f"ratelimit:{key}" for key in keys], args=args))
+        except Exception as e:
+            # Redis异常时只按本地令牌桶限流
+            logger.warning(f"共享限流检查失败: {e}")
+            return 0
+
+    async def check(self, channel: str, user_id: str, ip: str) -> Optional[str]:
+        """检查一条消息，超限时返回限流维度（user / ip），放行返回None"""
+        security = config.security
+        checks = []
+        if security.rate_limit > 0 and user_id and user_id not in security.whitelist:
+            checks.append(("user", f"user:{channel}:{user_id}", security.rate_limit))
+        if security.ip_rate_limit > 0 and ip and ip not in security.whitelist:
+            checks.append(("ip", f"ip:{ip}", security.ip_rate_limit))
+        if not checks:
+            return None
+
+        for index, (scope, key, limit) in enumerate(checks):
+            if not self._take_local(key, limit):
+                for _, taken_key, taken_limit in checks[:index]:
+                    self._refund_local(taken_key, taken_limit)
+                return self._limited(channel, scope, user_id, ip)
+
+        exceeded = await self._take_shared([key for _, key, _ in checks], [limit for _, _, limit in checks])
+        if exceeded:
+            for _, key, limit in checks:
+                self._refund_local(key, limit)
+            return self._limited(channel, checks[exceeded - 1][0], user_id, ip)
+        return None
+
+    def _limited(self, channel: str, scope: str, user_id: str, ip: str) -> str:
+        rate_limited_total.inc(channel, scope)
+        logger.debug(f"🚦 消息被限流（{scope}），渠道: {channel}，用户: {user_id}，IP: {ip}")
+        return scope
+
+    async def should_notify(self, channel: str, user_id: str) -> bool:
+        """主动推送的渠道每个窗口只提示一次，避免为刷屏用户频繁调用发送接口（多个worker进程共享）"""
+        return await state_store.add("ratelimit_notified", f"{channel}:{user_id}", config.security.rate_limit_window)
+
+# 全局限流器实例
+rate_limiter = RateLimiter()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dify请求调度器
+
+在DifyClient前限制并发，并按以下顺序分配空闲槽位：
+1. 优先级：可被动回复的请求 > 企业微信推送 > 超时后的后台完整回复
+2. 同一优先级内按用户做加权公平排队（WFQ），短消息的虚拟完成时间更早，
+   因此短问题排在长问题之前，刷长消息的用户也不会挤占其他用户
+"""
+
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import Dict, Any, Optional, List, Deque
+
+from .config import config
+from .metrics import registry
+
+class Priority(IntEnum):
+    """请求优先级，数值越小越优先"""
+    INTERACTIVE = 0  # 4.5秒内可被动回复的请求
+    NORMAL = 1       # 企业微信等推送式回复
+    BACKGROUND = 2   # 超时后的后台完整回复
+
+class _Ticket:
+    """排队凭证"""
+    __slots__ = ("user_id", "priority", "start_tag", "finish_tag", "enqueued_at", "future", "granted_at")
+
+    def __init__(self, user_id: str, priority: Priority, start_tag: float, finish_tag: float):
+        self.user_id = user_id
+        self.priority = priority
+        self.start_tag = start_tag
+        self.finish_tag = finish_tag
+        self.enqueued_at = time.monotonic()
+        self.future: Optional[asyncio.Future] = None
+        self.granted_at: Optional[float] = None
+
+class _WaitStats:
+    """单个优先级的排队等待统计"""
+
+    def __init__(self, sample_size: int = 512):
+        self.count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.samples: Deque[float] = deque(maxlen=sample_size)
+
+    def record(self, wait: float):
+        self.count += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.samples.append(wait)
+
+    def snapshot(self) -> Dict[str, Any]:
+        samples = sorted(self.samples)
+        def percentile(p: float) -> float:
+            if not samples:
+                return 0.0
+            return round(samples[min(len(samples) - 1, int(p * len(samples)))], 4)
+        return {
+            "count": self.count,
+            "avg_wait": round(self.total_wait / self.count, 4) if self.count else 0.0,
+            "max_wait": round(self.max_wait, 4),
+            "p50_wait": percentile(0.50),
+            "p95_wait": percentile(0.95),
+        }
+
+class DifyScheduler:
+    """加权公平、带优先级的Dify并发调度器"""
+
+    def __init__(self):
+        self._heap: List[tuple] = []
+        self._seq = itertools.count()
+        self._active = 0
+        self._virtual_time = 0.0
+        self._last_finish: Dict[str, float] = {}
+        self._wait_stats: Dict[Priority, _WaitStats] = {p: _WaitStats() for p in Priority}
+        # 各优先级进行中的调用数
+        self._active_by_priority: Dict[Priority, int] = {p: 0 for p in Priority}
+        # 各优先级占用槽位时长的指数移动平均（流式调用从获得槽位到生成结束），供准入控制估算等待时间。
+        # 后台完整回复的生成时间远长于被动回复，按优先级分开统计，避免互相拉偏
+        self.service_time_ewma: Dict[Priority, Optional[float]] = {p: None for p in Priority}
+
+    @property
+    def max_concurrency(self) -> int:
+        return max(1, config.scheduler.max_concurrency)
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for entry in self._heap if not entry[-1].future.done())
+
+    def queue_depth_for(self, priority: Priority) -> int:
+        """排在指定优先级请求之前（同级或更高优先级）的排队数"""
+        return sum(
+            1 for entry in self._heap
+            if entry[0] <= priority and not entry[-1].future.done()
+        )
+
+    def expected_service_time(self, priority: Priority) -> float:
+        """指定优先级的预期槽位占用时长，尚无样本时参考其他优先级"""
+        ewma = self.service_time_ewma[priority]
+        if ewma is not None:
+            return ewma
+        samples = [value for value in self.service_time_ewma.values() if value is not None]
+        return min(samples) if samples else 0.0
+
+    def mean_active_service_time(self) -> float:
+        """进行中调用的平均预期占用时长，决定槽位释放的速度"""
+        if self._active <= 0:
+            return 0.0
+        total = sum(count * self.expected_service_time(priority)
+                    for priority, count in self._active_by_priority.items())
+        return total / self._active
+
+    def _cost(self, message: str) -> float:
+        """按消息长度估算代价，短消息代价低、优先出队"""
+        return 1.0 + len(message) / max(1, config.scheduler.cost_unit_chars)
+
+    def _weight(self, user_id: str) -> float:
+        return max(0.01, config.scheduler.user_weights.get(user_id, 1.0))
+
+    def _make_ticket(self, user_id: str, priority: Priority, message: str) -> _Ticket:
+        start_tag = max(self._virtual_time, self._last_finish.get(user_id, 0.0))
+        finish_tag = start_tag + self._cost(message) / self._weight(user_id)
+        self._last_finish[user_id] = finish_tag
+        return _Ticket(user_id, priority, start_tag, finish_tag)
+
+    def _grant(self, ticket: _Ticket):
+        self._active += 1
+        self._active_by_priority[ticket.priority] += 1
+        ticket.granted_at = time.monotonic()
+        self._virtual_time = max(self._virtual_time, ticket.start_tag)
+        self._wait_stats[ticket.priority].record(ticket.granted_at - ticket.enqueued_at)
+
+    def _dispatch(self):
+        """把空闲槽位分配给队首请求"""
+        while self._heap and self._active < self.max_concurrency:
+            ticket = heapq.heappop(self._heap)[-1]
+            if ticket.future.done():
+                # 排队期间已被取消
+                continue
+            self._grant(ticket)
+            ticket.future.set_result(True)
+
+        # 清理已落后于虚拟时间的用户记录，避免字典无限增长
+        if len(self._last_finish) > 10000:
+            self._last_finish = {
+                user_id: finish for user_id, finish in self._last_finish.items()
+                if finish > self._virtual_time
+            }
+
+    async def acquire(self, user_id: str, priority: Priority = Priority.INTERACTIVE, message: str = "") -> _Ticket:
+        """申请一个Dify并发槽位"""
+        ticket = self._make_ticket(user_id, priority, message)
+        if not self._heap and self._active < self.max_concurrency:
+            self._grant(ticket)
+            return ticket
+
+        ticket.future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, ticket.finish_tag, next(self._seq), ticket))
+        # 队列中可能只剩已取消的请求，立即尝试调度
+        self._dispatch()
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket.granted_at is not None:
+                # 已分配槽位但调用方被取消，归还槽位
+                self.release(ticket)
+            raise
+        return ticket
+
+    def release(self, ticket: _Ticket):
+        """归还槽位并调度下一个请求"""
+        self._active -= 1
+        self._active_by_priority[ticket.priority] -= 1
+        service_time = time.monotonic() - (ticket.granted_at or time.monotonic())
+        ewma = self.service_time_ewma[ticket.priority]
+        self.service_time_ewma[ticket.priority] = (
+            service_time if ewma is None else 0.8 * ewma + 0.2 * service_time
+        )
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, user_id: str, priority: Priority = Priority.INTERACTIVE, message: str = ""):
+        """在Dify调用期间占用一个并发槽位"""
+        if not config.scheduler.enabled:
+            yield None
+            return
+        ticket = await self.acquire(user_id, priority, message)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def stats(self) -> Dict[str, Any]:
+        """获取调度器统计"""
+        depth_by_priority = {p.name.lower(): 0 for p in Priority}
+        for entry in self._heap:
+            ticket = entry[-1]
+            if not ticket.future.done():
+                depth_by_priority[ticket.priority.name.lower()] += 1
+        return {
+            "enabled": config.scheduler.enabled,
+            "max_concurrency": self.max_concurrency,
+            "active": self._active,
+            "queue_depth": sum(depth_by_priority.values()),
+            "queue_depth_by_priority": depth_by_priority,
+            "service_time_ewma": {
+                p.name.lower(): round(value or 0.0, 4) for p, value in self.service_time_ewma.items()
+            },
+            "queue_wait": {p.name.lower(): stats.snapshot() for p, stats in self._wait_stats.items()},
+        }
+
+# 全局调度器实例
+dify_scheduler = DifyScheduler()
+
+def _collect_scheduler_depth():
+    stats = dify_scheduler.stats()
+    return [((priority,), depth) for priority, depth in stats["queue_depth_by_priority"].items()]
+
+registry.gauge("dify2wechat_dify_active_calls", "进行中的Dify调用数", (),
+               lambda: [((), dify_scheduler.active)])
+registry.gauge("dify2wechat_dify_queue_depth", "等待Dify槽位的请求数", ("priority",),
+               _collect_scheduler_depth)
@@ -5,25 +5,79 @@
 """
 
 import redis
+import redis.asyncio as aioredis
 import json
 import time
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Tuple
 from loguru import logger
 
 from .config import config
+from .metrics import redis_op_seconds
 
 class SessionManager:
     """会话管理器"""
     
     def __init__(self):
-        self.redis_client = None
+        # 同步客户端由connect()连接（ping会阻塞，服务启动时由lifespan在线程中执行）
+        self._redis_client = None
+        self._redis_initialized = False
+        self.async_redis_client = None  # 供任务队列等异步组件使用
         self.memory_store = {}  # 内存存储作为备选
-        self.init_redis()
+    
+    @property
+    def redis_client(self) -> Optional[redis.Redis]:
+        """同步Redis客户端，尚未连接或连接失败时为None（使用内存存储）
+        
+        读取时不会连接：连接会阻塞事件循环直到超时，lifespan预热失败时也不能让请求去承担
+        """
+        return self._redis_client
+    
+    @redis_client.setter
+    def redis_client(self, client: Optional[redis.Redis]):
+        self._redis_initialized = True
+        self._redis_client = client
+    
+    def connect(self):
+        """连接Redis（已连接或已确认不可用时不重复连接）"""
+        if not self._redis_initialized:
+            self.init_redis()
+    
+    def _new_sync_client(self) -> redis.Redis:
+        return redis.Redis(
+            host=config.redis.host,
+            port=config.redis.port,
+            password=config.redis.password or None,
+            db=config.redis.db,
+            decode_responses=True,
+            socket_timeout=5
+        )
+    
+    def check_connection(self) -> bool:
+        """一次性检查Redis是否可用，检查后关闭连接（供启动worker进程前的父进程使用，不保留连接）"""
+        client = self._new_sync_client()
+        try:
+            return bool(client.ping())
+        except Exception:
+            return False
+        finally:
+            client.close()
     
     def init_redis(self):
         """初始化Redis连接"""
         try:
-            self.redis_client = redis.Redis(
+            client = self._new_sync_client()
+            # 测试连接，成功后才对外可见
+            client.ping()
+            self.redis_client = client
+            logger.info("Redis连接成功")
+        except Exception as e:
+            logger.warning(f"Redis连接失败，使用内存存储: {e}")
+            self.redis_client = None
+    
+    def get_async_redis(self) -> aioredis.Redis:
+        """获取异步Redis客户端（懒加载，与同步客户端共用配置）"""
+        if self.async_redis_client is None:
+            self.async_redis_client = aioredis.Redis(
                 host=config.redis.host,
                 port=config.redis.port,
                 password=config.redis.password or None,
@@ -31,46 +85,29 @@ class SessionManager:
                 decode_responses=True,
                 socket_timeout=5
             )
-            # 测试连接
-            self.redis_client.ping()
-            logger.info("Redis连接成功")
-        except Exception as e:
-            logger.warning(f"Redis连接失败，使用内存存储: {e}")
-            self.redis_client = None
+        return self.async_redis_client
     
-    async def get_conversation_id(self, user_id: str) -> Optional[str]:
-        """获取用户的会话ID"""
-        try:
-            key = f"conversation:{user_id}"
-            
+    def _session_key(self, user_id: str, app: str = "default") -> str:
+        """Dify会话ID只在所属应用内有效，每个应用单独保存"""
+        return f"conversation:{user_id}" if app == "default" else f"conversation:{user_id}:{app}"
+    
+    async def load_session(self, user_id: str, app: str = "default") -> Dict[str, Any]:
+        """读取用户会话数据（异步Redis客户端，不阻塞事件循环）"""
+        key = self._session_key(user_id, app)
+        with redis_op_seconds.time("load"):
             if self.redis_client:
-                data = self.redis_client.get(key)
-                if data:
-                    session_data = json.loads(data)
-                    return session_data.get('conversation_id')
-            else:
-                # 使用内存存储
-                session_data = self.memory_store.get(key)
-                if session_data:
-                    return session_data.get('conversation_id')
-                    
-        except Exception as e:
-            logger.error(f"获取会话ID失败: {e}")
-        
-        return None
+                data = await self.get_async_redis().get(key)
+                return json.loads(data) if data else {}
+            return dict(self.memory_store.get(key) or {})
     
-    async def set_conversation_id(self, user_id: str, conversation_id: str):
-        """设置用户的会话ID"""
-        try:
-            key = f"conversation:{user_id}"
-            session_data = {
-                'conversation_id': conversation_id,
-                'updated_at': int(time.time())
-            }
-            
+    async def _save_session(self, user_id: str, session_data: Dict[str, Any], app: str = "default"):
+        """保存用户会话数据"""
+        key = self._session_key(user_id, app)
+        session_data['updated_at'] = int(time.time())
+        with redis_op_seconds.time("save"):
             if self.redis_client:
                 # Redis存储，过期时间7天
-                self.redis_client.setex(
+                await self.get_async_redis().setex(
                     key, 
                     7 * 24 * 3600, 
                     json.dumps(session_data)
@@ -78,19 +115,116 @@ class SessionManager:
             else:
                 # 内存存储
                 self.memory_store[key] = session_data
-                
+    
+    async def get_conversation_id(self, user_id: str) -> Optional[str]:
+        """获取用户的会话ID"""
+        try:
+            return (await self.load_session(user_id)).get('conversation_id')
+        except Exception as e:
+            logger.error(f"获取会话ID失败: {e}")
+        
+        return None
+    
+    async def set_conversation_id(self, user_id: str, conversation_id: str):
+        """设置用户的会话ID"""
+        try:
+            session_data = await self.load_session(user_id)
+            if session_data.get('conversation_id') != conversation_id:
+                session_data = self._new_session(conversation_id)
+            await self._save_session(user_id, session_data)
             logger.debug(f"会话ID已保存，用户: {user_id}")
             
         except Exception as e:
             logger.error(f"保存会话ID失败: {e}")
     
+    def _new_session(self, conversation_id: str) -> Dict[str, Any]:
+        return {
+            'conversation_id': conversation_id,
+            'created_at': int(time.time()),
+            'turns': 0,
+            'tokens': 0,
+            'recent': []
+        }
+    
+    def rotation_reason(self, session_data: Dict[str, Any]) -> Optional[str]:
+        """会话超过轮数、存活时间或token限制时返回原因"""
+        limits = config.conversation
+        if not limits.rotation_enabled or not session_data.get('conversation_id'):
+            return None
+        if session_data.get('turns', 0) >= limits.max_turns:
+            return f"轮数 {session_data['turns']}"
+        age = time.time() - session_data.get('created_at', session_data.get('updated_at', time.time()))
+        if age >= limits.max_age:
+            return f"存活 {int(age)} 秒"
+        if session_data.get('tokens', 0) >= limits.max_tokens:
+            return f"token {session_data['tokens']}"
+        return None
+    
+    def _carryover_summary(self, session_data: Dict[str, Any]) -> str:
+        """用最近几轮对话拼出带入新会话的摘要"""
+        lines = []
+        for query, answer in session_data.get('recent', []):
+            lines.append(f"用户：{query}")
+            lines.append(f"助手：{answer}")
+        if not lines:
+            return ""
+        return "（以下是此前对话的摘要，供参考）\n" + "\n".join(lines)
+    
+    async def start_turn(self, user_id: str, message: str, app: str = "default",
+                         session_data: Optional[Dict[str, Any]] = None) -> Tuple[Optional[str], str]:
+        """开始一轮对话，返回 (会话ID, 发送给Dify的query)
+        
+        会话超过限制时返回None开启新会话，开启了摘要带入时query前附带最近几轮对话。
+        session_data 为路由时已读取的会话数据，传入时不再重复读取。
+        """
+        if session_data is None:
+            try:
+                session_data = await self.load_session(user_id, app)
+            except Exception as e:
+                logger.error(f"获取会话ID失败: {e}")
+                return None, message
+        
+        reason = self.rotation_reason(session_data)
+        if reason is None:
+            return session_data.get('conversation_id'), message
+        
+        logger.info(f"🔄 会话达到限制（{reason}），开启新会话，用户: {user_id}")
+        summary = self._carryover_summary(session_data) if config.conversation.carry_summary else ""
+        return None, f"{summary}\n\n{message}" if summary else message
+    
+    async def record_turn(self, user_id: str, result: Dict[str, Any], message: str, app: str = "default"):
+        """记录一轮对话：保存会话ID并累计轮数和token用量"""
+        conversation_id = result.get('conversation_id')
+        if not conversation_id:
+            return
+        try:
+            session_data = await self.load_session(user_id, app)
+            if session_data.get('conversation_id') != conversation_id:
+                session_data = self._new_session(conversation_id)
+            
+            answer = result.get('answer', '')
+            # 部分回复或Dify未返回用量时按字符数估算
+            tokens = (result.get('usage') or {}).get('total_tokens') or len(message) + len(answer)
+            session_data['turns'] = session_data.get('turns', 0) + 1
+            session_data['tokens'] = session_data.get('tokens', 0) + tokens
+            
+            summary_chars = config.conversation.summary_chars
+            recent = session_data.get('recent', []) + [[message[:summary_chars], answer[:summary_chars]]]
+            summary_turns = config.conversation.summary_turns
+            session_data['recent'] = recent[-summary_turns:] if summary_turns > 0 else []
+            
+            await self._save_session(user_id, session_data, app)
+        except Exception as e:
+            logger.error(f"保存会话ID失败: {e}")
+    
     async def clear_conversation(self, user_id: str):
         """清除用户会话"""
         try:
             keys = [f"conversation:{user_id}", f"context:{user_id}"]
+            keys += [self._session_key(user_id, app) for app in config.dify.apps if app != "default"]
             
             if self.redis_client:
-                self.redis_client.delete(*keys)
+                await self.get_async_redis().delete(*keys)
             else:
                 for key in keys:
                     self.memory_store.pop(key, None)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+跨请求状态存储
+
+多个uvicorn worker进程同时处理Webhook时，同一用户的重试回调、下一条消息可能落到
+不同的进程，因此消息去重、待取回的完整回复、"该用户已有异步回复任务"标记等跨请求
+状态统一通过这里读写：
+
+- memory：进程内字典（单进程部署，或没有Redis时）
+- redis：与会话共用的Redis，多个worker进程共享
+
+server.state_store 为 auto 时有Redis连接就用Redis。Redis操作失败时降级到进程内
+存储，不影响消息处理。
+
+进行中的asyncio任务对象、Dify流式回复的中间结果只在发起它的进程内有意义，仍保存
+在各处理器自己的字典中。
+"""
+
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from loguru import logger
+
+from .config import config
+from .session_manager import session_manager
+
+# 进程内存储每个命名空间的条目上限，超过时淘汰最早写入的条目
+MAX_MEMORY_ITEMS = 10000
+# 消息ID去重的保留时间（秒），覆盖微信回调的重试窗口
+DEDUP_TTL = 300
+
+class MemoryStateStore:
+    """进程内状态存储（带过期时间）"""
+
+    name = "memory"
+
+    def __init__(self, max_items: int = MAX_MEMORY_ITEMS):
+        self.max_items = max_items
+        self._data: Dict[str, "OrderedDict[str, Tuple[float, Any]]"] = {}
+
+    def _namespace(self, namespace: str) -> "OrderedDict[str, Tuple[float, Any]]":
+        return self._data.setdefault(namespace, OrderedDict())
+
+    def _get(self, namespace: str, key: str) -> Optional[Tuple[float, Any]]:
+        items = self._namespace(namespace)
+        entry = items.get(key)
+        if entry is not None and entry[0] <= time.monotonic():
+            del items[key]
+            return None
+        return entry
+
+    def _set(self, namespace: str, key: str, value: Any, ttl: float):
+        items = self._namespace(namespace)
+        items[key] = (time.monotonic() + ttl, value)
+        items.move_to_end(key)
+        while len(items) > self.max_items:
+            items.popitem(last=False)
+
+    async def add(self, namespace: str, key: str, ttl: float) -> bool:
+        """键不存在时写入并返回True，已存在返回False"""
+        if self._get(namespace, key) is not None:
+            return False
+        self._set(namespace, key, 1, ttl)
+        return True
+
+    async def delete(self, namespace: str, key: str):
+        self._namespace(namespace).pop(key, None)
+
+    async def put(self, namespace: str, key: str, value: Dict[str, Any], ttl: float):
+        self._set(namespace, key, value, ttl)
+
+    async def pop(self, namespace: str, key: str) -> Optional[Dict[str, Any]]:
+        """读取并删除"""
+        entry = self._get(namespace, key)
+        if entry is None:
+            return None
+        del self._namespace(namespace)[key]
+        return entry[1]
+
+    def sizes(self) -> Dict[str, int]:
+        return {namespace: len(items) for namespace, items in self._data.items()}
+
+class RedisStateStore:
+    """Redis状态存储，键为 "{namespace}:{key}"，多个worker进程共享"""
+
+    name = "redis"
+
+    @staticmethod
+    def _key(namespace: str, key: str) -> str:
+        return f"{namespace}:{key}"
+
+    async def add(self, namespace: str, key: str, ttl: float) -> bool:
+        redis = session_manager.get_async_redis()
+        return bool(await redis.set(self._key(namespace, key), 1, nx=True, px=int(ttl * 1000)))
+
+    async def delete(self, namespace: str, key: str):
+        await session_manager.get_async_redis().delete(self._key(namespace, key))
+
+    async def put(self, namespace: str, key: str, value: Dict[str, Any], ttl: float):
+        redis = session_manager.get_async_redis()
+        await redis.set(self._key(namespace, key), json.dumps(value, ensure_ascii=False), px=int(ttl * 1000))
+
+    async def pop(self, namespace: str, key: str) -> Optional[Dict[str, Any]]:
+        """读取并删除（事务中执行，并发读取时只有一个进程拿到）"""
+        async with session_manager.get_async_redis().pipeline(transaction=True) as pipe:
+            pipe.get(self._key(namespace, key))
+            pipe.delete(self._key(namespace, key))
+            data, _ = await pipe.execute()
+        return json.loads(data) if data else None
+
+class StateStore:
+    """按 server.state_store 选择后端，Redis异常时降级到进程内存储"""
+
+    def __init__(self):
+        self.memory = MemoryStateStore()
+        self.redis = RedisStateStore()
+
+    @property
+    def backend(self):
+        mode = config.server.state_store
+        if mode == "memory":
+            return self.memory
+        if mode == "redis" or session_manager.redis_client is not None:
+            return self.redis
+        return self.memory
+
+    async def _call(self, method: str, *args):
+        backend = self.backend
+        if backend is self.memory:
+            return await getattr(self.memory, method)(*args)
+        try:
+            return await getattr(backend, method)(*args)
+        except Exception as e:
+            logger.warning(f"共享状态{method}失败，使用进程内存储: {e}")
+            return await getattr(self.memory, method)(*args)
+
+    async def add(self, namespace: str, key: str, ttl: float) -> bool:
+        """首次写入返回True（用于去重和互斥标记）"""
+        return await self._call("add", namespace, key, ttl)
+
+    async def delete(self, namespace: str, key: str):
+        await self._call("delete", namespace, key)
+
+    async def put(self, namespace: str, key: str, value: Dict[str, Any], ttl: float):
+        await self._call("put", namespace, key, value, ttl)
+
+    async def pop(self, namespace: str, key: str) -> Optional[Dict[str, Any]]:
+        return await self._call("pop", namespace, key)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.backend.name, "memory_items": self.memory.sizes()}
+
+# 全局状态存储实例
+state_store = StateStore()
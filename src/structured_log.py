@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+结构化日志
+
+- JSON格式：每行一条记录，附带当前链路的trace_id和 logger.bind() 绑定的字段
+- 分阶段采样：按模块名（或绑定的stage字段）对INFO及以下日志采样，WARNING及以上全部保留；
+  每条记录只在patcher中决定一次，各输出（stderr、文件）保留或丢弃同一批记录
+- 消息汇总：每条消息处理结束时输出一条包含渠道、结果、耗时等字段的汇总记录，
+  代替逐步的过程日志
+
+大块内容（XML、消息体）只在DEBUG级别以参数形式记录，loguru在级别未开启时不会格式化。
+"""
+
+import json
+import random
+import traceback
+from typing import Any, Dict
+
+from loguru import logger
+
+from .config import config
+from .tracing import tracer
+
+# 不参与采样的最低级别（WARNING）
+_ALWAYS_KEEP_LEVEL = 30
+SUMMARY_STAGE = "summary"
+
+def _sampled(record: Dict[str, Any]) -> bool:
+    """按阶段采样INFO及以下的日志"""
+    if record["level"].no >= _ALWAYS_KEEP_LEVEL:
+        return True
+    stage = record["extra"].get("stage") or (record["name"] or "").rsplit(".", 1)[-1]
+    if stage == SUMMARY_STAGE:
+        return True
+    rate = config.logging.sampling.get(stage)
+    return rate is None or random.random() < rate
+
+def patch_record(record: Dict[str, Any]):
+    """patcher：在调用方上下文中记录当前trace_id（写入可能在后台线程进行），并决定是否采样保留"""
+    span = tracer.current()
+    if span is not None:
+        record["extra"]["trace_id"] = span.trace_id
+    record["extra"]["_sampled"] = _sampled(record)
+
+def sample_filter(record: Dict[str, Any]) -> bool:
+    """各输出共用patcher的采样决定"""
+    return record["extra"].get("_sampled", True)
+
+def json_format(record: Dict[str, Any]) -> str:
+    """loguru格式函数：把记录序列化为一行JSON"""
+    payload = {
+        "time": record["time"].isoformat(),
+        "level": record["level"].name,
+        "logger": record["name"],
+        "function": record["function"],
+        "line": record["line"],
+        "message": record["message"],
+    }
+    for key, value in record["extra"].items():
+        if not key.startswith("_"):
+            payload.setdefault(key, value)
+    if record["exception"] is not None:
+        payload["exception"] = "".join(traceback.format_exception(*record["exception"]))
+    record["extra"]["_json"] = json.dumps(payload, ensure_ascii=False, default=str)
+    return "{extra[_json]}\n"
+
+def log_message_summary(event: str, **fields: Any):
+    """输出一条消息的汇总记录"""
+    if not config.logging.message_summary:
+        return
+    logger.bind(stage=SUMMARY_STAGE, **fields).opt(depth=1).info(
+        "📋 {} {}", event, " ".join(f"{key}={value}" for key, value in fields.items())
+    )
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+有界后台任务池
+
+Webhook只负责把任务放进有界队列后立即返回，由固定数量的worker协程依次执行；
+队列满时拒绝提交，由调用方决定降级方式，避免无限堆积协程。
+
+提交时保存调用方的上下文（contextvars），任务在该上下文中执行，链路追踪等
+上下文信息与直接 asyncio.create_task 时一致。
+"""
+
+import asyncio
+import contextvars
+from typing import Awaitable, Callable, Dict, Any, List, Optional
+from loguru import logger
+
+TaskFactory = Callable[[], Awaitable[Any]]
+
+class BackgroundPool:
+    """固定worker数量的后台任务池"""
+
+    def __init__(self, name: str, workers: int, queue_size: int):
+        self.name = name
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker_tasks: List[asyncio.Task] = []
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def _ensure_started(self):
+        """在当前事件循环中懒启动worker"""
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.queue_size)
+        if not self._worker_tasks:
+            self._worker_tasks = [
+                asyncio.create_task(self._worker(i)) for i in range(self.workers)
+            ]
+            logger.info(f"后台任务池 {self.name} 启动，worker数: {self.workers}")
+
+    async def _worker(self, index: int):
+        while True:
+            factory, context = await self._queue.get()
+            try:
+                await context.run(asyncio.create_task, factory())
+                self.completed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"后台任务池 {self.name} 任务异常: {e}")
+            finally:
+                self._queue.task_done()
+
+    def submit(self, factory: TaskFactory) -> bool:
+        """提交任务，队列已满时返回False"""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((factory, contextvars.copy_context()))
+            return True
+        except asyncio.QueueFull:
+            self.rejected += 1
+            logger.warning(f"后台任务池 {self.name} 已满，拒绝任务")
+            return False
+
+    async def stop(self, grace_period: float):
+        """等待队列中的任务完成（最长grace_period秒）后停止worker"""
+        if self._queue is not None and self._worker_tasks:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout=grace_period)
+            except asyncio.TimeoutError:
+                logger.warning(f"后台任务池 {self.name} 关闭超时，剩余 {self._queue.qsize()} 个任务未处理")
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+
+    def stats(self) -> Dict[str, Any]:
+        """获取任务池统计"""
+        return {
+            "workers": self.workers,
+            "queue_size": self._queue.qsize() if self._queue is not None else 0,
+            "queue_capacity": self.queue_size,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+消息链路追踪
+
+每条收到的消息（按MsgId）生成一个trace，Webhook、handle_message、Dify调用、
+异步回复和客服消息发送各自记录为带耗时的span。当前span保存在contextvar中，
+asyncio.create_task 和后台任务池会把它带到后台任务里；写入任务队列时以W3C
+traceparent格式随任务传递。
+
+结束的span写入内存环形缓冲区，/api/traces/{msg_id} 按OpenTelemetry的OTLP JSON
+格式输出，不需要外部采集器即可查看一条慢消息的耗时分布，也可以直接转发给
+OTLP collector 的 /v1/traces。
+"""
+
+import functools
+import random
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+
+from .config import config
+
+SERVICE_NAME = "dify2wechat"
+
+# OTLP中的span类型
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+
+# OTLP中的状态码
+STATUS_UNSET = 0
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+class Span:
+    """一个计时阶段"""
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind",
+                 "start_ns", "end_ns", "attributes", "events", "status", "status_message")
+
+    def __init__(self, trace_id: str, parent_id: Optional[str], name: str,
+                 kind: int = KIND_INTERNAL, attributes: Optional[Dict[str, Any]] = None):
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes: Dict[str, Any] = attributes or {}
+        self.events: List[tuple] = []
+        self.status = STATUS_UNSET
+        self.status_message = ""
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def add_event(self, name: str, **attributes: Any):
+        self.events.append((time.time_ns(), name, attributes))
+
+    def fail(self, message: str):
+        self.status = STATUS_ERROR
+        self.status_message = message
+
+    @property
+    def duration(self) -> float:
+        """耗时（秒），未结束时为到目前为止的耗时"""
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def _otlp_attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items()]
+
+def _otlp_span(span: Span) -> Dict[str, Any]:
+    result = {
+        "traceId": span.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": span.kind,
+        "startTimeUnixNano": str(span.start_ns),
+        "endTimeUnixNano": str(span.end_ns or time.time_ns()),
+        "attributes": _otlp_attributes(span.attributes),
+        "status": {"code": span.status, **({"message": span.status_message} if span.status_message else {})},
+    }
+    if span.parent_id:
+        result["parentSpanId"] = span.parent_id
+    if span.events:
+        result["events"] = [
+            {"timeUnixNano": str(at), "name": name, "attributes": _otlp_attributes(attributes)}
+            for at, name, attributes in span.events
+        ]
+    return result
+
+class _TraceRecord:
+    __slots__ = ("spans", "msg_id", "dropped")
+
+    def __init__(self):
+        self.spans: List[Span] = []
+        self.msg_id: Optional[str] = None
+        self.dropped = 0
+
+class RingBufferExporter:
+    """在内存中保留最近 buffer_size 条链路的已结束span"""
+
+    def __init__(self):
+        self.traces: "OrderedDict[str, _TraceRecord]" = OrderedDict()
+        self.msg_index: Dict[str, str] = {}
+
+    def _record(self, trace_id: str) -> _TraceRecord:
+        record = self.traces.get(trace_id)
+        if record is None:
+            record = self.traces[trace_id] = _TraceRecord()
+            while len(self.traces) > config.tracing.buffer_size:
+                _, evicted = self.traces.popitem(last=False)
+                if evicted.msg_id and self.msg_index.get(evicted.msg_id) == trace_id:
+                    del self.msg_index[evicted.msg_id]
+        return record
+
+    def bind(self, msg_id: str, trace_id: str):
+        """建立消息ID到链路的映射"""
+        self._record(trace_id).msg_id = msg_id
+        self.msg_index[msg_id] = trace_id
+
+    def export(self, span: Span):
+        record = self._record(span.trace_id)
+        if len(record.spans) >= config.tracing.max_spans:
+            record.dropped += 1
+            return
+        record.spans.append(span)
+
+    def lookup(self, msg_id: str) -> Optional[_TraceRecord]:
+        trace_id = self.msg_index.get(msg_id)
+        return self.traces.get(trace_id) if trace_id else None
+
+    def to_otlp(self, record: _TraceRecord) -> Dict[str, Any]:
+        """按OTLP JSON（ExportTraceServiceRequest）格式输出"""
+        spans = sorted(record.spans, key=lambda span: span.start_ns)
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": _otlp_attributes({"service.name": SERVICE_NAME})},
+                "scopeSpans": [{
+                    "scope": {"name": SERVICE_NAME},
+                    "spans": [_otlp_span(span) for span in spans],
+                }],
+            }]
+        }
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("trace_span", default=None)
+
+class Tracer:
+    """创建span并维护当前span"""
+
+    def __init__(self, exporter: RingBufferExporter):
+        self.exporter = exporter
+
+    def current(self) -> Optional[Span]:
+        return _current_span.get()
+
+    @contextmanager
+    def _activate(self, span: Span) -> Iterator[Span]:
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            # 包括被动回复超时导致的取消
+            span.fail(f"{type(e).__name__}: {e}" if str(e) else type(e).__name__)
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            _current_span.reset(token)
+            self.exporter.export(span)
+
+    @contextmanager
+    def trace(self, name: str, kind: int = KIND_SERVER, traceparent: Optional[str] = None,
+              msg_id: Optional[str] = None, **attributes: Any) -> Iterator[Optional[Span]]:
+        """开始一条新链路（或从traceparent继续），未启用追踪时返回None"""
+        if not config.tracing.enabled:
+            yield None
+            return
+        parent = parse_traceparent(traceparent) if traceparent else None
+        trace_id, parent_id = parent or (f"{random.getrandbits(128):032x}", None)
+        span = Span(trace_id, parent_id, name, kind, attributes)
+        if msg_id:
+            self.bind_msg_id(msg_id, span)
+        with self._activate(span):
+            yield span
+
+    @contextmanager
+    def span(self, name: str, kind: int = KIND_INTERNAL, **attributes: Any) -> Iterator[Optional[Span]]:
+        """当前链路下的子阶段，不在链路中时不记录并返回None"""
+        parent = _current_span.get()
+        if parent is None:
+            yield None
+            return
+        with self._activate(Span(parent.trace_id, parent.span_id, name, kind, attributes)) as span:
+            yield span
+
+    def bind_msg_id(self, msg_id: str, span: Optional[Span] = None):
+        """把当前链路关联到消息ID，供 /api/traces/{msg_id} 查询"""
+        span = span or _current_span.get()
+        if span is None or not msg_id:
+            return
+        span.set_attribute("messaging.message.id", msg_id)
+        self.exporter.bind(msg_id, span.trace_id)
+
+    def set_attribute(self, key: str, value: Any):
+        """设置当前span的属性"""
+        span = _current_span.get()
+        if span is not None:
+            span.set_attribute(key, value)
+
+    def add_event(self, name: str, **attributes: Any):
+        """在当前span上记录一个时间点"""
+        span = _current_span.get()
+        if span is not None:
+            span.add_event(name, **attributes)
+
+    def traceparent(self) -> Optional[str]:
+        """当前span的W3C traceparent，用于跨进程传递"""
+        span = _current_span.get()
+        return f"00-{span.trace_id}-{span.span_id}-01" if span is not None else None
+
+def parse_traceparent(value: str) -> Optional[tuple]:
+    """解析W3C traceparent，返回 (trace_id, parent_span_id)"""
+    parts = value.split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return parts[1], parts[2]
+
+def traced(name: str, kind: int = KIND_INTERNAL):
+    """把协程函数的执行记录为当前链路下的一个span"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with tracer.span(name, kind):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# 全局链路追踪实例
+trace_exporter = RingBufferExporter()
+tracer = Tracer(trace_exporter)
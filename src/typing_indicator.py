@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+“对方正在输入”状态
+
+后台生成回复期间，通过客服消息 custom/typing 接口定期下发输入状态，让用户看到
+正在处理而不是沉默。输入状态在微信端持续约15秒，这里按 typing_refresh_interval
+刷新：同一用户在间隔内不重复下发，全局按令牌桶限速，令牌不足时直接跳过本次刷新，
+不会排队或占用真正回复的发送。
+"""
+
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict
+from loguru import logger
+
+from .config import config
+
+TYPING = "Typing"
+CANCEL_TYPING = "CancelTyping"
+# 去重记录的用户数上限
+MAX_TRACKED_USERS = 10000
+
+# 发送输入状态命令的函数：(user_id, command) -> 是否成功
+TypingSender = Callable[[str, str], Awaitable[bool]]
+
+class TypingIndicator:
+    """限速、去重的输入状态发送器"""
+
+    def __init__(self, sender: TypingSender):
+        self.sender = sender
+        self._loops: Dict[str, asyncio.Task] = {}
+        self._last_sent: Dict[str, float] = {}
+        self._tokens = config.wechat_official.typing_rate_limit
+        self._refilled_at = time.monotonic()
+        self.sent = 0
+        self.skipped = 0
+
+    def _take_token(self) -> bool:
+        """全局令牌桶，每秒补充 typing_rate_limit 个令牌"""
+        rate = config.wechat_official.typing_rate_limit
+        now = time.monotonic()
+        self._tokens = min(rate, self._tokens + (now - self._refilled_at) * rate)
+        self._refilled_at = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    async def _send(self, user_id: str, command: str) -> bool:
+        """发送命令；因限速被跳过时返回False"""
+        if command == TYPING:
+            last_sent = self._last_sent.get(user_id, 0.0)
+            if time.monotonic() - last_sent < config.wechat_official.typing_refresh_interval:
+                return True
+        if not self._take_token():
+            self.skipped += 1
+            return False
+        if command == TYPING:
+            self._last_sent[user_id] = time.monotonic()
+        else:
+            self._last_sent.pop(user_id, None)
+        try:
+            if await self.sender(user_id, command):
+                self.sent += 1
+        except Exception as e:
+            logger.debug(f"输入状态发送失败: {e}")
+        return True
+
+    async def _refresh(self, user_id: str):
+        interval = config.wechat_official.typing_refresh_interval
+        while True:
+            # 被限速跳过时稍后重试，而不是等满一个刷新间隔
+            sent = await self._send(user_id, TYPING)
+            await asyncio.sleep(interval if sent else min(1.0, interval))
+
+    def start(self, user_id: str):
+        """开始为用户持续下发输入状态（已在进行时忽略）"""
+        if not config.wechat_official.typing_indicator:
+            return
+        if len(self._last_sent) > MAX_TRACKED_USERS:
+            # 清理已过期的去重记录
+            expire_before = time.monotonic() - config.wechat_official.typing_refresh_interval
+            self._last_sent = {uid: sent_at for uid, sent_at in self._last_sent.items() if sent_at >= expire_before}
+        task = self._loops.get(user_id)
+        if task is None or task.done():
+            self._loops[user_id] = asyncio.create_task(self._refresh(user_id))
+
+    def stop(self, user_id: str):
+        """停止刷新；真正的回复送达后微信端会自动结束输入状态"""
+        task = self._loops.pop(user_id, None)
+        if task is not None:
+            task.cancel()
+
+    async def cancel(self, user_id: str):
+        """停止刷新并显式取消输入状态（不会发送回复时使用）"""
+        self.stop(user_id)
+        if config.wechat_official.typing_indicator and user_id in self._last_sent:
+            await self._send(user_id, CANCEL_TYPING)
+
+    async def close(self):
+        """停止所有刷新任务"""
+        tasks = list(self._loops.values())
+        self._loops.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+公众号加密处理器和微信客户端
+
+按凭据缓存，公众号消息处理器和菜单管理器共用同一个客户端（共享access_token）。
+配置热加载修改凭据后，新请求按新凭据取得新对象，固定了旧配置快照的请求继续使用旧对象。
+wechatpy在首次创建时才导入，未启用公众号时不加载。
+
+公众号的access_token保存在会话Redis中：每次获取都会使之前的令牌失效，多个worker进程
+各自获取会互相顶掉对方的令牌。
+"""
+
+import json
+from functools import lru_cache
+from typing import Any, Dict, Optional
+
+from loguru import logger
+
+from .session_manager import session_manager
+
+# 访问令牌无效或过期的错误码
+TOKEN_INVALID_ERRCODES = {40001, 40014, 42001}
+
+class SharedTokenStorage:
+    """wechatpy会话存储：优先使用会话Redis（多个worker进程共享），不可用时退回进程内存储"""
+
+    def __init__(self, prefix: str = "wechatpy"):
+        self.prefix = prefix
+        self._memory: Dict[str, Any] = {}
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}:{key}"
+
+    def get(self, key: str, default: Any = None) -> Any:
+        redis_client = session_manager.redis_client
+        if redis_client is None:
+            return self._memory.get(key, default)
+        value = redis_client.get(self._key(key))
+        return json.loads(value) if value is not None else default
+
+    def set(self, key: str, value: Any, ttl: Optional[int] = None):
+        if value is None:
+            return
+        redis_client = session_manager.redis_client
+        if redis_client is None:
+            self._memory[key] = value
+        else:
+            redis_client.set(self._key(key), json.dumps(value), ex=ttl)
+
+    def delete(self, key: str):
+        redis_client = session_manager.redis_client
+        if redis_client is None:
+            self._memory.pop(key, None)
+        else:
+            redis_client.delete(self._key(key))
+
+@lru_cache(maxsize=4)
+def get_crypto(token: str, encoding_aes_key: str, app_id: str):
+    """消息加解密处理器（未配置EncodingAESKey时为None）"""
+    if not encoding_aes_key:
+        return None
+    from wechatpy.crypto import WeChatCrypto
+    return WeChatCrypto(token, encoding_aes_key, app_id)
+
+@lru_cache(maxsize=4)
+def get_wechat_client(app_id: str, app_secret: str) -> Optional["WeChatClient"]:
+    """微信客户端（未配置AppSecret或创建失败时为None）"""
+    if not (app_id and app_secret):
+        return None
+    try:
+        from wechatpy import WeChatClient
+        client = WeChatClient(app_id, app_secret, session=SharedTokenStorage())
+        logger.info("微信客户端初始化成功")
+        return client
+    except Exception as e:
+        logger.warning(f"微信客户端初始化失败: {e}")
+        return None
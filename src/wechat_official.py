@@ -7,50 +7,189 @@
 import asyncio
 import hashlib
 import time
+import httpx
 import xml.etree.ElementTree as ET
-from typing import Dict, Any, Optional, Set
+from typing import Dict, Any, Optional
 from fastapi import Request, HTTPException
 from loguru import logger
-from wechatpy import WeChatClient
-from wechatpy.crypto import WeChatCrypto
-from wechatpy.exceptions import InvalidSignatureException
 
 from .config import config
-from .dify_client import dify_client
+from .scheduler import Priority
+from .admission import admission_controller
+from .keyword_router import keyword_router
+from .faq_cache import faq_cache
+from .dify_router import dify_router, Route
 from .session_manager import session_manager
 from .menu_manager import menu_manager
+from .wechat_clients import get_crypto, get_wechat_client, TOKEN_INVALID_ERRCODES
+from .job_queue import job_queue, JobFailed, JOB_OFFICIAL_REPLY
+from .deadline import current_deadline, start_deadline, finalize_timer
+from .typing_indicator import TypingIndicator
+from .live_stats import live_stats
+from .tracing import tracer, traced, KIND_CLIENT
+from .structured_log import log_message_summary
+from .rate_limiter import rate_limiter, client_ip
+from .state_store import state_store, DEDUP_TTL
+from .metrics import (
+    registry, xml_parse_seconds, decrypt_seconds, reply_outcome_total,
+    reply_send_seconds, reply_send_errors_total
+)
+
+# 待取回的完整回复保留时间（秒）
+PENDING_RESPONSE_TTL = 600
+# "该用户已有异步回复任务"标记的过期时间，进程崩溃未清理时由过期兜底（秒）
+ASYNC_REPLY_TTL = 120
 
 class WeChatOfficialHandler:
     """微信公众号消息处理器"""
     
     def __init__(self):
-        self.token = config.wechat_official.token
-        self.app_id = config.wechat_official.app_id
-        self.app_secret = config.wechat_official.app_secret
-        self.encoding_aes_key = config.wechat_official.encoding_aeskey
-        
-        # 初始化加密处理器
-        if self.encoding_aes_key:
-            self.crypto = WeChatCrypto(self.token, self.encoding_aes_key, self.app_id)
-        else:
-            self.crypto = None
+        # 凭据从当前请求固定的配置快照读取；加密处理器和微信客户端按凭据缓存在 wechat_clients 中，
+        # 首次使用时创建（服务启动时由lifespan提前创建），未启用公众号时不导入wechatpy
         
-        # 初始化微信客户端（用于发送客服消息）
-        self.wechat_client = None
-        if self.app_id and self.app_secret:
-            try:
-                self.wechat_client = WeChatClient(self.app_id, self.app_secret)
-                logger.info("微信客户端初始化成功")
-            except Exception as e:
-                logger.warning(f"微信客户端初始化失败: {e}")
-            
-        # 消息去重缓存（存储最近处理的消息ID）
-        self.processed_messages: Set[str] = set()
-        self.max_cache_size = 1000
+        # 消息去重、待取回回复、异步任务标记保存在 state_store 中，多个worker进程共享
         
-        # 异步处理任务跟踪
+        # 本进程内的异步处理任务
         self.async_tasks: Dict[str, asyncio.Task] = {}
+        # 异步任务对应的原始消息，关闭时用于持久化未完成的任务
+        self.async_messages: Dict[str, Dict[str, Any]] = {}
+        # 关闭过程中不再启动新的进程内异步任务
+        self.accepting_async = True
+        
+        # 复用的HTTP连接池（客服消息）
+        self._http_client: Optional[httpx.AsyncClient] = None
+        
+        # 后台生成回复期间的“对方正在输入”状态
+        self.typing = TypingIndicator(self.send_typing_command)
+    
+    @property
+    def token(self) -> str:
+        return config.wechat_official.token
+    
+    @property
+    def app_id(self) -> str:
+        return config.wechat_official.app_id
+    
+    @property
+    def app_secret(self) -> str:
+        return config.wechat_official.app_secret
+    
+    @property
+    def encoding_aes_key(self) -> str:
+        return config.wechat_official.encoding_aeskey
+    
+    @property
+    def crypto(self):
+        """消息加解密处理器（未配置EncodingAESKey时为None）"""
+        return get_crypto(self.token, self.encoding_aes_key, self.app_id)
+    
+    @property
+    def wechat_client(self):
+        """微信客户端（用于发送客服消息，未配置AppSecret时为None）"""
+        return get_wechat_client(self.app_id, self.app_secret)
+    
+    def build_clients(self):
+        """提前创建加密处理器和微信客户端"""
+        return self.crypto, self.wechat_client
+    
+    def get_http_client(self) -> httpx.AsyncClient:
+        """获取共享的HTTP客户端（懒加载）"""
+        if self._http_client is None or self._http_client.is_closed:
+            self._http_client = httpx.AsyncClient(timeout=10.0)
+        return self._http_client
+    
+    async def close(self):
+        """停止输入状态刷新并关闭HTTP连接池"""
+        await self.typing.close()
+        if self._http_client is not None and not self._http_client.is_closed:
+            await self._http_client.aclose()
+        self._http_client = None
+    
+    async def warm_up(self) -> bool:
+        """预热：预取access_token并建立到微信API的连接"""
+        if not self.wechat_client:
+            return False
+        access_token = await self.get_access_token()
+        await self.get_http_client().get("https://api.weixin.qq.com/cgi-bin/getcallbackip",
+                                         params={"access_token": access_token})
+        return True
+    
+    async def get_access_token(self, invalid_token: Optional[str] = None) -> str:
+        """获取access_token（wechatpy是同步调用，放到线程中执行避免阻塞事件循环）
+        
+        invalid_token 为调用接口时被判定失效的令牌：共享存储中仍是该令牌时重新获取，
+        已被其他worker进程刷新时直接使用新令牌，避免各进程轮流获取互相顶掉。
+        """
+        client = self.wechat_client
+        
+        def load() -> str:
+            if invalid_token and client.session.get(client.access_token_key) == invalid_token:
+                client.fetch_access_token()
+            return client.access_token
+        
+        return await asyncio.to_thread(load)
+    
+    async def _post_api(self, path: str, data: Dict[str, Any], **kwargs) -> Dict[str, Any]:
+        """调用公众号接口，令牌失效时重新获取并重试一次"""
+        url = f"https://api.weixin.qq.com/cgi-bin/{path}"
+        access_token = await self.get_access_token()
+        response = await self.get_http_client().post(url, params={"access_token": access_token}, json=data, **kwargs)
+        result = response.json()
+        
+        if result.get('errcode') in TOKEN_INVALID_ERRCODES:
+            # 令牌失效（被其他系统刷新或已过期），重新获取后重试一次
+            logger.warning(f"公众号访问令牌失效: {result.get('errcode')}，重新获取")
+            access_token = await self.get_access_token(access_token)
+            response = await self.get_http_client().post(url, params={"access_token": access_token}, json=data, **kwargs)
+            result = response.json()
+        return result
+    
+    async def drain_async_tasks(self, grace_period: float):
+        """关闭时等待进行中的异步任务完成，超时未完成的任务持久化后取消"""
+        self.accepting_async = False
+        tasks = {user_id: task for user_id, task in self.async_tasks.items() if not task.done()}
+        if not tasks:
+            return
+        
+        logger.info(f"⏳ 等待 {len(tasks)} 个异步任务完成，最长 {grace_period} 秒")
+        await asyncio.wait(tasks.values(), timeout=grace_period)
+        
+        for user_id, task in tasks.items():
+            if task.done():
+                continue
+            message = self.async_messages.get(user_id)
+            await self.persist_async_task(message, user_id)
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+    
+    async def persist_async_task(self, message: Optional[Dict[str, Any]], user_id: str):
+        """持久化未完成的异步任务：写入任务队列，队列不可用时缓存提示语"""
+        if message and job_queue.enabled:
+            entry_id = await job_queue.enqueue(
+                JOB_OFFICIAL_REPLY,
+                {"message": message, "user_id": user_id}
+            )
+            if entry_id:
+                logger.info(f"💾 未完成的异步任务已写入队列，用户: {user_id}")
+                return
+        
+        await self.cache_complete_response(
+            user_id,
+            "抱歉，服务刚刚重启，上一个问题没来得及回答完，请重新发送一次。"
+        )
+        logger.warning(f"⚠️ 异步任务未完成，已缓存重试提示，用户: {user_id}")
+    
+    async def send_typing_command(self, user_id: str, command: str) -> bool:
+        """下发客服输入状态（Typing / CancelTyping）"""
+        if not self.wechat_client:
+            return False
+        result = await self._post_api("message/custom/typing", {"touser": user_id, "command": command}, timeout=3.0)
+        if result.get('errcode') != 0:
+            logger.debug(f"输入状态下发失败: {result}")
+            return False
+        return True
     
+    @traced("official.send_customer_service_message", KIND_CLIENT)
     async def send_customer_service_message(self, user_id: str, content: str) -> bool:
         """发送客服消息"""
         if not self.wechat_client:
@@ -58,18 +197,6 @@ class WeChatOfficialHandler:
             return False
         
         try:
-            # 使用异步方式发送客服消息
-            import httpx
-            
-            logger.info(f"🔑 开始获取access_token...")
-            # 获取access_token
-            access_token = self.wechat_client.access_token
-            logger.info(f"✅ 获取access_token成功: {access_token[:20]}...")
-            
-            # 构建客服消息API URL
-            url = f"https://api.weixin.qq.com/cgi-bin/message/custom/send?access_token={access_token}"
-            logger.info(f"🌐 客服消息API URL: {url[:80]}...")
-            
             # 构建消息数据
             data = {
                 "touser": user_id,
@@ -78,25 +205,25 @@ class WeChatOfficialHandler:
                     "content": content
                 }
             }
-            logger.info(f"📦 消息数据: {data}")
+            logger.debug("客服消息数据: {}", data)
             
             # 发送HTTP请求
-            logger.info("🚀 开始发送HTTP请求...")
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.post(url, json=data)
-                logger.info(f"📡 HTTP响应状态: {response.status_code}")
-                
-                result = response.json()
-                logger.info(f"📄 API响应结果: {result}")
+            with reply_send_seconds.time("official"):
+                result = await self._post_api("message/custom/send", data)
+            
+            logger.debug("客服消息API响应: {}", result)
+            
+            tracer.set_attribute("wechat.errcode", result.get('errcode'))
+            if result.get('errcode') == 0:
+                logger.debug(f"客服消息发送成功，用户: {user_id}")
+                return True
+            else:
+                reply_send_errors_total.inc("official", str(result.get('errcode')))
+                logger.error(f"❌ 客服消息发送失败: {result}")
+                return False
                 
-                if result.get('errcode') == 0:
-                    logger.info(f"✅ 客服消息发送成功，用户: {user_id}")
-                    return True
-                else:
-                    logger.error(f"❌ 客服消息发送失败: {result}")
-                    return False
-                    
         except Exception as e:
+            reply_send_errors_total.inc("official", "exception")
             logger.error(f"💥 客服消息发送异常: {e}")
             import traceback
             logger.error(f"异常详情: {traceback.format_exc()}")
@@ -107,35 +234,19 @@ class WeChatOfficialHandler:
         try:
             logger.info(f"🚀 开始异步处理消息，用户: {user_id}")
             
-            content = message.get('Content', '').strip()
+            content = self.chat_content(message)
             logger.info(f"📝 异步处理消息内容: {content[:50]}...")
             
-            # 获取会话ID
-            conversation_id = await session_manager.get_conversation_id(user_id)
-            logger.info(f"🔗 获取会话ID: {conversation_id}")
-            
-            # 调用Dify API（使用更长的超时时间）
-            original_timeout = dify_client.timeout
-            dify_client.timeout = 60  # 异步处理时使用60秒超时，给Dify充分时间
-            logger.info(f"⏰ 设置Dify超时时间: {dify_client.timeout}秒")
-            
+            # 调用Dify API（流式模式读取超时60秒，给Dify充分时间）
             logger.info("📡 开始调用Dify API（流式模式）...")
-            result = await dify_client.chat_completion_streaming(
+            result = await dify_router.chat(
                 message=content,
                 user_id=user_id,
-                conversation_id=conversation_id
+                priority=Priority.BACKGROUND
             )
             logger.info("✅ Dify API流式调用完成")
             
-            # 恢复原始超时设置
-            dify_client.timeout = original_timeout
-            
-            # 保存会话ID
             if result.get('conversation_id'):
-                await session_manager.set_conversation_id(
-                    user_id, 
-                    result['conversation_id']
-                )
                 logger.info(f"💾 保存会话ID: {result['conversation_id']}")
             
             # 获取回复内容
@@ -240,100 +351,39 @@ class WeChatOfficialHandler:
         event_key = message.get('EventKey', '')
         logger.info(f"处理菜单点击事件: {event_key}, 用户: {from_user}")
         
-        if event_key == 'AI_CHAT' or event_key == 'START_CHAT':
-            response_text = "🤖 AI助手已准备就绪！\n\n请直接发送消息开始对话：\n• 问我任何问题\n• 寻求建议和帮助\n• 进行有趣的聊天\n\n我会尽我所能为你提供帮助！ ✨"
-            
-        elif event_key == 'CLEAR_HISTORY':
-            # 清除用户会话历史
-            try:
-                await session_manager.clear_conversation(from_user)
-                response_text = "🔄 会话历史已清除！\n\n你现在可以开始一个全新的对话。之前的聊天记录已被清空，我将不会记住之前的对话内容。"
-            except Exception as e:
-                logger.error(f"清除会话历史失败: {e}")
-                response_text = "❌ 清除历史记录时发生错误，请稍后再试。"
-        
-        elif event_key == 'HELP_INFO':
-            response_text = """ℹ️ 使用帮助
-
-🤖 我是基于Dify的AI智能助手，具有以下功能：
-
-💬 **对话功能**
-• 直接发送文字消息与我对话
-• 支持多轮连续对话
-• 记住对话上下文
-
-🔧 **菜单功能**  
-• 🤖 AI助手：快速开始对话
-• 🔄 清除历史：清空聊天记录
-• ℹ️ 使用帮助：查看此帮助信息
-
-⚡ **使用技巧**
-• 可以问我任何问题
-• 支持中英文对话
-• 回复会在5秒内送达
-
-有问题随时问我哦！ 😊"""
-        
-        elif event_key == 'CONTACT_SERVICE':
-            response_text = "📞 联系客服\n\n如需人工客服帮助，请：\n• 发送「人工客服」关键词\n• 或添加客服微信：your-service-wechat\n• 或发送邮件至：service@yourcompany.com\n\n我们将尽快为您提供帮助！"
-        
-        elif event_key == 'ABOUT_US':
-            response_text = """⭐ 关于我们
-
-🚀 **项目简介**
-Dify2WeChat是一个开源的微信AI接入方案，让AI助手轻松融入微信生态。
-
-🛠️ **技术特点**
-• 基于Dify AI平台
-• 支持微信公众号和企业微信
-• 高性能异步处理
-• 完善的会话管理
-
-🌟 **开源地址**
-GitHub: dify2wechat
-
-💪 让AI更好地服务每一个人！"""
-        
-        else:
-            # 未知菜单事件
-            response_text = f"🤔 收到菜单点击事件：{event_key}\n\n请直接发送消息与我对话，或使用菜单中的其他功能。"
-        
+        response_text = await menu_manager.get_click_reply(event_key, from_user)
         return self.create_text_response(from_user, to_user, response_text)
     
-    async def async_complete_response(self, message: Dict[str, Any], user_id: str):
-        """异步完成完整回复（等待超时后继续处理）"""
+    @traced("official.async_complete_response")
+    async def async_complete_response(self, message: Dict[str, Any], user_id: str, retryable: bool = False) -> str:
+        """
+        异步完成完整回复（等待超时后继续处理）
+        
+        retryable 为True时（任务队列），Dify调用失败或处理异常时抛出异常交给队列重试，
+        不给用户发送错误提示。返回处理结果（sent / cached / too_short / error / cancelled）。
+        """
+        started_at = time.perf_counter()
+        outcome = "cancelled"
+        reply_chars = 0
         try:
-            logger.info(f"🔄 异步完整回复开始，用户: {user_id}")
-            
-            content = message.get('Content', '').strip()
+            content = self.chat_content(message)
             
-            # 获取会话ID
-            conversation_id = await session_manager.get_conversation_id(user_id)
-            
-            # 使用更长的超时时间进行完整处理
-            original_timeout = dify_client.timeout
-            dify_client.timeout = 60  # 异步处理时使用60秒超时，给Dify充分时间
-            
-            logger.info(f"📡 异步调用Dify API获取完整回复...")
-            # 清除之前的部分回复缓存，重新开始
-            if user_id in dify_client.partial_responses:
-                del dify_client.partial_responses[user_id]
-            
-            result = await dify_client.chat_completion_streaming(
-                message=content,
-                user_id=user_id,
-                conversation_id=conversation_id
-            )
+            # 生成期间持续显示“对方正在输入”，发送回复前停止刷新
+            self.typing.start(user_id)
+            try:
+                result = await dify_router.chat(
+                    message=content,
+                    user_id=user_id,
+                    priority=Priority.BACKGROUND
+                )
+            finally:
+                self.typing.stop(user_id)
             
-            # 恢复原始超时设置
-            dify_client.timeout = original_timeout
+            if retryable and not result.get('success'):
+                raise JobFailed(f"Dify调用失败: {result.get('error', '')}")
             
-            # 保存会话ID
-            if result.get('conversation_id'):
-                await session_manager.set_conversation_id(
-                    user_id, 
-                    result['conversation_id']
-                )
+            if result.get('success') and not result.get('partial'):
+                faq_cache.remember(content, result.get('answer', ''), result['context_free'])
             
             # 获取完整回复内容
             full_reply = result.get('answer', '抱歉，完整回复获取失败。')
@@ -349,20 +399,26 @@ GitHub: dify2wechat
                     reply_content = reply_content[:max_length] + "...\n\n💡 回复内容较长，已截断显示"
                 
                 # 尝试通过客服消息发送
-                logger.info(f"📤 尝试通过客服消息发送完整回复，长度: {len(full_reply)}")
+                reply_chars = len(reply_content)
                 success = await self.send_customer_service_message(user_id, reply_content)
                 
                 if success:
-                    logger.info(f"✅ 完整回复通过客服消息发送成功，用户: {user_id}")
+                    outcome = "sent"
                 else:
+                    outcome = "cached"
                     logger.warning(f"⚠️ 客服消息发送失败，将完整回复保存到缓存")
                     # 保存到缓存，用户下次发消息时自动推送
                     await self.cache_complete_response(user_id, reply_content)
             else:
+                outcome = "too_short"
                 logger.warning(f"⚠️ 异步获取的回复内容太短，跳过发送")
+                await self.typing.cancel(user_id)
                 
         except Exception as e:
+            outcome = "error"
             logger.error(f"💥 异步完整回复异常: {e}")
+            if retryable:
+                raise
             # 发送错误提示（如果客服消息可用）或缓存错误信息
             error_msg = "抱歉，在生成详细回复时遇到了问题。您可以重新提问或换个问题试试。"
             
@@ -372,58 +428,70 @@ GitHub: dify2wechat
                 
         finally:
             # 清理任务记录
-            if user_id in self.async_tasks:
-                del self.async_tasks[user_id]
-                logger.info(f"🧹 清理异步任务记录，用户: {user_id}")
+            self.async_messages.pop(user_id, None)
+            self.async_tasks.pop(user_id, None)
+            await state_store.delete("async_reply", user_id)
+            log_message_summary(
+                "公众号异步回复", channel="official",
+                msg_id=message.get('MsgId', ''), user=user_id, outcome=outcome,
+                reply_chars=reply_chars, elapsed_ms=round((time.perf_counter() - started_at) * 1000, 1)
+            )
+        return outcome
+    
+    def chat_content(self, message: Dict[str, Any]) -> str:
+        """文本消息中交给关键词匹配、FAQ缓存和Dify的内容（去除首尾空白和群聊触发词）"""
+        content = (message.get('Content') or '').strip()
+        # 微信公众号默认不需要@bot触发（因为是私聊）
+        # 如果启用了群聊模式且有触发词，则移除触发词；私聊模式下没有触发词也正常处理
+        trigger = config.message.group_trigger
+        if config.message.enable_group and trigger and content.startswith(trigger):
+            content = content[len(trigger):].strip()
+        return content
+    
+    def skip_passive_reply(self, is_chat: bool) -> bool:
+        """队列模式且关闭被动回复尝试时，文本消息直接入队"""
+        return job_queue.enabled and not config.queue.passive_attempt and is_chat
+    
+    async def start_async_reply(self, message: Dict[str, Any], user_id: str):
+        """启动异步完整回复：优先写入任务队列由worker处理，否则在本进程内执行"""
+        if job_queue.enabled:
+            entry_id = await job_queue.enqueue(
+                JOB_OFFICIAL_REPLY,
+                {"message": message, "user_id": user_id}
+            )
+            if entry_id:
+                return
+            logger.warning("任务队列不可用，降级为进程内异步处理")
+        
+        if not self.accepting_async:
+            # 服务正在关闭，直接持久化
+            await self.persist_async_task(message, user_id)
+        elif await state_store.add("async_reply", user_id, ASYNC_REPLY_TTL):
+            logger.info(f"🚀 启动异步完整处理任务，用户: {user_id}")
+            self.async_messages[user_id] = message
+            self.async_tasks[user_id] = asyncio.create_task(
+                self.async_complete_response(message, user_id)
+            )
+        else:
+            logger.info(f"⚠️ 用户 {user_id} 已有异步任务在运行")
     
     async def cache_complete_response(self, user_id: str, response: str):
-        """缓存完整回复，供下次用户交互时使用"""
+        """缓存完整回复，供下次用户交互时使用（有效期10分钟）"""
         try:
-            cache_key = f"pending_response:{user_id}"
-            # 使用会话管理器的Redis缓存
-            if hasattr(session_manager, 'redis_client') and session_manager.redis_client:
-                # 存储到Redis，有效期10分钟
-                import json
-                cache_data = {
-                    'response': response,
-                    'timestamp': time.time()
-                }
-                session_manager.redis_client.setex(cache_key, 600, json.dumps(cache_data))
-                logger.info(f"💾 完整回复已缓存，用户: {user_id}")
-            else:
-                # 存储到内存
-                if not hasattr(self, 'pending_responses'):
-                    self.pending_responses = {}
-                self.pending_responses[user_id] = {
-                    'response': response,
-                    'timestamp': time.time()
-                }
-                logger.info(f"💾 完整回复已存储到内存缓存，用户: {user_id}")
+            await state_store.put(
+                "pending_response", user_id,
+                {'response': response, 'timestamp': time.time()},
+                PENDING_RESPONSE_TTL
+            )
+            logger.info(f"💾 完整回复已缓存，用户: {user_id}")
         except Exception as e:
             logger.error(f"缓存完整回复失败: {e}")
     
     async def get_cached_response(self, user_id: str) -> str:
-        """获取缓存的完整回复"""
+        """获取缓存的完整回复（获取后删除）"""
         try:
-            cache_key = f"pending_response:{user_id}"
-            cached_response = ""
-            
-            # 从Redis获取
-            if hasattr(session_manager, 'redis_client') and session_manager.redis_client:
-                import json
-                cache_data = session_manager.redis_client.get(cache_key)
-                if cache_data:
-                    data = json.loads(cache_data)
-                    cached_response = data.get('response', '')
-                    # 获取后删除缓存
-                    session_manager.redis_client.delete(cache_key)
-            else:
-                # 从内存获取
-                if hasattr(self, 'pending_responses') and user_id in self.pending_responses:
-                    cached_response = self.pending_responses[user_id].get('response', '')
-                    # 获取后删除缓存
-                    del self.pending_responses[user_id]
-            
+            data = await state_store.pop("pending_response", user_id)
+            cached_response = data.get('response', '') if data else ""
             if cached_response:
                 logger.info(f"📥 获取到缓存的完整回复，用户: {user_id}")
                 return cached_response
@@ -433,19 +501,25 @@ GitHub: dify2wechat
         
         return ""
     
-    async def handle_message(self, message: Dict[str, Any]) -> str:
-        """处理微信消息"""
+    @traced("official.handle_message")
+    async def handle_message(self, message: Dict[str, Any], route: Optional[Route] = None,
+                             keyword_rule: Optional[Dict[str, Any]] = None) -> str:
+        """处理微信消息
+
+        关键词匹配在入口处对 chat_content 完成一次，命中的规则通过 keyword_rule 传入；
+        route 为被动回复路径上已做出的路由决策。
+        """
         try:
             msg_type = message.get('MsgType', '')
             from_user = message.get('FromUserName', '')
             to_user = message.get('ToUserName', '')
             
-            logger.info(f"处理消息类型: {msg_type}, 来自: {from_user}")
+            logger.debug(f"处理消息类型: {msg_type}, 来自: {from_user}")
             
             # 处理事件消息
             if msg_type == 'event':
                 event_type = message.get('Event', '')
-                logger.info(f"收到事件: {event_type}")
+                logger.debug(f"收到事件: {event_type}")
                 
                 if event_type == 'subscribe':
                     # 关注事件
@@ -469,25 +543,16 @@ GitHub: dify2wechat
             
             # 处理文本消息
             elif msg_type == 'text':
-                content = message.get('Content', '').strip()
+                content = self.chat_content(message)
                 if not content:
                     return self.create_text_response(
                         from_user, to_user,
                         "请发送文本消息与我对话。"
                     )
                 
-                logger.info(f"收到文本消息: {content}")
+                logger.debug("收到文本消息: {}", content)
                 
-                # 检查是否有缓存的完整回复
-                cached_response = await self.get_cached_response(from_user)
-                if cached_response:
-                    logger.info(f"💾 找到缓存的完整回复，优先返回")
-                    return self.create_text_response(
-                        from_user, to_user, 
-                        f"📨 之前为您准备的完整回复：\n\n{cached_response}"
-                    )
-                
-                # 继续处理文本消息，不返回
+                # 缓存的完整回复已在入口处优先检查，继续处理文本消息，不返回
             
             # 处理其他类型消息（图片、语音等）
             else:
@@ -498,26 +563,23 @@ GitHub: dify2wechat
             
             # 如果到这里，说明是text消息且有内容，准备调用AI
             
-            # 微信公众号默认不需要@bot触发（因为是私聊）
-            # 如果启用了群聊模式且有触发词，则检查触发
-            if config.message.enable_group and config.message.group_trigger:
-                trigger = config.message.group_trigger
-                if content.startswith(trigger):
-                    # 移除触发词
-                    content = content[len(trigger):].strip()
-                # 微信公众号私聊模式下，即使有触发词配置也正常处理
+            # 关键词快速回复，不经过Dify
+            if keyword_rule is not None:
+                keyword_reply = await keyword_router.reply(keyword_rule, from_user)
+                return self.create_text_response(from_user, to_user, keyword_reply)
             
-            # 获取会话ID
-            conversation_id = await session_manager.get_conversation_id(from_user)
+            # 被动回复预算不足时不再发起Dify调用，由上层转入异步回复
+            deadline = current_deadline()
+            if deadline is not None and config.message.adaptive_budget and deadline.check("前置处理") <= 0:
+                raise asyncio.TimeoutError("被动回复预算已耗尽")
             
             # 统一使用流式模式，提升响应速度
-            content_length = len(content)
-            logger.info(f"使用流式模式处理消息，长度: {content_length}")
-            
-            result = await dify_client.chat_completion_streaming(
+            # 被动回复需要在窗口内完成，路由时考虑各应用的首字节耗时
+            result = await dify_router.chat(
                 message=content,
                 user_id=from_user,
-                conversation_id=conversation_id
+                latency_sensitive=True,
+                route=route
             )
             
             # 检查是否是部分回复（超时情况）
@@ -526,12 +588,8 @@ GitHub: dify2wechat
                 # 抛出超时异常，让上层处理异步任务
                 raise asyncio.TimeoutError("Dify API超时，返回部分内容")
             
-            # 保存会话ID
-            if result.get('conversation_id'):
-                await session_manager.set_conversation_id(
-                    from_user, 
-                    result['conversation_id']
-                )
+            if result.get('success'):
+                faq_cache.remember(content, result.get('answer', ''), result['context_free'])
             
             # 返回回复
             reply_content = result.get('answer', '抱歉，我暂时无法回复。')
@@ -541,14 +599,8 @@ GitHub: dify2wechat
             if len(reply_content) > max_length:
                 reply_content = reply_content[:max_length] + "..."
             
-            logger.info(f"公众号消息处理完成，用户: {from_user}, 回复: {reply_content[:50]}...")
-            logger.info(f"🔍 调试：即将返回的reply_content长度: {len(reply_content)}")
-            
-            final_response = self.create_text_response(from_user, to_user, reply_content)
-            logger.info(f"🔍 调试：create_text_response返回的XML长度: {len(final_response)}")
-            logger.info(f"🔍 调试：create_text_response返回的XML预览: {final_response[:300]}")
-            
-            return final_response
+            logger.debug("公众号回复内容: {}", reply_content)
+            return self.create_text_response(from_user, to_user, reply_content)
             
         except asyncio.TimeoutError:
             # 重新抛出超时异常，让上层处理
@@ -581,30 +633,36 @@ GitHub: dify2wechat
             
             # POST请求处理消息
             elif request.method == "POST":
+                # 中间件在请求到达时已创建截止时间
+                deadline = getattr(request.state, 'deadline', None) or current_deadline() or start_deadline()
+                
                 # 获取请求参数
                 signature = request.query_params.get('signature', '')
                 timestamp = request.query_params.get('timestamp', '')
                 nonce = request.query_params.get('nonce', '')
                 msg_signature = request.query_params.get('msg_signature', '')
                 encrypt_type = request.query_params.get('encrypt_type', '')
+                # 整个请求使用同一个加密处理器，配置热加载不影响进行中的请求
+                crypto = self.crypto
                 
                 # 读取消息体
                 body = await request.body()
                 xml_data = body.decode('utf-8')
                 
-                logger.info(f"收到POST请求，加密类型: {encrypt_type}")
-                logger.debug(f"原始XML数据: {xml_data}")
+                logger.debug("原始XML数据: {}", xml_data)
                 
                 # 处理加密消息
-                if encrypt_type == 'aes' and self.crypto:
+                if encrypt_type == 'aes' and crypto:
+                    from wechatpy.exceptions import InvalidSignatureException
                     try:
                         # 解密消息
-                        decrypted_xml = self.crypto.decrypt_message(
-                            xml_data, msg_signature, timestamp, nonce
-                        )
-                        logger.info("消息解密成功")
-                        logger.debug(f"解密后XML: {decrypted_xml}")
+                        with decrypt_seconds.time("official"), tracer.span("decrypt"):
+                            decrypted_xml = crypto.decrypt_message(
+                                xml_data, msg_signature, timestamp, nonce
+                            )
+                        logger.debug("解密后XML: {}", decrypted_xml)
                         xml_data = decrypted_xml
+                        deadline.check("解密")
                     except InvalidSignatureException as e:
                         logger.error(f"消息签名验证失败: {e}")
                         raise HTTPException(status_code=403, detail="消息签名验证失败")
@@ -613,80 +671,129 @@ GitHub: dify2wechat
                         raise HTTPException(status_code=400, detail="消息解密失败")
                 else:
                     # 明文消息，暂时跳过签名验证（微信明文模式签名机制不同）
-                    logger.info("明文模式消息，跳过签名验证")
+                    logger.debug("明文模式消息，跳过签名验证")
                 
                 # 解析消息
-                message = self.parse_xml_message(xml_data)
+                with xml_parse_seconds.time("official"), tracer.span("parse_xml"):
+                    message = self.parse_xml_message(xml_data)
                 
                 if not message:
                     logger.warning("消息解析为空")
                     return ""
                 
-                logger.info(f"收到微信消息: {message.get('MsgType', '')} from {message.get('FromUserName', '')}")
                 
                 # 消息去重检查
                 msg_id = message.get('MsgId', '')
-                if msg_id and msg_id in self.processed_messages:
+                if msg_id and not await state_store.add("processed:official", msg_id, DEDUP_TTL):
                     logger.info(f"消息已处理过，跳过: {msg_id}")
                     # 返回空响应，避免重复回复
                     from fastapi import Response
                     return Response(content="", media_type="text/xml")
                 
-                # 添加到已处理消息缓存
-                if msg_id:
-                    self.processed_messages.add(msg_id)
-                    # 限制缓存大小
-                    if len(self.processed_messages) > self.max_cache_size:
-                        # 移除一半的旧消息
-                        old_messages = list(self.processed_messages)[:self.max_cache_size // 2]
-                        for old_msg in old_messages:
-                            self.processed_messages.discard(old_msg)
+                # 关联链路，事件消息没有MsgId时用用户和时间标识
+                tracer.bind_msg_id(msg_id or f"{message.get('FromUserName', '')}:{message.get('CreateTime', '')}")
+                tracer.set_attribute("wechat.msg_type", message.get('MsgType', ''))
+                
+                # 超过频率限制的消息直接回复提示，不调用Dify、不读写会话
+                limited = await rate_limiter.check("official", message.get('FromUserName', ''), client_ip(request))
                 
                 # 微信要求5秒内响应，采用智能分层回复策略
+                finalize_start = None
+                outcome = "passive"
+                content_length = len(message.get('Content', ''))
+                timeout_duration = config.message.passive_reply_timeout
                 try:
-                    content_length = len(message.get('Content', ''))
-                    timeout_duration = 4.5  # 4.5秒超时，为异步处理留出时间
-                    
-                    logger.info(f"消息长度: {content_length}, 超时设置: {timeout_duration}秒")
-                    
                     from_user = message.get('FromUserName', '')
                     to_user = message.get('ToUserName', '')
                     
-                    # 智能分层回复策略
-                    import asyncio
-                    from .dify_client import dify_client
+                    # 关键词只匹配一次，与后续路由和Dify调用使用同一份去除触发词后的内容
+                    content = self.chat_content(message) if message.get('MsgType') == 'text' else ''
+                    keyword_rule = keyword_router.match(content) if content else None
+                    is_chat = bool(content) and keyword_rule is None
                     
-                    # 等待4.5秒看能否获得完整回复
-                    response = await asyncio.wait_for(
-                        self.handle_message(message), 
-                        timeout=timeout_duration
-                    )
+                    # 之前超时未取回的完整回复优先返回（先于关键词、FAQ缓存和各种转异步分支）
+                    pending_reply = await self.get_cached_response(from_user) if content and not limited else ""
+                    # 近似重复问题在被动回复窗口内直接返回缓存的回答，不经过排队和准入控制；
+                    # 查找与写入（remember）都使用 chat_content
+                    cached_reply = faq_cache.lookup(content) if is_chat and not limited and not pending_reply else None
                     
-                    # 如果在4.5秒内完成，直接返回，不需要异步处理
-                    logger.info(f"✅ 4.5秒内获得完整回复，直接返回")
-                    logger.info(f"🔍 调试：response变量内容预览: {response[:200] if response else 'None或空'}")
+                    if config.message.adaptive_budget:
+                        # 扣除读取、解密、去重、限流和待取回复查询等已用时间和序列化/加密预留后的剩余预算
+                        timeout_duration = deadline.check("前置检查")
+                    logger.debug(f"消息长度: {content_length}, 超时设置: {timeout_duration:.3f}秒")
+                    
+                    if limited:
+                        outcome = "rate_limited"
+                        response = self.create_text_response(from_user, to_user, config.security.rate_limit_reply)
+                    elif pending_reply:
+                        outcome = "pending_response"
+                        logger.info(f"💾 找到缓存的完整回复，优先返回")
+                        response = self.create_text_response(
+                            from_user, to_user,
+                            f"📨 之前为您准备的完整回复：\n\n{pending_reply}"
+                        )
+                    elif cached_reply is not None:
+                        outcome = "faq_cache"
+                        response = self.create_text_response(from_user, to_user, cached_reply)
+                    elif is_chat and timeout_duration <= 0:
+                        # 前置阶段已耗尽被动回复预算，直接转入异步回复
+                        logger.warning("⏱️ 被动回复预算已耗尽，直接转异步回复")
+                        outcome = "budget_exhausted"
+                        await self.start_async_reply(message, from_user)
+                        response = self.create_text_response(from_user, to_user, "🤔 我在思考中，请耐心等待...")
+                    elif self.skip_passive_reply(is_chat):
+                        # 队列模式下不尝试被动回复，文本消息直接交给worker
+                        logger.info("📮 队列模式，跳过被动回复直接入队")
+                        outcome = "queued"
+                        await self.start_async_reply(message, from_user)
+                        response = self.create_text_response(from_user, to_user, "🤔 我在思考中，请耐心等待...")
+                    elif is_chat and not admission_controller.admit(timeout_duration):
+                        # 预估排队时间已超过被动回复窗口，立即回复繁忙提示并转入异步回复
+                        outcome = "shed"
+                        await self.start_async_reply(message, from_user)
+                        response = self.create_text_response(from_user, to_user, config.admission.busy_reply)
+                    else:
+                        # 路由决策（含会话读取）只做一次，预测和后续Dify调用共用
+                        route = await dify_router.route(content, from_user, latency_sensitive=True) if is_chat else None
+                        if route is not None and config.message.adaptive_budget:
+                            # 路由读取会话也占用被动回复窗口，等待回复前重新计算剩余预算
+                            timeout_duration = deadline.check("路由")
+                        if is_chat and timeout_duration <= 0:
+                            logger.warning("⏱️ 被动回复预算已耗尽，直接转异步回复")
+                            outcome = "budget_exhausted"
+                            await self.start_async_reply(message, from_user)
+                            response = self.create_text_response(from_user, to_user, "🤔 我在思考中，请耐心等待...")
+                        elif route is not None and dify_router.predict_timeout(content, from_user, route):
+                            # 预测无法在被动回复窗口内完成，不再等满4.5秒，立即回复等待提示并转入异步回复
+                            outcome = "predicted_slow"
+                            await self.start_async_reply(message, from_user)
+                            response = self.create_text_response(from_user, to_user, "🤔 我在思考中，请耐心等待...")
+                        else:
+                            # 在剩余预算内等待完整回复
+                            response = await asyncio.wait_for(
+                                self.handle_message(message, route, keyword_rule), 
+                                # 非对话消息（菜单、关注等）不会转异步，预算耗尽时仍给出最短等待时间
+                                timeout=timeout_duration if is_chat else max(timeout_duration, 0.5)
+                            )
+                            # 在窗口内完成，直接返回，不需要异步处理
+                            finalize_start = time.perf_counter()
                     
                 except asyncio.TimeoutError:
-                    logger.warning("🔔 4.5秒内未能完成，切换到等待提示模式")
+                    finalize_start = time.perf_counter()
+                    outcome = "async"
+                    logger.warning(f"🔔 {timeout_duration:.2f}秒内未能完成，切换到等待提示模式")
                 
                     # 不显示部分回复内容，直接提供等待提示
                     reply_content = "🤔 我在思考中，请耐心等待..."
-                    logger.info(f"回复超时，提示用户等待")
                     
                     # 启动异步完整处理任务
-                    if from_user not in self.async_tasks:
-                        logger.info(f"🚀 启动异步完整处理任务，用户: {from_user}")
-                        self.async_tasks[from_user] = asyncio.create_task(
-                            self.async_complete_response(message, from_user)
-                        )
-                    else:
-                        logger.info(f"⚠️ 用户 {from_user} 已有异步任务在运行")
+                    await self.start_async_reply(message, from_user)
                     
                     response = self.create_text_response(from_user, to_user, reply_content)
-                    logger.info(f"🔍 调试：超时情况下response内容: {response[:200] if response else 'None或空'}")
                     
                 except Exception as e:
                     logger.error(f"💥 消息处理异常: {e}")
+                    outcome = "error"
                     # 发生异常时也提供友好回复
                     from_user = message.get('FromUserName', '')
                     to_user = message.get('ToUserName', '')
@@ -694,33 +801,43 @@ GitHub: dify2wechat
                         from_user, to_user, 
                         "抱歉，处理您的消息时遇到了问题，请稍后再试。"
                     )
-                    logger.info(f"🔍 调试：异常情况下response内容: {response[:200] if response else 'None或空'}")
                 
-                logger.info(f"准备返回回复，长度: {len(response)}")
-                logger.info(f"回复XML内容: {response}")
+                logger.debug("回复XML: {}", response)
                 
                 # 如果是加密模式，需要加密回复
-                if encrypt_type == 'aes' and self.crypto:
+                body = response
+                if encrypt_type == 'aes' and crypto:
                     try:
-                        encrypted_response = self.crypto.encrypt_message(response, nonce, timestamp)
-                        logger.info("回复消息加密成功")
-                        logger.info(f"最终返回加密响应，长度: {len(encrypted_response)}")
-                        from fastapi import Response
-                        return Response(content=encrypted_response, media_type="text/xml")
+                        with tracer.span("encrypt"):
+                            body = crypto.encrypt_message(response, nonce, timestamp)
                     except Exception as e:
-                        logger.error(f"回复消息加密失败: {e}")
-                        logger.info(f"返回明文响应: {response}")
-                        from fastapi import Response
-                        return Response(content=response, media_type="text/xml")
+                        logger.error(f"回复消息加密失败，返回明文响应: {e}")
+                
+                # 记录等待结束后的序列化和加密耗时，用于调整下次的预留时间
+                if finalize_start is not None:
+                    finalize_timer.record(time.perf_counter() - finalize_start)
+                reply_outcome_total.inc("official", outcome)
+                live_stats.record_outcome(outcome)
+                tracer.set_attribute("reply.outcome", outcome)
+                log_message_summary(
+                    "公众号消息", channel="official", msg_id=msg_id, user=message.get('FromUserName', ''),
+                    msg_type=message.get('MsgType', ''), outcome=outcome, content_chars=content_length,
+                    reply_bytes=len(body), encrypted=body is not response,
+                    elapsed_ms=round(deadline.elapsed() * 1000, 1)
+                )
                 
-                logger.info(f"最终返回明文响应: {response}")
                 # 返回XML响应，设置正确的Content-Type
                 from fastapi import Response
-                return Response(content=response, media_type="text/xml")
+                return Response(content=body, media_type="text/xml")
                 
         except Exception as e:
             logger.error(f"Webhook处理异常: {e}")
             raise HTTPException(status_code=500, detail="内部服务器错误")
 
 # 全局微信公众号处理器实例
-wechat_official_handler = WeChatOfficialHandler() 
\ No newline at end of file
+wechat_official_handler = WeChatOfficialHandler()
+
+registry.gauge(
+    "dify2wechat_official_async_tasks", "公众号进行中的异步回复任务数", (),
+    lambda: [((), sum(1 for task in wechat_official_handler.async_tasks.values() if not task.done()))]
+)
@@ -4,90 +4,497 @@
 企业微信处理模块
 """
 
+import asyncio
 import hashlib
+import os
 import time
 import json
+import uuid
 import xml.etree.ElementTree as ET
-from typing import Dict, Any, Optional
+from typing import Awaitable, Dict, Any, Optional, List, Set
 from fastapi import Request, HTTPException
 from loguru import logger
 import httpx
 
 from .config import config
-from .dify_client import dify_client
+from .scheduler import Priority
 from .session_manager import session_manager
+from .job_queue import job_queue, JobFailed, JOB_WORK_MESSAGE
+from .task_pool import BackgroundPool
+from .keyword_router import keyword_router
+from .faq_cache import faq_cache
+from .metrics import (
+    registry, xml_parse_seconds, reply_outcome_total, reply_send_seconds,
+    reply_send_errors_total, token_refresh_total
+)
+from .dify_router import dify_router
+from .tracing import tracer, traced, KIND_CLIENT
+from .structured_log import log_message_summary
+from .rate_limiter import rate_limiter, client_ip
+from .state_store import state_store, DEDUP_TTL
+from .wechat_clients import TOKEN_INVALID_ERRCODES
+
+# 只有锁仍属于自己时才删除：刷新耗时超过锁过期时间后，锁可能已被其他进程取得
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# message/send 单次请求的接收人数量上限
+BATCH_LIMITS = {'touser': 1000, 'toparty': 100, 'totag': 100}
+
+def _chunk(items: List[str], size: int) -> List[List[str]]:
+    """按固定大小切分列表"""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+# 流式推送时优先在这些字符处切分，避免把一句话拆成两条消息
+SENTENCE_BOUNDARIES = "。！？；\n.!?;"
+
+# 截止时间内未能开始生成回复时的提示
+REPLY_TIMEOUT_MESSAGE = "抱歉，当前咨询人数较多，回复超时，请稍后再试。"
+
+class StreamingReply:
+    """流式回复：按固定节奏把Dify新生成的内容增量推送给用户
+    
+    企业微信应用消息不支持原地更新，这里按 stream_flush_interval 节流发送增量片段，
+    并限制单条回复最多拆成 stream_max_messages 条，避免触发发送频率限制。
+    """
+    
+    def __init__(self, handler: "WorkWeChatHandler", user_id: str):
+        self.handler = handler
+        self.user_id = user_id
+        self.text = ""
+        self.sent_length = 0
+        self.sent_messages = 0
+        self._changed = asyncio.Event()
+        self._sending = False
+        self._closed = False
+        self._last_sent_at = 0.0
+    
+    def update(self, answer: str):
+        """Dify数据块回调：只记录最新内容，由flush循环负责发送"""
+        self.text = answer
+        self._changed.set()
+    
+    def _next_segment(self, final: bool) -> str:
+        """取出待发送片段：中间片段在句子边界处切分，最终片段发送全部剩余内容（超长时截断）"""
+        pending = self.text[self.sent_length:]
+        if final:
+            max_length = config.message.max_length
+            return pending if len(pending) <= max_length else pending[:max_length] + "..."
+        if len(pending) < config.work_wechat.stream_min_chars:
+            return ""
+        cut = max(pending.rfind(ch) for ch in SENTENCE_BOUNDARIES)
+        return pending[:cut + 1] if cut >= 0 else ""
+    
+    async def flush(self, final: bool = False):
+        """发送一个片段"""
+        # 为最终片段保留一条消息额度
+        if not final and self.sent_messages >= config.work_wechat.stream_max_messages - 1:
+            return
+        segment = self._next_segment(final)
+        if not segment.strip():
+            return
+        if final:
+            # 最终片段同样遵守推送间隔
+            wait = self._last_sent_at + config.work_wechat.stream_flush_interval - time.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+        # 最终片段可能被截断，按原文计已发送长度
+        self.sent_length = len(self.text) if final else self.sent_length + len(segment)
+        self.sent_messages += 1
+        self._sending = True
+        try:
+            await self.handler.send_message(self.user_id, segment.strip())
+        finally:
+            self._sending = False
+            self._last_sent_at = time.time()
+    
+    async def run(self):
+        """按节奏发送增量内容，直到close()"""
+        interval = config.work_wechat.stream_flush_interval
+        while not self._closed:
+            await self._changed.wait()
+            self._changed.clear()
+            if self._closed:
+                break
+            await self.flush()
+            await asyncio.sleep(interval)
+    
+    async def close(self, task: asyncio.Task):
+        """停止发送循环：正在发送的片段会等待其完成，不会被中途取消"""
+        self._closed = True
+        self._changed.set()
+        if not self._sending:
+            task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
 
 class WorkWeChatHandler:
     """企业微信消息处理器"""
     
     def __init__(self):
-        self.corp_id = config.work_wechat.corp_id
-        self.corp_secret = config.work_wechat.corp_secret
-        self.agent_id = config.work_wechat.agent_id
         self.access_token = None
         self.token_expires_at = 0
+        # 当前令牌对应的 token_cache_key，热加载修改凭据后与新key不一致，令牌视为无效
+        self._token_key: Optional[str] = None
+        # 进程内单飞锁，过期瞬间的并发请求只触发一次刷新
+        self._token_lock = asyncio.Lock()
+        self._token_refresher: Optional[asyncio.Task] = None
+        
+        # 复用的HTTP连接池
+        self._http_client: Optional[httpx.AsyncClient] = None
+        
+        # 后台处理池：回调立即返回，消息在后台处理后主动推送
+        self.pool = BackgroundPool(
+            "work_wechat",
+            workers=config.work_wechat.workers,
+            queue_size=config.work_wechat.queue_size
+        )
+        # 不经过任务池的提示发送任务（限流提示、任务池已满时的繁忙提示），保留引用避免被回收，关闭时等待发送完成
+        self._notice_tasks: Set[asyncio.Task] = set()
+    
+    # 凭据从当前请求固定的配置快照读取
+    @property
+    def corp_id(self) -> str:
+        return config.work_wechat.corp_id
+    
+    @property
+    def corp_secret(self) -> str:
+        return config.work_wechat.corp_secret
+    
+    @property
+    def agent_id(self) -> str:
+        return config.work_wechat.agent_id
+    
+    def get_http_client(self) -> httpx.AsyncClient:
+        """获取共享的HTTP客户端（懒加载）"""
+        if self._http_client is None or self._http_client.is_closed:
+            self._http_client = httpx.AsyncClient(timeout=10.0)
+        return self._http_client
+    
+    async def close(self):
+        """停止令牌刷新任务并关闭HTTP连接池"""
+        if self._token_refresher is not None:
+            self._token_refresher.cancel()
+            await asyncio.gather(self._token_refresher, return_exceptions=True)
+            self._token_refresher = None
+        if self._http_client is not None and not self._http_client.is_closed:
+            await self._http_client.aclose()
+        self._http_client = None
+    
+    def send_notice(self, send: Awaitable[Any]):
+        """在后台发送一条提示，不占用任务池"""
+        task = asyncio.create_task(send)
+        self._notice_tasks.add(task)
+        task.add_done_callback(self._notice_done)
+    
+    def _notice_done(self, task: asyncio.Task):
+        self._notice_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"发送提示失败: {task.exception()}")
+    
+    async def drain_notices(self, grace_period: float):
+        """关闭时等待进行中的提示发送完成，超时未完成的取消"""
+        tasks = set(self._notice_tasks)
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=grace_period)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    async def warm_up(self) -> bool:
+        """预热：预取访问令牌"""
+        if not (self.corp_id and self.corp_secret):
+            return False
+        await self.get_access_token()
+        return True
+    
+    @property
+    def token_cache_key(self) -> str:
+        return f"work_wechat:access_token:{self.corp_id}:{self.agent_id}"
+    
+    def _token_usable(self, expires_at: float) -> bool:
+        """令牌距过期还有 token_refresh_ahead 秒以上（提前量只在这里扣除，expires_at 为真实过期时间）"""
+        return time.time() < expires_at - config.work_wechat.token_refresh_ahead
+    
+    def _has_valid_token(self) -> bool:
+        """本地令牌属于当前凭据且未到刷新时间"""
+        return (bool(self.access_token) and self._token_key == self.token_cache_key
+                and self._token_usable(self.token_expires_at))
+    
+    def _shared_redis(self):
+        """Redis可用时返回异步客户端，用于多进程共享令牌"""
+        if session_manager.redis_client is None:
+            return None
+        return session_manager.get_async_redis()
+    
+    async def _load_shared_token(self, newer_than: float = 0) -> bool:
+        """从Redis加载其他进程刷新的令牌"""
+        redis_client = self._shared_redis()
+        if redis_client is None:
+            return False
+        token_key = self.token_cache_key
+        try:
+            data = await redis_client.get(token_key)
+            if not data:
+                return False
+            token_data = json.loads(data)
+            expires_at = token_data.get('expires_at', 0)
+            if expires_at <= newer_than or not self._token_usable(expires_at):
+                return False
+            self.access_token = token_data['access_token']
+            self.token_expires_at = expires_at
+            self._token_key = token_key
+            return True
+        except Exception as e:
+            logger.warning(f"读取共享访问令牌失败: {e}")
+            return False
+    
+    async def _fetch_access_token(self):
+        """请求企业微信gettoken接口"""
+        url = f"{config.work_wechat.api_base}/cgi-bin/gettoken"
+        token_key = self.token_cache_key
+        params = {
+            'corpid': self.corp_id,
+            'corpsecret': self.corp_secret
+        }
+        
+        response = await self.get_http_client().get(url, params=params)
+        result = response.json()
+        
+        if result.get('errcode') == 0:
+            token_refresh_total.inc("work")
+            self.access_token = result['access_token']
+            self.token_expires_at = time.time() + result['expires_in']
+            self._token_key = token_key
+            logger.info("企业微信访问令牌获取成功")
+        else:
+            logger.error(f"获取访问令牌失败: {result}")
+            raise Exception(f"获取访问令牌失败: {result.get('errmsg', '未知错误')}")
+    
+    async def refresh_access_token(self) -> str:
+        """刷新访问令牌，多进程间通过Redis锁保证同一时间只有一个进程请求gettoken"""
+        stale_expires_at = self.token_expires_at
+        redis_client = self._shared_redis()
+        lock_key = f"{self.token_cache_key}:lock"
+        lock_owner = f"{os.getpid()}-{uuid.uuid4().hex}"
+        holds_lock = False
+        
+        if redis_client is not None:
+            try:
+                holds_lock = bool(await redis_client.set(lock_key, lock_owner, nx=True, px=10000))
+            except Exception as e:
+                logger.warning(f"获取令牌刷新锁失败: {e}")
+            if not holds_lock:
+                # 其他进程正在刷新，等待其写入新令牌
+                for _ in range(50):
+                    await asyncio.sleep(0.1)
+                    if await self._load_shared_token(newer_than=stale_expires_at):
+                        return self.access_token
+                logger.warning("等待其他进程刷新令牌超时，自行刷新")
+        
+        try:
+            await self._fetch_access_token()
+            if redis_client is not None:
+                try:
+                    await redis_client.set(
+                        self.token_cache_key,
+                        json.dumps({'access_token': self.access_token, 'expires_at': self.token_expires_at}),
+                        exat=int(self.token_expires_at)
+                    )
+                except Exception as e:
+                    logger.warning(f"写入共享访问令牌失败: {e}")
+            return self.access_token
+        finally:
+            if holds_lock:
+                try:
+                    await redis_client.eval(RELEASE_LOCK_SCRIPT, 1, lock_key, lock_owner)
+                except Exception as e:
+                    logger.warning(f"释放令牌刷新锁失败: {e}")
+    
+    async def invalidate_access_token(self, token: str):
+        """令牌被企业微信判定失效时清除本地和共享缓存（仅当缓存的仍是该令牌）"""
+        if self.access_token == token:
+            self.access_token = None
+            self.token_expires_at = 0
+        redis_client = self._shared_redis()
+        if redis_client is None:
+            return
+        try:
+            data = await redis_client.get(self.token_cache_key)
+            if data and json.loads(data).get('access_token') == token:
+                await redis_client.delete(self.token_cache_key)
+        except Exception as e:
+            logger.warning(f"清除共享访问令牌失败: {e}")
+    
+    def start_token_refresher(self):
+        """启动后台令牌刷新任务，在过期前主动刷新，避免消息路径上等待gettoken"""
+        if not (self.corp_id and self.corp_secret):
+            return
+        if self._token_refresher is None or self._token_refresher.done():
+            self._token_refresher = asyncio.create_task(self._refresh_token_loop())
+    
+    async def _refresh_token_loop(self):
+        while True:
+            delay = self.token_expires_at - config.work_wechat.token_refresh_ahead - time.time()
+            await asyncio.sleep(max(delay, 30))
+            try:
+                async with self._token_lock:
+                    # 其他进程已刷新过则直接采用
+                    if not await self._load_shared_token(newer_than=self.token_expires_at):
+                        await self.refresh_access_token()
+                logger.info("企业微信访问令牌已后台刷新")
+            except Exception as e:
+                logger.error(f"后台刷新访问令牌失败: {e}")
     
     async def get_access_token(self) -> str:
-        """获取企业微信访问令牌"""
-        if self.access_token and time.time() < self.token_expires_at:
+        """获取企业微信访问令牌：本地缓存 -> Redis共享缓存 -> 刷新"""
+        if self._has_valid_token():
             return self.access_token
         
         try:
-            url = "https://qyapi.weixin.qq.com/cgi-bin/gettoken"
-            params = {
-                'corpid': self.corp_id,
-                'corpsecret': self.corp_secret
-            }
-            
-            async with httpx.AsyncClient() as client:
-                response = await client.get(url, params=params)
-                result = response.json()
-                
-                if result.get('errcode') == 0:
-                    self.access_token = result['access_token']
-                    # 提前5分钟过期
-                    self.token_expires_at = time.time() + result['expires_in'] - 300
-                    logger.info("企业微信访问令牌获取成功")
+            async with self._token_lock:
+                if self._has_valid_token():
                     return self.access_token
-                else:
-                    logger.error(f"获取访问令牌失败: {result}")
-                    raise Exception(f"获取访问令牌失败: {result.get('errmsg', '未知错误')}")
-                    
+                if await self._load_shared_token():
+                    return self.access_token
+                return await self.refresh_access_token()
         except Exception as e:
             logger.error(f"获取访问令牌异常: {e}")
             raise
     
-    async def send_message(self, user_id: str, content: str) -> bool:
-        """发送消息给用户"""
+    async def _post_message(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """调用message/send接口，令牌失效时重新获取并重试一次"""
+        start_time = time.perf_counter()
         try:
             access_token = await self.get_access_token()
-            url = f"https://qyapi.weixin.qq.com/cgi-bin/message/send?access_token={access_token}"
-            
-            data = {
-                "touser": user_id,
-                "msgtype": "text",
-                "agentid": self.agent_id,
-                "text": {
-                    "content": content
-                },
-                "safe": 0
-            }
+            url = f"{config.work_wechat.api_base}/cgi-bin/message/send?access_token={access_token}"
+            response = await self.get_http_client().post(url, json=data)
+            result = response.json()
             
-            async with httpx.AsyncClient() as client:
-                response = await client.post(url, json=data)
+            if result.get('errcode') in TOKEN_INVALID_ERRCODES:
+                # 令牌失效（被其他系统刷新或已过期），重新获取后重试一次
+                logger.warning(f"企业微信访问令牌失效: {result.get('errcode')}，重新获取")
+                await self.invalidate_access_token(access_token)
+                access_token = await self.get_access_token()
+                url = f"{config.work_wechat.api_base}/cgi-bin/message/send?access_token={access_token}"
+                response = await self.get_http_client().post(url, json=data)
                 result = response.json()
+        except Exception:
+            reply_send_errors_total.inc("work", "exception")
+            raise
+        finally:
+            reply_send_seconds.observe(time.perf_counter() - start_time, "work")
+        if result.get('errcode') != 0:
+            reply_send_errors_total.inc("work", str(result.get('errcode')))
+        return result
+    
+    def _text_message(self, content: str, **recipients: str) -> Dict[str, Any]:
+        """构建文本消息体"""
+        return {
+            **recipients,
+            "msgtype": "text",
+            "agentid": self.agent_id,
+            "text": {
+                "content": content
+            },
+            "safe": 0
+        }
+    
+    @traced("work.send_message", KIND_CLIENT)
+    async def send_message(self, user_id: str, content: str) -> bool:
+        """发送消息给用户"""
+        try:
+            result = await self._post_message(self._text_message(content, touser=user_id))
+            tracer.set_attribute("wechat.errcode", result.get('errcode'))
+            
+            if result.get('errcode') == 0:
+                logger.debug(f"企业微信消息发送成功，用户: {user_id}")
+                return True
+            else:
+                logger.error(f"企业微信消息发送失败: {result}")
+                return False
                 
-                if result.get('errcode') == 0:
-                    logger.info(f"企业微信消息发送成功，用户: {user_id}")
-                    return True
-                else:
-                    logger.error(f"企业微信消息发送失败: {result}")
-                    return False
-                    
         except Exception as e:
             logger.error(f"发送企业微信消息异常: {e}")
             return False
     
+    async def send_batch(
+        self,
+        content: str,
+        users: Optional[List[str]] = None,
+        parties: Optional[List[str]] = None,
+        tags: Optional[List[str]] = None
+    ) -> Dict[str, Any]:
+        """
+        批量发送同一条消息
+        
+        按企业微信接口上限把接收人打包成"|"分隔的 touser/toparty/totag，
+        多个批次以有限并发发送，并汇总每个接收人的发送结果。
+        
+        Args:
+            content: 消息内容
+            users: 成员ID列表
+            parties: 部门ID列表
+            tags: 标签ID列表
+            
+        Returns:
+            包含批次数、无效接收人和发送失败接收人的字典
+        """
+        users, parties, tags = users or [], parties or [], tags or []
+        user_chunks = _chunk(users, BATCH_LIMITS['touser'])
+        party_chunks = _chunk(parties, BATCH_LIMITS['toparty'])
+        tag_chunks = _chunk(tags, BATCH_LIMITS['totag'])
+        batch_count = max(len(user_chunks), len(party_chunks), len(tag_chunks))
+        
+        semaphore = asyncio.Semaphore(max(1, config.work_wechat.batch_concurrency))
+        report = {
+            "batches": batch_count,
+            "failed_batches": 0,
+            "invalid_users": [],
+            "invalid_parties": [],
+            "invalid_tags": [],
+            "failed_users": [],
+            "failed_parties": [],
+            "failed_tags": []
+        }
+        
+        async def send_one(index: int):
+            batch = {
+                "touser": user_chunks[index] if index < len(user_chunks) else [],
+                "toparty": party_chunks[index] if index < len(party_chunks) else [],
+                "totag": tag_chunks[index] if index < len(tag_chunks) else []
+            }
+            recipients = {key: "|".join(values) for key, values in batch.items() if values}
+            async with semaphore:
+                try:
+                    result = await self._post_message(self._text_message(content, **recipients))
+                except Exception as e:
+                    result = {"errcode": -1, "errmsg": str(e)}
+            
+            if result.get('errcode') == 0:
+                for key, report_key in (("invaliduser", "invalid_users"),
+                                        ("invalidparty", "invalid_parties"),
+                                        ("invalidtag", "invalid_tags")):
+                    if result.get(key):
+                        report[report_key].extend(result[key].split("|"))
+            else:
+                logger.error(f"企业微信批量发送失败，批次{index}: {result}")
+                report["failed_batches"] += 1
+                report["failed_users"].extend(batch["touser"])
+                report["failed_parties"].extend(batch["toparty"])
+                report["failed_tags"].extend(batch["totag"])
+        
+        await asyncio.gather(*(send_one(i) for i in range(batch_count)))
+        logger.info(
+            f"企业微信批量发送完成: {batch_count}个批次，失败{report['failed_batches']}个，"
+            f"无效成员{len(report['invalid_users'])}个"
+        )
+        return report
+    
     def parse_xml_message(self, xml_data: str) -> Dict[str, Any]:
         """解析XML消息"""
         try:
@@ -100,8 +507,17 @@ class WorkWeChatHandler:
             logger.error(f"XML消息解析失败: {e}")
             return {}
     
-    async def handle_message(self, message: Dict[str, Any]) -> bool:
-        """处理企业微信消息"""
+    @traced("work.handle_message")
+    async def handle_message(self, message: Dict[str, Any], retryable: bool = False) -> bool:
+        """
+        处理企业微信消息
+        
+        retryable 为True时（任务队列），Dify调用失败、回复发送失败或处理异常时抛出异常交给
+        队列重试，不给用户发送错误提示；已经分段推送过内容的消息不再重试，避免重复推送。
+        """
+        started_at = time.perf_counter()
+        outcome = "ignored"
+        reply_chars = 0
         try:
             msg_type = message.get('MsgType', '')
             from_user = message.get('FromUserName', '')
@@ -109,6 +525,7 @@ class WorkWeChatHandler:
             
             # 只处理文本消息
             if msg_type != 'text' or not content:
+                outcome = "unsupported"
                 await self.send_message(from_user, "抱歉，我目前只能处理文本消息。")
                 return True
             
@@ -123,25 +540,57 @@ class WorkWeChatHandler:
                     return True
             
             if not content:
+                outcome = "empty"
                 await self.send_message(from_user, "请输入要对话的内容。")
                 return True
             
-            # 获取会话ID
-            conversation_id = await session_manager.get_conversation_id(from_user)
+            # 关键词快速回复，不经过Dify
+            keyword_reply = await keyword_router.route(content, from_user)
+            if keyword_reply is not None:
+                outcome = "keyword"
+                await self.send_message(from_user, keyword_reply)
+                return True
             
-            # 调用Dify API
-            result = await dify_client.chat_completion(
-                message=content,
-                user_id=from_user,
-                conversation_id=conversation_id
-            )
+            # 近似重复问题直接使用缓存的回答
+            cached_reply = faq_cache.lookup(content)
+            if cached_reply is not None:
+                outcome = "faq_cache"
+                await self.send_message(from_user, cached_reply)
+                return True
             
-            # 保存会话ID
-            if result.get('conversation_id'):
-                await session_manager.set_conversation_id(
-                    from_user, 
-                    result['conversation_id']
+            # 流式推送模式下边生成边发送
+            streaming_reply = StreamingReply(self, from_user) if config.work_wechat.stream_reply else None
+            flush_task = asyncio.create_task(streaming_reply.run()) if streaming_reply else None
+            
+            # 调用Dify API（流式模式）：企业微信为主动推送，没有5秒限制，使用较长的截止时间
+            # 超过截止时间时流式调用会返回已生成的部分内容
+            try:
+                result = await asyncio.wait_for(
+                    dify_router.chat(
+                        message=content,
+                        user_id=from_user,
+                        priority=Priority.NORMAL,
+                        on_chunk=streaming_reply.update if streaming_reply else None
+                    ),
+                    timeout=config.work_wechat.reply_deadline
                 )
+            except asyncio.TimeoutError:
+                # 截止时间到达时仍在排队等待Dify槽位或等待响应头，流式调用来不及返回部分内容
+                logger.warning(f"⏱️ {config.work_wechat.reply_deadline}秒内未开始生成回复，用户: {from_user}")
+                streamed_text = streaming_reply.text if streaming_reply else ""
+                result = {
+                    "success": bool(streamed_text),
+                    "partial": bool(streamed_text),
+                    "timeout": True,
+                    "error": "等待Dify超时",
+                    "answer": streamed_text or REPLY_TIMEOUT_MESSAGE,
+                }
+            finally:
+                if flush_task:
+                    await streaming_reply.close(flush_task)
+            
+            if result.get('success') and not result.get('partial'):
+                faq_cache.remember(content, result.get('answer', ''), result['context_free'])
             
             # 发送回复
             reply_content = result.get('answer', '抱歉，我暂时无法回复。')
@@ -151,12 +600,26 @@ class WorkWeChatHandler:
             if len(reply_content) > max_length:
                 reply_content = reply_content[:max_length] + "..."
             
-            await self.send_message(from_user, reply_content)
-            logger.info(f"企业微信消息处理完成，用户: {from_user}")
+            reply_chars = len(reply_content)
+            outcome = ("timeout" if result.get('timeout') and not result.get('success')
+                       else "partial" if result.get('partial') else "dify" if result.get('success') else "dify_failed")
+            streamed = bool(streaming_reply and streaming_reply.sent_messages)
+            if retryable and not streamed and not result.get('success'):
+                raise JobFailed(f"Dify调用失败: {result.get('error', '')}")
+            if streamed and result.get('success'):
+                # 已推送过部分内容，只补发剩余部分：已发送长度按Dify原文计，最终片段同样取自原文
+                streaming_reply.text = result.get('answer') or streaming_reply.text
+                reply_chars = len(streaming_reply.text)
+                await streaming_reply.flush(final=True)
+            elif not await self.send_message(from_user, reply_content) and retryable and not streamed:
+                raise JobFailed("企业微信消息发送失败")
             return True
             
         except Exception as e:
+            outcome = "error"
             logger.error(f"企业微信消息处理异常: {e}")
+            if retryable:
+                raise
             # 发送错误消息
             try:
                 await self.send_message(
@@ -166,6 +629,21 @@ class WorkWeChatHandler:
             except:
                 pass
             return False
+        finally:
+            log_message_summary(
+                "企业微信消息", channel="work", msg_id=message.get('MsgId', ''),
+                user=message.get('FromUserName', ''), outcome=outcome, reply_chars=reply_chars,
+                elapsed_ms=round((time.perf_counter() - started_at) * 1000, 1)
+            )
+    
+    async def is_duplicate(self, message: Dict[str, Any]) -> bool:
+        """检查并记录消息ID，重复回调返回True（企业微信回调超时会重试，多个worker进程共享记录）"""
+        msg_id = message.get('MsgId') or f"{message.get('FromUserName', '')}:{message.get('CreateTime', '')}"
+        return not await state_store.add("processed:work", msg_id, DEDUP_TTL)
+    
+    async def send_busy_message(self, user_id: str):
+        """后台任务池已满时提示用户稍后再试"""
+        await self.send_message(user_id, "当前咨询人数较多，请稍后再试。")
     
     def verify_url(self, msg_signature: str, timestamp: str, nonce: str, echostr: str) -> str:
         """验证企业微信回调URL"""
@@ -192,15 +670,43 @@ class WorkWeChatHandler:
             elif request.method == "POST":
                 body = await request.body()
                 xml_data = body.decode('utf-8')
-                message = self.parse_xml_message(xml_data)
+                with xml_parse_seconds.time("work"), tracer.span("parse_xml"):
+                    message = self.parse_xml_message(xml_data)
                 
                 if not message:
                     return ""
                 
-                logger.info(f"收到企业微信消息: {message.get('MsgType', '')} from {message.get('FromUserName', '')}")
+                logger.debug(f"收到企业微信消息: {message.get('MsgType', '')} from {message.get('FromUserName', '')}")
                 
-                # 异步处理消息
-                await self.handle_message(message)
+                # 消息去重检查
+                if await self.is_duplicate(message):
+                    logger.info(f"企业微信消息已处理过，跳过: {message.get('MsgId', '')}")
+                    return "success"
+                
+                tracer.bind_msg_id(message.get('MsgId') or f"{message.get('FromUserName', '')}:{message.get('CreateTime', '')}")
+                
+                # 超过频率限制的消息不再处理，每个窗口最多提示一次
+                from_user = message.get('FromUserName', '')
+                if await rate_limiter.check("work", from_user, client_ip(request)):
+                    reply_outcome_total.inc("work", "rate_limited")
+                    if await rate_limiter.should_notify("work", from_user):
+                        self.send_notice(self.send_message(from_user, config.security.rate_limit_reply))
+                    return "success"
+                
+                # 队列模式下写入任务队列立即返回，由worker处理并主动推送
+                if job_queue.enabled:
+                    entry_id = await job_queue.enqueue(JOB_WORK_MESSAGE, {"message": message})
+                    if entry_id:
+                        reply_outcome_total.inc("work", "queued")
+                        return "success"
+                    logger.warning("任务队列不可用，降级为进程内后台处理")
+                
+                # 交给后台任务池处理，立即应答避免企业微信重试回调
+                if self.pool.submit(lambda: self.handle_message(message)):
+                    reply_outcome_total.inc("work", "background")
+                else:
+                    reply_outcome_total.inc("work", "rejected")
+                    self.send_notice(self.send_busy_message(message.get('FromUserName', '')))
                 return "success"
                 
         except Exception as e:
@@ -208,4 +714,9 @@ class WorkWeChatHandler:
             return "error"
 
 # 全局企业微信处理器实例
-work_wechat_handler = WorkWeChatHandler() 
\ No newline at end of file
+work_wechat_handler = WorkWeChatHandler()
+
+registry.gauge(
+    "dify2wechat_background_pool_queue", "后台任务池待处理任务数", ("pool",),
+    lambda: [((work_wechat_handler.pool.name,), work_wechat_handler.pool.stats()["queue_size"])]
+)
\ No newline at end of file
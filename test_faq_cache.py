@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试近似重复问题缓存
+
+- 相似度达到 threshold 的改写问题命中，低于阈值的不命中
+- 超过 ttl 的条目过期，超过 max_entries 时淘汰最旧的条目
+"""
+
+import pytest
+
+from src.config import config
+from src.faq_cache import FAQCache, jaccard, shingles
+
+QUESTION = "怎么申请退款"
+PARAPHRASE = "怎么申请退款？"
+UNRELATED = "今天天气怎么样"
+
+@pytest.fixture
+def cache():
+    """启用缓存的独立实例，测试结束后恢复配置"""
+    original = config.faq_cache.model_copy()
+    config.faq_cache.enabled = True
+    yield FAQCache()
+    config.faq_cache = original
+
+def test_threshold(cache):
+    """改写问题命中，无关问题不命中；阈值高于相似度时不命中"""
+    cache.remember(QUESTION, "请在订单页申请退款", context_free=True)
+    assert cache.lookup(PARAPHRASE) == "请在订单页申请退款"
+    assert cache.lookup(UNRELATED) is None
+
+    similarity = jaccard(shingles("怎么申请退款呢", cache.shingle_size), shingles(QUESTION, cache.shingle_size))
+    config.faq_cache.threshold = similarity + 0.01
+    assert cache.lookup("怎么申请退款呢") is None
+    config.faq_cache.threshold = similarity
+    assert cache.lookup("怎么申请退款呢") == "请在订单页申请退款"
+
+def test_context_dependent_answers_not_cached(cache):
+    """有会话上下文的回答不缓存"""
+    cache.remember(QUESTION, "请在订单页申请退款", context_free=False)
+    assert cache.lookup(QUESTION) is None
+
+def test_ttl_eviction(cache):
+    """超过有效期的条目在查找时被淘汰"""
+    cache.remember(QUESTION, "请在订单页申请退款", context_free=True)
+    for entry in cache._entries.values():
+        entry.created_at -= config.faq_cache.ttl + 1
+    assert cache.lookup(QUESTION) is None
+    assert cache.stats()["entries"] == 0
+    assert not any(cache._buckets)
+
+def test_max_entries_eviction(cache):
+    """超过容量时按插入顺序淘汰最旧的条目"""
+    config.faq_cache.max_entries = 2
+    questions = ["怎么申请退款", "如何修改收货地址", "发票什么时候开"]
+    for index, question in enumerate(questions):
+        cache.remember(question, f"回答{index}", context_free=True)
+    assert cache.stats()["entries"] == 2
+    assert cache.lookup(questions[0]) is None
+    assert cache.lookup(questions[1]) == "回答1"
+    assert cache.lookup(questions[2]) == "回答2"
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试冷启动导入耗时
+
+在新的解释器中导入 src.app，检查：
+- 导入耗时不超过预算（可用环境变量 IMPORT_BUDGET_SECONDS 调整）
+- 导入时没有连接Redis、没有导入wechatpy（这些在lifespan中按需创建）
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+IMPORT_BUDGET_SECONDS = float(os.environ.get("IMPORT_BUDGET_SECONDS", "2.0"))
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import src.app
+elapsed = time.perf_counter() - started
+from src.session_manager import session_manager
+print(json.dumps({
+    "elapsed": elapsed,
+    "redis_connected": session_manager._redis_initialized,
+    "wechatpy_imported": any(name.split(".")[0] == "wechatpy" for name in sys.modules),
+}))
+"""
+
+def measure_import() -> dict:
+    """在子进程中导入应用，返回耗时和导入副作用"""
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE],
+        cwd=PROJECT_ROOT, capture_output=True, text=True, timeout=60
+    )
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def test_import_time():
+    """导入 src.app 的耗时在预算内，且没有阻塞的连接和重量级导入"""
+    probe = measure_import()
+    print(f"导入耗时: {probe['elapsed']:.3f}秒（预算 {IMPORT_BUDGET_SECONDS}秒）")
+    assert not probe["redis_connected"], "导入时不应连接Redis"
+    assert not probe["wechatpy_imported"], "导入时不应导入wechatpy"
+    assert probe["elapsed"] < IMPORT_BUDGET_SECONDS, f"导入耗时 {probe['elapsed']:.3f}秒 超出预算"
+
+if __name__ == "__main__":
+    test_import_time()
+    print("✅ 导入耗时测试通过")
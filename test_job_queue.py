@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试任务队列的失败重试与死信流
+
+处理失败的任务不ack，超时后被XAUTOCLAIM接管重试，超过 max_deliveries 后转入死信流。
+使用 fakeredis 模拟Redis（未安装时跳过）。
+"""
+
+import asyncio
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from src.config import config
+from src.job_queue import JobQueue, JobWorker, JobFailed
+from src.session_manager import session_manager
+
+JOB_KIND = "test_job"
+
+async def _run_failing_job():
+    session_manager.async_redis_client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    config.queue.claim_idle_ms = 0
+    config.queue.max_deliveries = 2
+
+    queue = JobQueue()
+    attempts = []
+
+    async def failing_handler(payload):
+        attempts.append(payload)
+        raise JobFailed("Dify调用失败")
+
+    worker = JobWorker(queue, {JOB_KIND: failing_handler})
+    redis_client = session_manager.async_redis_client
+    await queue.enqueue(JOB_KIND, {"n": 1})
+
+    # 首次投递失败：任务仍在待确认列表中
+    for entry_id, fields in await queue.read("consumer-a", count=1):
+        await worker.process(entry_id, fields)
+    pending = await redis_client.xpending(queue.stream, queue.group)
+    assert pending["pending"] == 1
+
+    # 被接管重试，超过投递次数后转入死信流
+    for _ in range(config.queue.max_deliveries):
+        for entry_id, fields in await queue.reclaim("consumer-b", count=1):
+            await worker.process(entry_id, fields, reclaimed=True)
+
+    pending = await redis_client.xpending(queue.stream, queue.group)
+    dead_letters = await redis_client.xrange(queue.dead_letter_stream)
+    return attempts, pending["pending"], dead_letters
+
+def test_failed_job_is_dead_lettered():
+    """处理失败的任务不被ack，重试超过次数后进入死信流"""
+    queue_config = config.queue.model_copy()
+    try:
+        attempts, pending, dead_letters = asyncio.run(_run_failing_job())
+    finally:
+        config.queue = queue_config
+        session_manager.async_redis_client = None
+    # 首次投递和一次重试调用了处理函数，第三次投递直接转入死信流
+    assert len(attempts) == 2
+    assert pending == 0
+    assert len(dead_letters) == 1
+    assert dead_letters[0][1]["kind"] == JOB_KIND
+
+if __name__ == "__main__":
+    test_failed_job_is_dead_lettered()
+    print("✅ 任务队列死信测试通过")
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试消息限流
+
+- 本地令牌桶超限时直接拒绝
+- 多个worker进程共享Redis滑动窗口，窗口拒绝时退还本地令牌
+- 白名单中的用户和IP不限流
+"""
+
+import asyncio
+
+import pytest
+from fakeredis import aioredis as fake_aioredis
+
+from src.config import config
+from src.rate_limiter import RateLimiter
+from src.session_manager import session_manager
+
+@pytest.fixture
+def limits():
+    """每个窗口限3条，测试结束后恢复配置"""
+    original = config.security.model_copy()
+    config.security.rate_limit = 3
+    config.security.ip_rate_limit = 0
+    config.security.rate_limit_window = 60
+    config.security.whitelist = []
+    yield config.security
+    config.security = original
+
+@pytest.fixture
+def shared_redis(monkeypatch):
+    """用fakeredis代替共享的Redis"""
+    monkeypatch.setattr(session_manager, "_redis_client", object())
+    monkeypatch.setattr(session_manager, "_redis_initialized", True)
+    monkeypatch.setattr(session_manager, "async_redis_client", fake_aioredis.FakeRedis(decode_responses=True))
+
+async def _send(limiter, count, user_id="u1", ip="1.2.3.4"):
+    return [await limiter.check("official", user_id, ip) for _ in range(count)]
+
+def test_local_bucket(limits, monkeypatch):
+    """Redis不可用时按本地令牌桶限流"""
+    monkeypatch.setattr(session_manager, "_redis_client", None)
+    monkeypatch.setattr(session_manager, "_redis_initialized", True)
+    results = asyncio.run(_send(RateLimiter(), 4))
+    assert results == [None, None, None, "user"]
+
+def test_shared_window_refunds_local_token(limits, shared_redis):
+    """另一个worker用完共享窗口后被拒绝，本地令牌被退还，不会重复计数"""
+    first, second = RateLimiter(), RateLimiter()
+    assert asyncio.run(_send(first, 3)) == [None, None, None]
+
+    assert asyncio.run(_send(second, 2)) == ["user", "user"]
+    tokens, _ = second._buckets["user:official:u1"]
+    assert tokens == pytest.approx(3, abs=0.01)
+
+def test_ip_limit_refunds_user_token(limits, monkeypatch):
+    """IP维度超限时退还已取出的用户令牌"""
+    monkeypatch.setattr(session_manager, "_redis_client", None)
+    monkeypatch.setattr(session_manager, "_redis_initialized", True)
+    limits.ip_rate_limit = 1
+    limiter = RateLimiter()
+    assert asyncio.run(_send(limiter, 2)) == [None, "ip"]
+    tokens, _ = limiter._buckets["user:official:u1"]
+    assert tokens == pytest.approx(2, abs=0.01)
+
+def test_whitelist(limits, shared_redis):
+    """白名单中的用户和IP不限流，也不写入共享窗口"""
+    limits.ip_rate_limit = 1
+    limits.whitelist = ["vip", "10.0.0.1"]
+    limiter = RateLimiter()
+    assert asyncio.run(_send(limiter, 5, user_id="vip", ip="10.0.0.1")) == [None] * 5
+    # 只有IP在白名单中时仍按用户限流
+    assert asyncio.run(_send(limiter, 4, ip="10.0.0.1")) == [None, None, None, "user"]
+    assert "user:official:vip" not in limiter._buckets
+    assert asyncio.run(session_manager.async_redis_client.exists("ratelimit:ip:10.0.0.1")) == 0
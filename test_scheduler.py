@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试Dify请求调度器和准入控制
+
+- 同一优先级内按用户加权公平排队，短消息先出队，高优先级先于低优先级
+- 排队期间被取消的请求不占用槽位
+- 准入控制按进行中调用所属优先级的占用时长估算等待时间
+"""
+
+import asyncio
+
+import pytest
+
+from src.config import config
+from src.scheduler import DifyScheduler, Priority
+from src import admission
+
+@pytest.fixture(autouse=True)
+def single_slot():
+    """只允许一个并发槽位，便于观察排队顺序"""
+    original = config.scheduler.max_concurrency
+    config.scheduler.max_concurrency = 1
+    yield
+    config.scheduler.max_concurrency = original
+
+async def _grant_order(requests):
+    """占住唯一槽位后依次提交请求，返回获得槽位的顺序"""
+    scheduler = DifyScheduler()
+    holder = await scheduler.acquire("holder")
+    order = []
+
+    async def request(name, user_id, priority, message):
+        ticket = await scheduler.acquire(user_id, priority, message)
+        order.append(name)
+        scheduler.release(ticket)
+
+    tasks = [asyncio.create_task(request(*item)) for item in requests]
+    await asyncio.sleep(0)
+    scheduler.release(holder)
+    await asyncio.gather(*tasks)
+    return order
+
+def test_wfq_ordering():
+    """高优先级先出队；同一优先级内短消息先出队，同一用户的连续请求排在其他用户之后"""
+    order = asyncio.run(_grant_order([
+        ("background", "u1", Priority.BACKGROUND, "短"),
+        ("long", "u2", Priority.INTERACTIVE, "长" * 500),
+        ("short", "u3", Priority.INTERACTIVE, "短"),
+        ("u3-second", "u3", Priority.INTERACTIVE, "短"),
+        ("u4", "u4", Priority.INTERACTIVE, "短"),
+    ]))
+    assert order[-1] == "background"
+    assert order.index("short") < order.index("long")
+    assert order.index("u4") < order.index("u3-second")
+
+async def _cancel_while_queued():
+    scheduler = DifyScheduler()
+    holder = await scheduler.acquire("holder")
+    queued = asyncio.create_task(scheduler.acquire("cancelled"))
+    waiting = asyncio.create_task(scheduler.acquire("waiting"))
+    await asyncio.sleep(0)
+    assert scheduler.queue_depth == 2
+
+    queued.cancel()
+    await asyncio.gather(queued, return_exceptions=True)
+    assert scheduler.queue_depth == 1
+
+    scheduler.release(holder)
+    ticket = await asyncio.wait_for(waiting, timeout=1)
+    assert ticket.user_id == "waiting"
+    assert scheduler.active == 1
+    scheduler.release(ticket)
+    return scheduler
+
+def test_cancel_while_queued():
+    """排队期间取消的请求被跳过，槽位分配给下一个请求"""
+    scheduler = asyncio.run(_cancel_while_queued())
+    assert scheduler.active == 0
+    assert scheduler.queue_depth == 0
+
+def test_admission_estimate_by_priority(monkeypatch):
+    """后台长回复的占用时长不会拉高只有被动回复在进行时的估算"""
+    scheduler = DifyScheduler()
+    monkeypatch.setattr(admission, "dify_scheduler", scheduler)
+    controller = admission.AdmissionController()
+    scheduler.service_time_ewma[Priority.INTERACTIVE] = 2.0
+    scheduler.service_time_ewma[Priority.BACKGROUND] = 30.0
+
+    # 有空闲槽位时不需要等待
+    assert controller.estimate_wait() == 0.0
+
+    # 槽位被被动回复占用：按被动回复的占用时长估算
+    scheduler._active = 1
+    scheduler._active_by_priority[Priority.INTERACTIVE] = 1
+    assert controller.estimate_wait() == pytest.approx(2.0)
+
+    # 槽位被后台长回复占用：等待时间相应变长
+    scheduler._active_by_priority[Priority.INTERACTIVE] = 0
+    scheduler._active_by_priority[Priority.BACKGROUND] = 1
+    assert controller.estimate_wait() == pytest.approx(30.0)
+
+if __name__ == "__main__":
+    config.scheduler.max_concurrency = 1
+    test_wfq_ordering()
+    test_cancel_while_queued()
+    print("✅ 调度器测试通过")
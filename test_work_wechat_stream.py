@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+企业微信流式回复测试脚本
+
+在本地启动一个同时模拟企业微信API和Dify流式接口的mock服务，
+验证回复会按节奏分段推送，而不是等生成结束后才发送。
+"""
+
+import asyncio
+import json
+import sys
+import threading
+import time
+from pathlib import Path
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+# 添加src目录到路径
+sys.path.insert(0, str(Path(__file__).parent / "src"))
+
+from src.config import config
+
+MOCK_PORT = 18765
+# 模拟Dify逐句生成，每个数据块间隔0.4秒
+DIFY_CHUNKS = ["你好！", "我是企业微信助手。", "这是第一段回答，", "内容比较长。", "下面是第二段，", "继续补充说明。", "最后一句结束。"]
+
+sent_messages = []
+mock_app = FastAPI()
+
+@mock_app.get("/cgi-bin/gettoken")
+async def mock_gettoken():
+    return {"errcode": 0, "errmsg": "ok", "access_token": "mock-token", "expires_in": 7200}
+
+@mock_app.post("/cgi-bin/message/send")
+async def mock_send(request: Request):
+    data = await request.json()
+    sent_messages.append((time.time(), data["text"]["content"]))
+    return {"errcode": 0, "errmsg": "ok"}
+
+@mock_app.post("/v1/chat-messages")
+async def mock_dify():
+    async def events():
+        for chunk in DIFY_CHUNKS:
+            await asyncio.sleep(0.4)
+            yield f"data: {json.dumps({'event': 'message', 'answer': chunk, 'conversation_id': 'c1', 'id': 'm1'}, ensure_ascii=False)}\n\n"
+        yield f"data: {json.dumps({'event': 'message_end', 'conversation_id': 'c1', 'id': 'm1'})}\n\n"
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+def start_mock_server():
+    """后台线程启动mock服务"""
+    server = uvicorn.Server(uvicorn.Config(mock_app, port=MOCK_PORT, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+async def run_streaming_reply():
+    """通过mock服务处理一条企业微信消息"""
+    from src.dify_client import dify_client
+    from src.work_wechat import work_wechat_handler
+
+    config.work_wechat.api_base = f"http://127.0.0.1:{MOCK_PORT}"
+    config.work_wechat.stream_reply = True
+    config.work_wechat.stream_flush_interval = 0.5
+    config.work_wechat.stream_min_chars = 5
+    config.dify.api_base = f"http://127.0.0.1:{MOCK_PORT}/v1"
+    config.work_wechat.corp_id = "mock-corp"
+    config.work_wechat.corp_secret = "mock-secret"
+
+    start_time = time.time()
+    await work_wechat_handler.handle_message({
+        "MsgType": "text",
+        "FromUserName": "mock_user",
+        "Content": "介绍一下你自己"
+    })
+    await dify_client.close()
+    await work_wechat_handler.close()
+    return start_time
+
+def test_work_wechat_streaming():
+    """测试流式分段推送"""
+    print("🧪 企业微信流式回复测试")
+    print("=" * 30)
+
+    server = start_mock_server()
+    try:
+        start_time = asyncio.run(run_streaming_reply())
+    finally:
+        server.should_exit = True
+
+    for sent_at, content in sent_messages:
+        print(f"  +{sent_at - start_time:.2f}s  {content}")
+
+    assert len(sent_messages) > 1, "回复应被拆分为多条消息推送"
+    assert "".join(content for _, content in sent_messages) == "".join(DIFY_CHUNKS)
+    assert sent_messages[0][0] - start_time < len(DIFY_CHUNKS) * 0.4, "首条消息应在生成结束前送达"
+    print("✅ 流式推送正常")
+
+if __name__ == "__main__":
+    test_work_wechat_streaming()
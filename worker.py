@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dify任务worker主程序
+
+从Redis Stream消费Webhook写入的任务并调用Dify，可独立于Webhook进程扩缩容：
+    python worker.py               # 按 queue.processes 启动进程
+    python worker.py --processes 4 # 覆盖进程数
+"""
+
+import sys
+import signal
+import asyncio
+import argparse
+import multiprocessing
+from pathlib import Path
+from typing import Dict, Any
+from loguru import logger
+
+# 添加项目根目录到Python路径
+project_root = Path(__file__).parent
+sys.path.insert(0, str(project_root))
+
+from src.config import config
+from main import setup_logging
+
+async def run_worker():
+    """运行单个worker进程"""
+    from src.job_queue import job_queue, JobWorker, JOB_OFFICIAL_REPLY, JOB_WORK_MESSAGE
+    from src.wechat_official import wechat_official_handler
+    from src.work_wechat import work_wechat_handler
+
+    # retryable=True：处理失败时抛出异常而不是给用户发错误提示，任务不ack，等待重试或转入死信流
+    async def handle_official_reply(payload: Dict[str, Any]):
+        await wechat_official_handler.async_complete_response(payload["message"], payload["user_id"], retryable=True)
+
+    async def handle_work_message(payload: Dict[str, Any]):
+        await work_wechat_handler.handle_message(payload["message"], retryable=True)
+
+    worker = JobWorker(job_queue, {
+        JOB_OFFICIAL_REPLY: handle_official_reply,
+        JOB_WORK_MESSAGE: handle_work_message,
+    })
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, worker.stop)
+
+    from src.lifecycle import build_services, start_background_tasks
+    await asyncio.to_thread(build_services)
+    start_background_tasks()
+
+    from src.loop_watchdog import loop_watchdog
+    from src.config_reload import config_reloader
+    loop_watchdog.start()
+    config_reloader.start()
+    try:
+        await worker.run()
+    finally:
+        await config_reloader.stop()
+        await loop_watchdog.stop()
+        await work_wechat_handler.close()
+
+def worker_process():
+    """子进程入口"""
+    setup_logging()
+    try:
+        asyncio.run(run_worker())
+    except KeyboardInterrupt:
+        pass
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="Dify任务worker")
+    parser.add_argument("--processes", type=int, default=config.queue.processes, help="worker进程数")
+    args = parser.parse_args()
+
+    setup_logging()
+    if not config.queue.enabled:
+        logger.warning("⚠️ queue.enabled 未开启，Webhook不会向队列写入任务")
+
+    logger.info(f"🚀 启动 {args.processes} 个worker进程，每个进程并发 {config.queue.concurrency}")
+    if args.processes <= 1:
+        worker_process()
+        return
+
+    processes = [multiprocessing.Process(target=worker_process) for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+
+    # SIGTERM转发给子进程，子进程处理完当前任务后退出
+    def forward_sigterm(signum, frame):
+        for process in processes:
+            process.terminate()
+    signal.signal(signal.SIGTERM, forward_sigterm)
+
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+        logger.info("👋 worker已停止")
+
+if __name__ == "__main__":
+    main()